@@ -4,14 +4,21 @@
 
 
 import numpy as np
-import laspy
+from grid_binning import cell_indices, group_argmin, hilbert_codes, space_filling_order
+from las_io import read_xyz, write_masked_points
+from instrument import stage, staged, count, write_report
+from cell_index import CellIndex
 
+@staged('gftin_read')
 def read_laz_file(file_path):
-    las = laspy.read(file_path)
-    points = np.vstack((las.x, las.y, las.z)).transpose()
+    # read the coordinates chunk by chunk, without keeping the whole LasData in memory
+    points = read_xyz(file_path)
     return points
 
-def create_grid_and_find_lowest_points(points, grid_size):
+@staged('gftin_seeds')
+def create_grid_and_find_lowest_points(points, grid_size, cell_index=None):
+    # with a CellIndex of the points at grid_size (see cell_index.py) the points are already sorted
+    # by cell, and the grid starts at the lower left corner of the index
     
     # These two lines calculate the minimum and maximum x and y coordinates among all points. 
     # This is used to determine the extent of the grid.
@@ -20,48 +27,139 @@ def create_grid_and_find_lowest_points(points, grid_size):
     print("min_x, min_y: ", min_x, min_y)
     print("max_x, max_y: ", max_x, max_y)
     
-    # Create grid
-    # These two lines create a sequence of x and y coordinates that represent the positions of the grid lines, 
-    # plus grid_size for later use. grid_size is the size of the grid cells.
-    x_coords = np.arange(min_x, max_x, grid_size)
-    y_coords = np.arange(min_y, max_y, grid_size)
-
-    lowest_points = []
-    for x in x_coords:
-        for y in y_coords:
-            # Find the point in the grid
-            in_grid = (points[:, 0] >= x) & (points[:, 0] < x + grid_size) & \
-                      (points[:, 1] >= y) & (points[:, 1] < y + grid_size)
-            grid_points = points[in_grid]
-
-            if len(grid_points) > 0:
-                # Select the point with the smallest z value
-                lowest_point = grid_points[np.argmin(grid_points[:, 2])]
-                lowest_points.append(lowest_point)
-            else:
-                # Print the position of the grid without data
-                print(f"No data in grid at position: x={x}, y={y}")
-
-    return np.array(lowest_points)
-
-grid_size = 40  # Maximum building 33x33m
-input_laz_path = "600_thinned_025_filtered.laz"
-points=read_laz_file(input_laz_path)
-lowest_points = create_grid_and_find_lowest_points(points, grid_size)
-
-print(len(lowest_points)) #If =225, there is no cell with no data
+    if cell_index is not None:
+        num_y, num_x = cell_index.shape
+        x_coords = cell_index.origin[0] + np.arange(num_x) * grid_size
+        y_coords = cell_index.origin[1] + np.arange(num_y) * grid_size
+
+        # the lowest point of every cell of the index, the cells of the index are numbered row by row,
+        # renumber them column by column (x outer, y inner) so the seeds keep the order of the former nested loops.
+        sorted_ids = cell_index.sorted_cell_ids()
+        lowest_index = group_argmin(sorted_ids, cell_index.xyz[:len(sorted_ids), 2], num_x * num_y)
+        lowest_index = lowest_index.reshape(num_y, num_x).T.ravel()
+        lowest_points = np.asarray(cell_index.xyz[lowest_index[lowest_index >= 0]])
+    else:
+        # Create grid
+        # These two lines create a sequence of x and y coordinates that represent the positions of the grid lines, 
+        # plus grid_size for later use. grid_size is the size of the grid cells.
+        x_coords = np.arange(min_x, max_x, grid_size)
+        y_coords = np.arange(min_y, max_y, grid_size)
+
+        # Assign every point to its grid cell in one pass, cells are numbered column by column
+        # (x outer, y inner) so the seeds keep the order of the former nested loops.
+        ix, iy, in_grid = cell_indices(points[:, 0], points[:, 1], min_x, min_y, grid_size,
+                                       len(x_coords), len(y_coords))
+        cell_ids = np.where(in_grid, ix * len(y_coords) + iy, -1)
+
+        # Select the point with the smallest z value in every cell
+        lowest_index = group_argmin(cell_ids, points[:, 2], len(x_coords) * len(y_coords))
+        lowest_points = points[lowest_index[lowest_index >= 0]]
+
+    # Report the position of the grids without data
+    empty = np.flatnonzero(lowest_index < 0)
+    count('gftin.seeds', len(lowest_points))
+    count('gftin.empty_seed_cells', len(empty))
+    empty_cells = np.column_stack((x_coords[empty // len(y_coords)], y_coords[empty % len(y_coords)]))
+
+    return lowest_points, empty_cells
+
+if __name__ == "__main__":
+    grid_size = 40  # Maximum building 33x33m
+    input_laz_path = "600_thinned_025_filtered.laz"
+    # the points sorted by seed cell, saved next to the laz file and reused by later runs
+    with stage('gftin_read'):
+        cell_index = CellIndex.for_file(input_laz_path, grid_size)
+        points = cell_index.file_order()
+    lowest_points, empty_cells = create_grid_and_find_lowest_points(points, grid_size, cell_index)
+
+    print(len(lowest_points)) #If =225, there is no cell with no data
+    if len(empty_cells) > 0:
+        print(f"No data in {len(empty_cells)} grids at positions (x, y):")
+        print(empty_cells)
 
 
 # ## Form the original TIN by lowest points and find other ground points
 
 
+import csv
+import os
+import time
 import matplotlib.pyplot as plt
 import startinpy
 from tqdm import tqdm
+from triangle_grid import TriangleGrid
+from checkpoint import Checkpoint, checkpoint_key
+
+# this is the threshold from 0.1 thining
+DISTANCE_THRESHOLD = 0.15651385846605634
+ANGLE_THRESHOLD = 1.4878249952648377
+
+
+def distance_and_angle(points, p123):
+    """
+    vectorized distance and angle test of many points against their triangles
+    points: an array of points with x, y, z values
+    p123: an array with the 3 vertices of the triangle of each point (n, 3, 3)
+    returns the distance of each point to the plane of its triangle and
+    the largest angle (in degrees) between that plane and the lines from the vertices to the point
+    """
+    p1, p2, p3 = p123[:, 0], p123[:, 1], p123[:, 2]
+
+    # Calculate distance
+    normal_vector = np.cross(p2 - p1, p3 - p1)
+    normal_vector /= np.linalg.norm(normal_vector, axis=1)[:, None]
+    # the normal points upwards, like for the counter-clockwise triangles of startinpy
+    normal_vector *= np.where(normal_vector[:, 2] < 0, -1.0, 1.0)[:, None]
+    distance = np.abs(np.sum(normal_vector * (points - p1), axis=1))
+
+    # Calculate alpha
+    max_angle = np.zeros(len(points))
+    for p in (p1, p2, p3):
+        v = points - p
+        norm_v = np.linalg.norm(v, axis=1)
+        # the same point does not count
+        same = norm_v == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cos_angle = np.sum(v * normal_vector, axis=1) / norm_v
+        angle = np.arccos(np.clip(cos_angle, -1.0, 1.0))
+        complement_angle = np.pi / 2 - angle
+        max_angle = np.where(same, max_angle, np.maximum(max_angle, complement_angle))
+
+    alpha = np.degrees(max_angle)
+    return distance, alpha
+
+
+def _triangle_keys(triangles, num_vertices):
+    """
+    one integer per triangle, the same for every rotation of its vertices
+    """
+    rows = np.sort(triangles, axis=1)
+    return (rows[:, 0] * num_vertices + rows[:, 1]) * num_vertices + rows[:, 2]
+
+
+def _match_triangles(old, new):
+    """
+    for every triangle of old, the index of the same triangle in new (-1 if it is gone)
+    and for every triangle of new whether it also is in old
+    """
+    num_vertices = max(old.max(initial=0), new.max(initial=0)) + 1
+    old_keys = _triangle_keys(old, num_vertices)
+    new_keys = _triangle_keys(new, num_vertices)
+    order = np.argsort(new_keys)
+    sorted_keys = new_keys[order]
+    position = np.minimum(np.searchsorted(sorted_keys, old_keys), len(new) - 1)
+    found = sorted_keys[position] == old_keys
+    old_to_new = np.where(found, order[position], -1)
+    new_in_old = np.zeros(len(new), dtype=bool)
+    new_in_old[old_to_new[found]] = True
+    return old_to_new, new_in_old
+
 
 class Tin:
     def __init__(self):
         self.dt = startinpy.DT()
+        # the TriangleGrid of the triangles, built by the first locate_many and then updated incrementally
+        self.index = None
         
     def insert_lowest_pts(self,arr): # insert a lot of point at the same time and create TIN
         return self.dt.insert(arr)
@@ -135,16 +233,240 @@ class Tin:
         
         return self.dt.is_inside_convex_hull(x,y)
 
-    def find_distance_and_add_points(self, points): # main function 
-        results = []
-
-        for point in tqdm(points, desc="Processing points"):
+    def locate_many(self, xy, prefer=None, old_to_new=None, unchanged=None):
+        """
+        the batch version of get_location and is_inside_tin: locate an array of [x, y] locations at once
+        with the TriangleGrid of the triangles. the grid follows the insertions into the TIN: only the
+        triangles created since the last call are bucketed again (see TriangleGrid.update).
+        prefer: optional indices of triangles that are searched first, the others only for the
+        locations that are in none of them (e.g. the new triangles around the inserted points)
+        old_to_new, unchanged: the matching of the triangles before and after the insertions
+        (see _match_triangles), when it is known already
+        returns the index in get_triangles() of the triangle of every location (-1 outside the TIN),
+        and whether every location is inside the convex hull (or on its boundary)
+        """
+        index = self.triangle_index(old_to_new, unchanged)
+        if prefer is None:
+            located = index.locate(xy)
+        else:
+            subset = np.zeros(len(index.triangles), dtype=bool)
+            subset[prefer] = True
+            located = index.locate(xy, subset=subset)
+            lost = np.flatnonzero(located < 0)
+            if len(lost) > 0:
+                located[lost] = index.locate(np.asarray(xy)[lost])
+        return located, located >= 0
+
+    def triangle_index(self, old_to_new=None, unchanged=None):
+        """
+        the TriangleGrid of the current triangles, built on the first call and updated incrementally
+        after points were inserted
+        """
+        vertices = self.get_delaunay_vertices()
+        triangles = self.get_triangles().astype(np.int64).reshape(-1, 3)
+        if self.index is None:
+            self.index = TriangleGrid(vertices, triangles)
+        elif len(self.index.vertices) != len(vertices):
+            if old_to_new is None:
+                old_to_new, unchanged = _match_triangles(self.index.triangles, triangles)
+            self.index.update(vertices, triangles, old_to_new, np.flatnonzero(~unchanged))
+            count('gftin.index_updates')
+        return self.index
+
+    def first_pass(self, points):
+        """
+        locate all points in the current TIN and test them against their triangle, the first
+        iteration of find_distance_and_add_points_batch. it does not depend on the thresholds,
+        so a threshold sweep computes it once for the seed TIN.
+        returns the triangle of every point (-1 outside the TIN), and its distance and angle, in float64
+        like in the iterations, so that the thresholds accept exactly the same points
+        """
+        points = np.asarray(points, dtype=np.float64)
+        vertices = self.get_delaunay_vertices()
+        triangles = self.get_triangles().astype(np.int64).reshape(-1, 3)
+        located = self.locate_many(points)[0]
+        distance = np.full(len(points), np.nan)
+        alpha = np.full(len(points), np.nan)
+        inside = np.flatnonzero(located >= 0)
+        distance[inside], alpha[inside] = distance_and_angle(points[inside], vertices[triangles[located[inside]]])
+        return located, distance, alpha
+
+    def find_distance_and_add_points_batch(self, points, distance_threshold=DISTANCE_THRESHOLD,
+                                           angle_threshold=ANGLE_THRESHOLD, curve=None, first_pass=None,
+                                           ground=None, checkpoint=None, checkpoint_interval=60.0):
+        """
+        progressive TIN densification in iterations:
+        every iteration tests all candidate points against the current TIN at once,
+        inserts in bulk the point closest to the plane of its triangle among the accepted points
+        of every triangle, and repeats until no more points qualify.
+        only points whose triangle was changed by the insertions are tested again.
+        curve ('morton' or 'hilbert') processes the points along a space filling curve,
+        so that consecutive point locations are close to each other in the TIN.
+        ties are broken on the input order, so the result does not depend on the curve.
+        first_pass is the result of first_pass(points) for the current TIN, so it is not computed again.
+        ground is a mask of points that are already in the TIN (a warm start), they are not tested again.
+        the time spent on point location and insertion is kept in self.timings, the number of iterations
+        in self.iterations
+        checkpoint is a .npz file where the state of the densification is saved every checkpoint_interval
+        seconds: the inserted points in their order of insertion and the state of every point after the
+        last iteration. a run with the same TIN, points and thresholds resumes from it, by inserting
+        the same points in the same order, and gives the same result; the file is removed at the end
+        returns a mask of the ground points, and the last float32 distance and angle of every point
+        (nan for points outside the TIN)
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if curve is None:
+            order = rank = np.arange(len(points))
+        else:
+            order = rank = space_filling_order(points[:, 0], points[:, 1], curve)
+            points = points[order]
+        # the chosen points of an iteration are always inserted along the hilbert curve: the order
+        # of insertion decides the triangulation of cocircular points, and it keeps the insertions local
+        insertion_key = hilbert_codes(points[:, 0], points[:, 1])
+        self.timings = {'locate': 0.0, 'insert': 0.0}
+        self.iterations = 0
+        ground = np.zeros(len(points), dtype=bool) if ground is None else np.asarray(ground, dtype=bool)[order]
+        distance = np.full(len(points), np.nan, dtype=np.float32)
+        alpha = np.full(len(points), np.nan, dtype=np.float32)
+
+        vertices = self.get_delaunay_vertices()
+        inserted = []
+        state = None
+        if checkpoint is not None:
+            checkpoint = Checkpoint(checkpoint, checkpoint_key(points, vertices, ground, curve=curve,
+                                                               distance_threshold=distance_threshold,
+                                                               angle_threshold=angle_threshold),
+                                    checkpoint_interval)
+            state = checkpoint.load()
+        if state is not None:
+            inserted.append(state['inserted'])
+            start = time.perf_counter()
+            self.insert_lowest_pts(points[state['inserted']])
+            self.timings['insert'] += time.perf_counter() - start
+            self.iterations = int(state['iterations'])
+            ground, distance, alpha = state['ground'], state['distance'], state['alpha']
+            located, candidates, todo = state['located'], state['candidates'], state['todo']
+            vertices = self.get_delaunay_vertices()
+            print(f"resuming after iteration {self.iterations} from {checkpoint.file_path}")
+        triangles = self.get_triangles().astype(np.int64).reshape(-1, 3)
+        if state is None:
+            start = time.perf_counter()
+            if first_pass is None:
+                located = self.locate_many(points)[0]
+            else:
+                located, first_distance, first_alpha = (np.asarray(values)[order] for values in first_pass)
+                distance[:], alpha[:] = first_distance, first_alpha
+            self.timings['locate'] += time.perf_counter() - start
+            # the convex hull does not grow, points outside the TIN are never ground points
+            candidates = np.flatnonzero((located >= 0) & ~ground)
+            todo = candidates
+            count('gftin.outside_tin', np.count_nonzero(located < 0))
+
+        with tqdm(desc="Densification iterations") as progress:
+            while len(todo) > 0:
+                if first_pass is not None and self.iterations == 0:
+                    # the float64 values, the float32 ones may round across a threshold
+                    d, a = first_distance[todo], first_alpha[todo]
+                else:
+                    d, a = distance_and_angle(points[todo], vertices[triangles[located[todo]]])
+                    distance[todo] = d
+                    alpha[todo] = a
+
+                # at most one point per triangle: the closest one to the plane of the triangle
+                passed = (d < distance_threshold) & (a < angle_threshold)
+                if not passed.any():
+                    break
+                accepted, d = todo[passed], d[passed]
+                accepted = accepted[np.lexsort((rank[accepted], d, located[accepted]))]
+                first = np.append(True, located[accepted][1:] != located[accepted][:-1])
+                chosen = accepted[first]
+                chosen = chosen[np.lexsort((rank[chosen], insertion_key[chosen]))]
+
+                start = time.perf_counter()
+                self.insert_lowest_pts(points[chosen])
+                self.timings['insert'] += time.perf_counter() - start
+                count('gftin.inserted', len(chosen))
+                count('gftin.iterations')
+                self.iterations += 1
+                inserted.append(chosen)
+                ground[chosen] = True
+                candidates = candidates[~ground[candidates]]
+
+                # follow the candidates whose triangle is unchanged, locate the others in the new triangles
+                new_vertices = self.get_delaunay_vertices()
+                new_triangles = self.get_triangles().astype(np.int64).reshape(-1, 3)
+                start = time.perf_counter()
+                old_to_new, unchanged = _match_triangles(triangles, new_triangles)
+                located[candidates] = old_to_new[located[candidates]]
+                moved = candidates[located[candidates] < 0]
+                changed = np.flatnonzero(~unchanged)
+                # a grid of only the new triangles is much smaller than the one of locate_many, which
+                # is not updated here but on its next call
+                located[moved] = changed[TriangleGrid(new_vertices, new_triangles[changed]).locate(points[moved])]
+                lost = moved[located[moved] < 0]
+                if len(lost) > 0:
+                    # a point on the border of the changed region
+                    located[lost] = TriangleGrid(new_vertices, new_triangles).locate(points[lost])
+                    candidates = candidates[located[candidates] >= 0]
+                self.timings['locate'] += time.perf_counter() - start
+
+                # test again the points in changed triangles and the accepted points that lost against another point
+                retest = np.zeros(len(points), dtype=bool)
+                retest[moved] = True
+                retest[accepted[~first]] = True
+                retest[ground] = False
+                todo = np.flatnonzero(retest & (located >= 0))
+                vertices, triangles = new_vertices, new_triangles
+                progress.update()
+                progress.set_postfix(inserted=len(chosen), retest=len(todo))
+                if checkpoint is not None:
+                    checkpoint.save_due(inserted=np.concatenate(inserted), iterations=self.iterations,
+                                        ground=ground, distance=distance, alpha=alpha, located=located,
+                                        candidates=candidates, todo=todo)
+
+        if checkpoint is not None:
+            checkpoint.remove()
+
+        # back to the input order
+        result = []
+        for values in (ground, distance, alpha):
+            unordered = np.empty_like(values)
+            unordered[order] = values
+            result.append(unordered)
+        return tuple(result)
+
+    @staged('gftin_densify')
+    def find_distance_and_add_points(self, points, batch=True, curve=None, distance_threshold=DISTANCE_THRESHOLD,
+                                     angle_threshold=ANGLE_THRESHOLD, checkpoint=None): # main function 
+        """
+        find the ground points among points and add them to the TIN
+        a point is a ground point when its distance to the plane of its triangle is below distance_threshold
+        and its angle below angle_threshold, see threshold_sweep to choose them
+        checkpoint is the file to save the state of the batch densification in, to resume an interrupted run
+        returns a mask of the ground points, and the float32 distance and angle of every point
+        (nan for points outside the TIN)
+        """
+        if batch:
+            return self.find_distance_and_add_points_batch(points, distance_threshold, angle_threshold, curve=curve,
+                                                           checkpoint=checkpoint)
+        if checkpoint is not None:
+            raise ValueError("only the batch densification can be resumed from a checkpoint")
+        if curve is not None:
+            # every point is tested against the TIN as it is at that moment
+            raise ValueError("the sequential sweep depends on the point order, reorder the points with batch=True")
+
+        points = np.asarray(points, dtype=np.float64)
+        ground = np.zeros(len(points), dtype=bool)
+        distances = np.full(len(points), np.nan, dtype=np.float32)
+        alphas = np.full(len(points), np.nan, dtype=np.float32)
+
+        for i, point in enumerate(tqdm(points, desc="Processing points")):
             
             inside_index = self.is_inside_tin(point)
     
             if not inside_index:
-                results.append((point, None, None, False))  # not inside TIN
-                continue
+                count('gftin.outside_tin')
+                continue  # not inside TIN
 
             arr = self.get_location(point)
             p123 = self.get_p123(arr)
@@ -174,62 +496,171 @@ class Tin:
                 max_angle = max(max_angle, complement_angle)
 
             alpha = np.degrees(max_angle)
+            distances[i] = distance
+            alphas[i] = alpha
 
             # Determine whether to add points
-            if distance < 0.15651385846605634 and alpha < 1.4878249952648377:  
+            if distance < distance_threshold and alpha < angle_threshold:  
                 # this is the threshold from 0.1 thining
                 # will be change in the following
                 self.insert_ground_pt(point)
-                results.append((point, distance, alpha, True))
+                ground[i] = True
+                count('gftin.inserted')
+
+        return ground, distances, alphas
+
+
+def compare_point_orders(initial_points, points, curves=(None, 'morton', 'hilbert')):
+    """
+    run the batched densification once per point order (None is the order of the file)
+    and report the time spent on point location and insertion for each of them.
+    the ground classification must be the same for every order.
+    returns the timings per order
+    """
+    report = {}
+    reference = None
+    for curve in curves:
+        tin = Tin()
+        tin.insert_lowest_pts(initial_points)
+        ground, _, _ = tin.find_distance_and_add_points_batch(points, curve=curve)
+        if reference is None:
+            reference = ground
+        elif not np.array_equal(ground, reference):
+            print(f"{curve}: {np.count_nonzero(ground != reference)} points are classified differently")
+        name = curve or 'file'
+        report[name] = tin.timings
+        print(f"{name} order: locate {tin.timings['locate']:.2f} s, insert {tin.timings['insert']:.2f} s")
+    return report
+
+
+@staged('gftin_sweep')
+def threshold_sweep(initial_points, points, distance_thresholds, angle_thresholds, curve='hilbert',
+                    warm_start=False, output='../data/output/gftin_sweep.csv'):
+    """
+    run the densification for every pair of distance and angle thresholds, to choose them.
+    the TIN of the seed points and the first pass (point location, distance and angle in that TIN)
+    are computed once and shared by all pairs.
+    with warm_start a pair starts from the ground points of a stricter pair (a smaller distance or
+    angle threshold with the other one the same, the one with the most ground points), which are
+    inserted in the TIN at once instead of found again iteration by iteration. this is much faster,
+    but the accepted sets are only nested approximately: a denser TIN accepts fewer points, so the
+    counts are lower than those of independent runs (by about 10% on the synthetic tiles). it is meant
+    for a first coarse sweep, without it every pair gives exactly the result of find_distance_and_add_points.
+    the ground point count, iterations and timings of every pair are written as csv to output.
+    returns the rows of the table
+    """
+    points = np.asarray(points, dtype=np.float64)
+    insertion_key = hilbert_codes(points[:, 0], points[:, 1])
+    start = time.perf_counter()
+    seed_tin = Tin()
+    seed_tin.insert_lowest_pts(initial_points)
+    with stage('first_pass'):
+        first = seed_tin.first_pass(points)
+    shared = time.perf_counter() - start
+    print(f"seed TIN and first pass: {shared:.2f} s")
+
+    distance_thresholds = sorted(distance_thresholds)
+    angle_thresholds = sorted(angle_thresholds)
+    rows = []
+    # the ground points of the pairs of the previous and the current distance threshold
+    previous, current = {}, {}
+    for distance_threshold in distance_thresholds:
+        last = None
+        for angle_threshold in angle_thresholds:
+            start = time.perf_counter()
+            tin = Tin()
+            tin.insert_lowest_pts(initial_points)
+            stricter = [mask for mask in (previous.get(angle_threshold), last) if mask is not None]
+            if warm_start and stricter:
+                warm = max(stricter, key=np.count_nonzero)
+                warm_index = np.flatnonzero(warm)
+                tin.insert_lowest_pts(points[warm_index[np.argsort(insertion_key[warm_index], kind='stable')]])
+                ground, _, _ = tin.find_distance_and_add_points_batch(points, distance_threshold, angle_threshold,
+                                                                      curve=curve, ground=warm)
+                warm_count = len(warm_index)
             else:
-                results.append((point, distance, alpha, False))
-
-        return results
+                ground, _, _ = tin.find_distance_and_add_points_batch(points, distance_threshold, angle_threshold,
+                                                                      curve=curve, first_pass=first)
+                warm_count = 0
+            seconds = time.perf_counter() - start
+            current[angle_threshold] = last = ground
+            rows.append({'distance_threshold': distance_threshold, 'angle_threshold': angle_threshold,
+                         'ground_points': int(np.count_nonzero(ground)), 'warm_start_points': warm_count,
+                         'iterations': tin.iterations, 'seconds': seconds,
+                         'locate_seconds': tin.timings['locate'], 'insert_seconds': tin.timings['insert']})
+            print(f"distance {distance_threshold:g}, angle {angle_threshold:g}: "
+                  f"{rows[-1]['ground_points']} ground points in {seconds:.2f} s")
+        previous, current = current, {}
+
+    if output is not None:
+        directory = os.path.dirname(output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+@staged('gftin')
+def ground_filter(input_laz_path, output_path, grid_size=40, curve='hilbert', checkpoint=True):
+    """
+    the whole ground filtering of a laz file, like the cells below: the lowest point of every grid cell
+    forms the initial TIN, that is densified with the points that pass the distance and angle tests.
+    the ground points are copied to output_path with all their attributes.
+    with checkpoint the densification is saved to output_path.checkpoint.npz while it runs,
+    and a run that was interrupted continues from there.
+    returns the number of ground points
+    """
+    with stage('gftin_read'):
+        cell_index = CellIndex.for_file(input_laz_path, grid_size)
+        points = cell_index.file_order()
+    lowest_points, empty_cells = create_grid_and_find_lowest_points(points, grid_size, cell_index)
+    if len(empty_cells) > 0:
+        print(f"No data in {len(empty_cells)} grids")
+    with stage('gftin_tin_build'):
+        tin = Tin()
+        tin.insert_lowest_pts(lowest_points)
+    ground, _, _ = tin.find_distance_and_add_points(
+        points, curve=curve, checkpoint=f"{output_path}.checkpoint.npz" if checkpoint else None)
+    if not ground.any():
+        raise ValueError(f"no ground points found in {input_laz_path}")
+    with stage('gftin_write'):
+        write_masked_points(input_laz_path, output_path, ground)
+    return int(np.count_nonzero(ground))
 
 
 # ## Build the TIN and use it
 
 
 
-initial_points=lowest_points
-
-tin = Tin()
-tin.insert_lowest_pts(initial_points)
-print(tin.number_of_vertices())
-print(tin.number_of_triangles())
+if __name__ == "__main__":
+    initial_points=lowest_points
 
+    with stage('gftin_tin_build'):
+        tin = Tin()
+        tin.insert_lowest_pts(initial_points)
+    print(tin.number_of_vertices())
+    print(tin.number_of_triangles())
 
 
-query_points = points
-results = tin.find_distance_and_add_points(query_points)
 
+    query_points = points
+    results = tin.find_distance_and_add_points(query_points, curve='hilbert')
 
 
 # ## Save data to laz files
 
 
 
-import numpy as np
-import laspy
-
-data = results
-
-filtered_points = [item[0] for item in data if item[-1]]
-
-header = laspy.LasHeader(version="1.2", point_format=1)
-outfile = laspy.LasData(header)
-
-if filtered_points:
-    all_points = np.array(filtered_points)
-    outfile.x = all_points[:, 0]
-    outfile.y = all_points[:, 1]
-    outfile.z = all_points[:, 2]
-
-    outfile.write("600_GP_output.laz")
-else:
-    print("No points with the last attribute as True.")
-
-
-
-
+if __name__ == "__main__":
+    ground, distance, alpha = results
 
+    if ground.any():
+        # copy the ground points with all their attributes and the header of the input file
+        with stage('gftin_write'):
+            write_masked_points(input_laz_path, "600_GP_output.laz", ground)
+    else:
+        print("No ground points found.")
+    write_report('../data/output/gftin_report.json', input=input_laz_path, grid_size=grid_size)
@@ -0,0 +1,180 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import time
+import tracemalloc
+
+import numpy as np
+import laspy
+
+from synthetic_terrain import generate_tile
+from las_io import read_points
+from cell_index import index_directory
+from instrument import max_rss_mb, reset_max_rss
+from GFTIN_final_pyVer import create_grid_and_find_lowest_points, Tin
+from laplace_interpolate import generate_grid, laplace_interpolant
+from raster_io import header_transform, raster_profile, write_raster
+from step4 import CLASSES as STEP4_CLASSES, DIMENSIONS as STEP4_DIMENSIONS, split_point_cloud, step4
+from step5 import step5
+
+
+def measure(func, *args, prepare=None, **kwargs):
+    '''
+        Run func twice and measure it: once for the wall and cpu time (s) and the peak resident size
+        of the process while it ran (MB), and once with tracemalloc, which slows the allocations down,
+        for the peak of the memory allocated while it ran (MB, numpy included)
+
+        Input:
+            prepare: called before each run and not measured, e.g. to remove the files a run saves
+                     for the next ones, so that both runs start from the same state
+
+        Output:
+            the result of the timed run of func, and a dictionary with the measures
+    '''
+    def run():
+        # the stages print their progress, keep the benchmark output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func(*args, **kwargs)
+
+    if prepare is not None:
+        prepare()
+    reset_max_rss()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = run()
+    # the peak resident size is the one of the process so far where it cannot be reset
+    stats = {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu, 'max_rss_mb': max_rss_mb()}
+
+    if prepare is not None:
+        prepare()
+    tracemalloc.start()
+    run()
+    stats['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result, stats
+
+
+def _densify(seeds, points):
+    tin = Tin()
+    tin.insert_lowest_pts(seeds)
+    return tin.find_distance_and_add_points(points)
+
+
+def benchmark_tile(file_path, resolutions, output_dir, grid_size=40):
+    '''
+        Time every stage of the pipeline on one laz tile
+
+        Input:
+            file_path: the laz tile
+            resolutions: output resolutions of the rasters
+            output_dir: directory for the rasters written by the stages
+            grid_size: cell size of the seed points of GFTIN
+
+        Output:
+            a list with one record per stage run
+    '''
+    with laspy.open(file_path) as reader:
+        header = reader.header
+    bbx = [header.x_min, header.x_max, header.y_min, header.y_max]
+    data = read_points(file_path, ('x', 'y', 'z', 'classification'), classes=(1, 2))
+    points = np.column_stack((data['x'], data['y'], data['z']))
+    records = []
+
+    def record(stage, stats, **params):
+        records.append({'stage': stage, 'points': len(points), **params, **stats})
+        print(f"{stage} {params}: {stats['wall']:.2f} s, peak {stats['peak_mb']:.0f} MB")
+
+    (seeds, _), stats = measure(create_grid_and_find_lowest_points, points, grid_size)
+    record('create_grid_and_find_lowest_points', stats, grid_size=grid_size)
+    (ground, _, _), stats = measure(_densify, seeds, points)
+    record('find_distance_and_add_points', stats, grid_size=grid_size)
+
+    ground_points = points[ground]
+    for res in resolutions:
+        # the DTM on the grid of step4 (which covers the extent with whole cells from x_min, y_min),
+        # so that step5 can subtract the rasters
+        columns = len(np.arange(bbx[0], bbx[1], res))
+        rows = len(np.arange(bbx[2], bbx[3], res))
+        grid_bbx = [bbx[0], bbx[0] + (columns + 0.5) * res, bbx[2], bbx[2] + (rows + 0.5) * res]
+        cell_centers, rows, columns = generate_grid(grid_bbx, res)
+        dtm, stats = measure(laplace_interpolant, ground_points, cell_centers, rows, columns)
+        record('laplace_interpolant', stats, res=res)
+        dtm_file = os.path.join(output_dir, f'dtm_{res}.tiff')
+        write_raster(dtm, raster_profile(header_transform(header, res), dtm.shape[1], dtm.shape[0]), dtm_file)
+
+        _, stats = measure(split_point_cloud, data['x'], data['y'], header, res)
+        record('split_point_cloud', stats, res=res)
+        step4_file = os.path.join(output_dir, f'step4_{res}.tiff')
+        # step4 saves the index of the points next to the tile, which is reused by later runs,
+        # remove it so that every run (and every benchmark) grids the points
+        step4_index = index_directory(file_path, res, STEP4_DIMENSIONS, classes=STEP4_CLASSES)
+        _, stats = measure(step4, file_path, res, output=step4_file,
+                           prepare=lambda: shutil.rmtree(step4_index, ignore_errors=True))
+        shutil.rmtree(step4_index, ignore_errors=True)
+        record('step4', stats, res=res)
+        _, stats = measure(step5, dtm_file=dtm_file, step4_file=step4_file,
+                           output=os.path.join(output_dir, f'step5_{res}.tiff'))
+        record('step5', stats, res=res)
+    return records
+
+
+def run_benchmark(name='baseline', densities=(2, 5, 10), extent=(100.0, 100.0), resolutions=(2.0, 1.0, 0.5),
+                  output_dir='../data/benchmark', seed=0):
+    '''
+        Generate a synthetic tile per density and benchmark every stage on it.
+        The records are saved as ../data/benchmark/{name}.json, to compare later runs against
+
+        Input:
+            name: name of the result file
+            densities: first returns per m2 of the tiles
+            extent: size of the tiles in x and y (m)
+            resolutions: output resolutions of the rasters
+            output_dir: directory of the tiles, rasters and results
+            seed: seed of the synthetic tiles
+
+        Output:
+            the path of the result file
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    records = []
+    for density in densities:
+        tile = os.path.join(output_dir, f'synthetic_{extent[0]:g}x{extent[1]:g}_{density:g}.laz')
+        if not os.path.exists(tile):
+            generate_tile(tile, extent, density, seed=seed)
+        print(f"Benchmark {tile}")
+        for item in benchmark_tile(tile, resolutions, output_dir):
+            records.append({'density': density, 'extent': list(extent), **item})
+
+    result = {'name': name, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+              'cpus': os.cpu_count(), 'records': records}
+    output = os.path.join(output_dir, f'{name}.json')
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    return output
+
+
+def compare_benchmarks(baseline_file, result_file):
+    '''
+        Print the wall time and memory of every stage of result_file relative to baseline_file,
+        for the stage runs with the same stage, density and parameters in both
+    '''
+    def index(file_path):
+        with open(file_path) as f:
+            records = json.load(f)['records']
+        return {(r['stage'], r['density'], r.get('res'), r.get('grid_size')): r for r in records}
+
+    baseline = index(baseline_file)
+    result = index(result_file)
+    for key in sorted(baseline.keys() & result.keys(), key=str):
+        old, new = baseline[key], result[key]
+        print(f"{key[0]} density {key[1]} res {key[2]}: "
+              f"time {old['wall']:.2f} -> {new['wall']:.2f} s ({old['wall'] / max(new['wall'], 1e-9):.1f}x), "
+              f"peak {old['peak_mb']:.0f} -> {new['peak_mb']:.0f} MB")
+
+
+if __name__ == '__main__':
+    print(run_benchmark())
@@ -0,0 +1,234 @@
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from grid_binning import cell_indices, sort_by_cell
+from las_io import read_header, read_points
+
+
+class CellIndex:
+    '''
+        The points of a tile sorted by the grid cell they fall in. The points of cell k are the
+        rows offsets[k]:offsets[k + 1] of every column, so they are a zero-copy slice. Cells are
+        numbered row by row from (x_min, y_min): k = row * num_x + col, like the grids of step4.
+        Points outside the grid are kept after the last cell.
+        An index is saved as .npy files in a directory next to the laz file and loaded memory mapped,
+        so repeated runs at the same cell size do not read the laz file or sort the points again.
+    '''
+
+    def __init__(self, columns, order, offsets, bbox, origin, cell_size, shape):
+        '''
+            Input:
+                columns: dictionary of arrays sorted by cell ('xyz' holds the coordinates as (n, 3))
+                order: for every sorted point its index in the laz file (after the class filter)
+                offsets: start of the points of every cell, num_cells + 1 values
+                bbox: [min_x, max_x, min_y, max_y] of the points of every cell, nan for empty cells
+                origin: [x_min, y_min] of the grid
+                cell_size: size of the cells
+                shape: (num_y, num_x), the number of rows and columns of cells
+        '''
+        self.columns = columns
+        self.order = order
+        self.offsets = offsets
+        self.bbox = bbox
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.cell_size = cell_size
+        self.shape = tuple(int(v) for v in shape)
+
+    @classmethod
+    def build(cls, columns, cell_size, origin, shape):
+        '''
+            Build the index of the points in columns (a dictionary of arrays with at least x and y)
+            on the grid with lower left corner origin and shape (num_y, num_x)
+        '''
+        x = np.asarray(columns['x'], dtype=np.float64)
+        y = np.asarray(columns['y'], dtype=np.float64)
+        num_y, num_x = shape
+        col, row, inside = cell_indices(x, y, origin[0], origin[1], cell_size, num_x, num_y)
+        num_cells = num_x * num_y
+        cell_ids = np.where(inside, row * num_x + col, -1)
+        inside_order, cells, starts = sort_by_cell(cell_ids)
+        # the points outside the grid go after the last cell, in file order
+        order = np.concatenate((inside_order, np.flatnonzero(~inside)))
+
+        counts = np.diff(np.append(starts, len(inside_order)))
+        offsets = np.zeros(num_cells + 1, dtype=np.int64)
+        offsets[cells + 1] = counts
+        offsets = np.cumsum(offsets)
+
+        sorted_columns = {}
+        for name, values in columns.items():
+            if name in ('x', 'y', 'z'):
+                continue
+            sorted_columns[name] = np.ascontiguousarray(np.asarray(values)[order])
+        z = np.asarray(columns['z'], dtype=np.float64) if 'z' in columns else np.zeros(len(x))
+        sorted_columns['xyz'] = np.column_stack((x[order], y[order], z[order]))
+
+        bbox = np.full((num_cells, 4), np.nan)
+        if len(starts) > 0:
+            xs = sorted_columns['xyz'][:len(inside_order), 0]
+            ys = sorted_columns['xyz'][:len(inside_order), 1]
+            bbox[cells] = np.column_stack((np.minimum.reduceat(xs, starts), np.maximum.reduceat(xs, starts),
+                                           np.minimum.reduceat(ys, starts), np.maximum.reduceat(ys, starts)))
+        return cls(sorted_columns, order, offsets, bbox, origin, cell_size, shape)
+
+    @classmethod
+    def for_file(cls, file_path, cell_size, dimensions=('x', 'y', 'z'), classes=None):
+        '''
+            The index of a laz file on the grid of cell_size from the lower left corner of its header
+            (the grid of split_point_cloud in step4). It is loaded from the directory next to the file
+            when it was saved before for the same file, cell size, dimensions and classes,
+            and built and saved otherwise.
+
+            Input:
+                file_path: the laz file (or PointStore directory)
+                cell_size: size of the cells
+                dimensions: the dimensions to keep, x, y and z are stored together as 'xyz'
+                classes: optional list of classification codes, only points with these classes are kept
+
+            Output:
+                the CellIndex
+        '''
+        directory = index_directory(file_path, cell_size, dimensions, classes)
+        stat = os.stat(file_path)
+        meta = {'file_size': stat.st_size, 'file_mtime_ns': stat.st_mtime_ns, 'cell_size': cell_size,
+                'dimensions': list(dimensions), 'classes': None if classes is None else [int(c) for c in classes]}
+        if os.path.exists(os.path.join(directory, 'meta.json')):
+            with open(os.path.join(directory, 'meta.json')) as f:
+                saved = json.load(f)
+            if all(saved.get(key) == value for key, value in meta.items()):
+                return cls.load(directory)
+
+        header = read_header(file_path)
+        origin = [header.x_min, header.y_min]
+        shape = (len(np.arange(header.y_min, header.y_max, cell_size)),
+                 len(np.arange(header.x_min, header.x_max, cell_size)))
+        columns = read_points(file_path, tuple(dict.fromkeys(('x', 'y', 'z') + tuple(dimensions))), classes=classes)
+        index = cls.build(columns, cell_size, origin, shape)
+        index.save(directory, **meta)
+        return index
+
+    def save(self, directory, **meta):
+        '''
+            Save the index as .npy files and a meta.json in directory.
+            The files are written in a temporary directory first, that is then renamed.
+        '''
+        # one temporary directory per thread, a tile may be indexed in the background while it is used
+        partial = f"{directory}.partial-{os.getpid()}-{threading.get_ident()}"
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        for name, values in self.columns.items():
+            np.save(os.path.join(partial, f'column_{name}.npy'), values)
+        np.save(os.path.join(partial, 'order.npy'), self.order)
+        np.save(os.path.join(partial, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(partial, 'bbox.npy'), self.bbox)
+        with open(os.path.join(partial, 'meta.json'), 'w') as f:
+            json.dump({**meta, 'origin': self.origin.tolist(), 'grid_cell_size': self.cell_size,
+                       'shape': list(self.shape), 'columns': list(self.columns)}, f, indent=2)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(partial, directory)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        '''
+            Load an index saved with save, the arrays are memory mapped by default
+        '''
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+
+        def array(name):
+            return np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        columns = {name: array(f'column_{name}') for name in meta['columns']}
+        return cls(columns, array('order'), array('offsets'), array('bbox'), meta['origin'],
+                   meta['grid_cell_size'], meta['shape'])
+
+    @property
+    def num_cells(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def xyz(self):
+        return self.columns['xyz']
+
+    def cell_slice(self, k):
+        '''
+            The slice of the sorted columns with the points of cell k
+        '''
+        return slice(int(self.offsets[k]), int(self.offsets[k + 1]))
+
+    def cell(self, k, name='xyz'):
+        '''
+            The points of cell k (a view of the column name)
+        '''
+        return self.columns[name][self.cell_slice(k)]
+
+    def cell_of(self, row, col):
+        return row * self.shape[1] + col
+
+    def occupied(self):
+        '''
+            The non-empty cells and the start of their points, like sort_by_cell returns them
+        '''
+        counts = np.diff(self.offsets)
+        cells = np.flatnonzero(counts > 0)
+        return cells, self.offsets[cells]
+
+    def sorted_cell_ids(self):
+        '''
+            The cell of every sorted point inside the grid
+        '''
+        return np.repeat(np.arange(self.num_cells), np.diff(self.offsets))
+
+    def bbox_slices(self, bbox):
+        '''
+            The slices of the sorted columns with the cells overlapping bbox [min_x, max_x, min_y, max_y],
+            one slice per row of cells (the cells of a row are contiguous)
+        '''
+        num_y, num_x = self.shape
+        # clip before the conversion to integers, the box may be infinite
+        low = np.clip(np.floor((np.array([bbox[0], bbox[2]]) - self.origin) / self.cell_size), -1, [num_x, num_y])
+        high = np.clip(np.floor((np.array([bbox[1], bbox[3]]) - self.origin) / self.cell_size), -1, [num_x, num_y])
+        col0, row0 = np.maximum(low.astype(np.int64), 0)
+        col1, row1 = np.minimum(high.astype(np.int64), [num_x - 1, num_y - 1])
+        if col0 > col1 or row0 > row1:
+            return []
+        return [slice(int(self.offsets[row * num_x + col0]), int(self.offsets[row * num_x + col1 + 1]))
+                for row in range(row0, row1 + 1)]
+
+    def points_in_bbox(self, bbox, name='xyz'):
+        '''
+            The points inside bbox [min_x, max_x, min_y, max_y], and their index in the sorted columns.
+            A bbox that is exactly one cell is a zero-copy slice, see cell
+        '''
+        # the points outside the grid (e.g. on its upper edge) may be in the box too
+        slices = self.bbox_slices(bbox) + [slice(int(self.offsets[-1]), len(self.order))]
+        index = np.concatenate([np.arange(s.start, s.stop) for s in slices])
+        xy = self.xyz[index, :2]
+        inside = (xy[:, 0] >= bbox[0]) & (xy[:, 0] <= bbox[1]) & (xy[:, 1] >= bbox[2]) & (xy[:, 1] <= bbox[3])
+        index = index[inside]
+        return self.columns[name][index], index
+
+    def file_order(self, name='xyz'):
+        '''
+            A column in the order of the laz file (after the class filter)
+        '''
+        values = np.empty(self.columns[name].shape, dtype=self.columns[name].dtype)
+        values[self.order] = self.columns[name]
+        return values
+
+
+def index_directory(file_path, cell_size, dimensions=('x', 'y', 'z'), classes=None):
+    '''
+        The directory next to the laz file where its index for these parameters is saved
+    '''
+    name = f"{os.path.basename(file_path)}.cells_{cell_size:g}"
+    extra = [d for d in dimensions if d not in ('x', 'y', 'z')]
+    if extra:
+        name += '_' + '-'.join(extra)
+    if classes is not None:
+        name += '_class' + '-'.join(str(int(c)) for c in classes)
+    return os.path.join(os.path.dirname(os.path.abspath(file_path)), name)
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from instrument import count
+
+
+def checkpoint_key(*arrays, **params):
+    '''
+        sha256 of the content of arrays and of params, a checkpoint is only resumed by a run
+        with the same key (the same input points, cells and parameters)
+    '''
+    sha = hashlib.sha256()
+    for values in arrays:
+        values = np.ascontiguousarray(values)
+        sha.update(f"{values.dtype.str}{values.shape}".encode())
+        sha.update(values.data)
+    sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+class Checkpoint:
+    '''
+        The state of a long loop saved to a .npz file every interval seconds, so that a run that
+        is interrupted (a crash, or a preemption of the batch node) resumes from the last save.
+        A save is written under a temporary name and then renamed, so the file is always complete.
+
+            checkpoint = Checkpoint(file_path, key)
+            state = checkpoint.load()              # None when there is nothing to resume
+            ...
+                checkpoint.save_due(done=..., values=...)
+            checkpoint.remove()                    # the loop finished
+    '''
+
+    def __init__(self, file_path, key, interval=60.0):
+        '''
+            Input:
+                file_path: the .npz file of the checkpoint
+                key: the checkpoint_key of the run
+                interval: minimum number of seconds between two saves of save_due
+        '''
+        self.file_path = file_path
+        self.key = key
+        self.interval = interval
+        self.saved = time.monotonic()
+
+    def load(self):
+        '''
+            The arrays of the last save as a dictionary, None if there is no checkpoint or it was
+            written by a run with another key
+        '''
+        if not os.path.exists(self.file_path):
+            return None
+        with np.load(self.file_path) as data:
+            if str(data['key']) != self.key:
+                print(f"{self.file_path} belongs to another run, starting over")
+                return None
+            state = {name: data[name] for name in data.files if name != 'key'}
+        count('checkpoint.resumed')
+        return state
+
+    def save(self, **arrays):
+        partial = f"{self.file_path}.partial"
+        with open(partial, 'wb') as f:
+            np.savez(f, key=self.key, **arrays)
+        os.replace(partial, self.file_path)
+        self.saved = time.monotonic()
+        count('checkpoint.saves')
+
+    def save_due(self, **arrays):
+        '''
+            Save when the last save is more than interval seconds ago
+        '''
+        if time.monotonic() - self.saved >= self.interval:
+            self.save(**arrays)
+
+    def remove(self):
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
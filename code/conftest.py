@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from las_io import read_points, read_xyz, write_masked_points
+from synthetic_terrain import generate_tile
+
+
+@pytest.fixture(scope='session')
+def tiny_tile(tmp_path_factory):
+    '''
+        A small synthetic laz tile (terrain, buildings and trees with multiple returns)
+    '''
+    file_path = str(tmp_path_factory.mktemp('tiles') / 'tiny.laz')
+    generate_tile(file_path, extent=(40.0, 40.0), density=4.0, seed=1)
+    return file_path
+
+
+@pytest.fixture(scope='session')
+def tiny_ground(tiny_tile):
+    '''
+        The ground points (class 2) of tiny_tile, as a laz file and an array of x, y, z values
+    '''
+    file_path = tiny_tile.replace('.laz', '_ground.laz')
+    write_masked_points(tiny_tile, file_path, read_points(tiny_tile, ('classification',))['classification'] == 2)
+    return file_path, read_xyz(file_path)
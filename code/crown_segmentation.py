@@ -0,0 +1,260 @@
+import itertools
+import os
+
+import numpy as np
+import rasterio
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from grid_binning import cell_indices, sort_by_cell, group_reduce, group_argmin
+from las_io import read_points
+from instrument import stage, staged, count
+
+
+def neighbor_pairs(xyz, eps):
+    '''
+        All pairs of points at most eps apart, found by hashing the points into a grid of cells of
+        size eps: the neighbours of a point are in the 27 cells around (and including) its own cell
+
+        Input:
+            xyz: an array of points with x, y, z values
+            eps: the distance
+
+        Output:
+            two arrays i, j with both directions of every pair (i != j)
+    '''
+    xyz = np.asarray(xyz, dtype=np.float64)
+    if len(xyz) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # a border of empty cells around the points, so that the keys of the neighbouring cells never wrap
+    cell = np.floor((xyz - xyz.min(axis=0)) / eps).astype(np.int64) + 1
+    dims = cell.max(axis=0) + 2
+    keys = (cell[:, 0] * dims[1] + cell[:, 1]) * dims[2] + cell[:, 2]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    # every pair is found once, from the cell with the smaller key (or within one cell for i < j),
+    # and then added in both directions
+    pair_i, pair_j = [], []
+    for dx, dy, dz in itertools.product((-1, 0, 1), repeat=3):
+        step = (dx * dims[1] + dy) * dims[2] + dz
+        if step < 0:
+            continue
+        start = np.searchsorted(sorted_keys, keys + step, side='left')
+        size = np.searchsorted(sorted_keys, keys + step, side='right') - start
+        i = np.repeat(np.arange(len(xyz)), size)
+        j = order[np.repeat(start - np.cumsum(size) + size, size) + np.arange(size.sum())]
+        close = np.sum((xyz[i] - xyz[j]) ** 2, axis=1) <= eps ** 2
+        if step == 0:
+            close &= i < j
+        pair_i.append(i[close])
+        pair_j.append(j[close])
+    i = np.concatenate(pair_i)
+    j = np.concatenate(pair_j)
+    return np.concatenate((i, j)), np.concatenate((j, i))
+
+
+def dbscan(xyz, eps=0.5, min_samples=10, tile_size=50.0):
+    '''
+        DBSCAN clustering tile by tile. Every tile of tile_size * tile_size (in x and y) is clustered
+        with the points within 2 * eps around it: that is enough to know which points within eps of
+        the tile are core points (at least min_samples points, itself included, within eps), and so
+        every link between core points that crosses the tile border. The clusters of the tiles are
+        merged through the core points they share. The core points and the clusters are the same as
+        the ones of DBSCAN on all the points at once; a border point within eps of the core points of
+        several clusters may join another one of them.
+
+        Input:
+            xyz: an array of points with x, y, z values
+            eps: the neighbourhood distance
+            min_samples: number of points within eps of a core point
+            tile_size: size of the tiles, at least 2 * eps
+
+        Output:
+            the cluster of every point, -1 for noise points
+    '''
+    xyz = np.asarray(xyz, dtype=np.float64)
+    labels = np.full(len(xyz), -1, dtype=np.int64)
+    if len(xyz) == 0:
+        return labels
+    tile_size = max(tile_size, 2 * eps)
+    x_min, y_min = xyz[:, 0].min(), xyz[:, 1].min()
+    num_x = int((xyz[:, 0].max() - x_min) // tile_size) + 1
+    num_y = int((xyz[:, 1].max() - y_min) // tile_size) + 1
+    col, row, _ = cell_indices(xyz[:, 0], xyz[:, 1], x_min, y_min, tile_size, num_x, num_y)
+    order, tiles, starts = sort_by_cell(row * num_x + col)
+    ends = np.append(starts[1:], len(order))
+    offsets = np.zeros(num_x * num_y + 1, dtype=np.int64)
+    offsets[tiles + 1] = ends - starts
+    offsets = np.cumsum(offsets)
+
+    # the cluster of the tile that owns each core point, the clusters of the other tiles sharing a
+    # core point, and the cluster each border point joins
+    owner = np.full(len(xyz), -1, dtype=np.int64)
+    shared_point, shared_cluster = [], []
+    border_point, border_cluster = [], []
+    num_clusters = 0
+    for tile in tiles:
+        r, c = divmod(int(tile), num_x)
+        box = [x_min + c * tile_size, x_min + (c + 1) * tile_size, y_min + r * tile_size, y_min + (r + 1) * tile_size]
+        # the points of the tile first, then the others of the 3 * 3 tiles around it within 2 * eps
+        owned = order[offsets[tile]:offsets[tile + 1]]
+        around = np.concatenate([order[offsets[k]:offsets[k + 1]]
+                                 for k in (rr * num_x + cc for rr in range(max(r - 1, 0), min(r + 2, num_y))
+                                           for cc in range(max(c - 1, 0), min(c + 2, num_x)))
+                                 if k != tile] + [np.empty(0, dtype=np.int64)])
+        distance = _box_distance(xyz[around], box)
+        local = np.concatenate((owned, around[distance <= 2 * eps]))
+        known = np.concatenate((np.ones(len(owned), dtype=bool), distance[distance <= 2 * eps] <= eps))
+
+        i, j = neighbor_pairs(xyz[local], eps)
+        core = (np.bincount(i, minlength=len(local)) + 1 >= min_samples) & known
+        count('crowns.tile_pairs', len(i))
+
+        # connected components of the links between core points
+        linked = core[i] & core[j]
+        core_index = np.flatnonzero(core)
+        position = np.full(len(local), -1, dtype=np.int64)
+        position[core_index] = np.arange(len(core_index))
+        graph = coo_matrix((np.ones(np.count_nonzero(linked)), (position[i[linked]], position[j[linked]])),
+                           shape=(len(core_index), len(core_index)))
+        num_local, component = connected_components(graph, directed=False)
+        cluster = np.full(len(local), -1, dtype=np.int64)
+        cluster[core_index] = component + num_clusters
+        num_clusters += num_local
+
+        is_owned = np.arange(len(local)) < len(owned)
+        owner[local[core & is_owned]] = cluster[core & is_owned]
+        shared_point.append(local[core & ~is_owned])
+        shared_cluster.append(cluster[core & ~is_owned])
+        # the owned points that are not core points join the cluster of their first core neighbour
+        reach = is_owned[i] & ~core[i] & core[j]
+        first = np.flatnonzero(reach)[::-1]
+        border = np.full(len(local), -1, dtype=np.int64)
+        border[i[first]] = cluster[j[first]]
+        border_point.append(local[border >= 0])
+        border_cluster.append(border[border >= 0])
+    count('crowns.tiles', len(tiles))
+
+    # merge the clusters of the tiles through the shared core points
+    shared_point = np.concatenate(shared_point)
+    shared_cluster = np.concatenate(shared_cluster)
+    graph = coo_matrix((np.ones(len(shared_point)), (shared_cluster, owner[shared_point])),
+                       shape=(num_clusters, num_clusters))
+    _, merged = connected_components(graph, directed=False)
+    # number the clusters in the order of their first core point
+    is_core = owner >= 0
+    first = np.full(num_clusters, len(xyz), dtype=np.int64)
+    np.minimum.at(first, merged[owner[is_core]], np.flatnonzero(is_core))
+    used = np.flatnonzero(first < len(xyz))
+    rank = np.full(num_clusters, -1, dtype=np.int64)
+    rank[used[np.argsort(first[used], kind='stable')]] = np.arange(len(used))
+    labels[is_core] = rank[merged[owner[is_core]]]
+    border_point = np.concatenate(border_point)
+    labels[border_point] = rank[merged[np.concatenate(border_cluster)]]
+    return labels
+
+
+def _box_distance(xy, box):
+    # distance in x, y of every point to the box [min_x, max_x, min_y, max_y]
+    dx = np.maximum(np.maximum(box[0] - xy[:, 0], xy[:, 0] - box[1]), 0)
+    dy = np.maximum(np.maximum(box[2] - xy[:, 1], xy[:, 1] - box[3]), 0)
+    return np.hypot(dx, dy)
+
+
+def crown_statistics(xyz, labels, res=0.5, dtm_file=None):
+    '''
+        The statistics of every crown (cluster)
+
+        Input:
+            xyz: an array of points with x, y, z values
+            labels: the cluster of every point, -1 for noise points
+            res: cell size used for the crown area
+            dtm_file: optional DTM, the height of the crowns is then taken above the terrain
+
+        Output:
+            a dictionary with an array per statistic: cluster, point_count, x and y of the highest point,
+            z_max, height (z_max above the DTM, nan without DTM), area (area of the cells of res * res
+            with points of the crown)
+    '''
+    xyz = np.asarray(xyz, dtype=np.float64)
+    order, clusters, starts = sort_by_cell(labels)
+    z = xyz[order, 2]
+    point_count = np.diff(np.append(starts, len(order)))
+    z_max = group_reduce(np.maximum, z, starts)
+    top = order[group_argmin(labels[order], -z, labels.max() + 1 if len(labels) else 0)[clusters]]
+
+    # the crown area as the number of occupied cells
+    cell = np.floor(xyz[order, :2] / res).astype(np.int64)
+    cell_keys = np.lexsort((cell[:, 1], cell[:, 0], labels[order]))
+    sorted_cells = cell[cell_keys]
+    sorted_labels = labels[order][cell_keys]
+    distinct = np.ones(len(cell_keys), dtype=bool)
+    distinct[1:] = (sorted_labels[1:] != sorted_labels[:-1]) | np.any(sorted_cells[1:] != sorted_cells[:-1], axis=1)
+    area = np.bincount(sorted_labels[distinct], minlength=labels.max() + 1 if len(labels) else 0)[clusters] * res ** 2
+
+    height = np.full(len(clusters), np.nan)
+    if dtm_file is not None:
+        with rasterio.open(dtm_file) as dtm:
+            terrain = dtm.read(1)
+            rows, cols = rasterio.transform.rowcol(dtm.transform, xyz[top, 0], xyz[top, 1])
+            rows, cols = np.asarray(rows), np.asarray(cols)
+            inside = (rows >= 0) & (rows < dtm.height) & (cols >= 0) & (cols < dtm.width)
+            ground = np.full(len(clusters), np.nan)
+            ground[inside] = terrain[rows[inside], cols[inside]]
+            ground[ground == dtm.nodata] = np.nan
+            height = z_max - ground
+    return {'cluster': clusters, 'point_count': point_count, 'x': xyz[top, 0], 'y': xyz[top, 1],
+            'z_max': z_max, 'height': height, 'area': area}
+
+
+def write_statistics(statistics, output):
+    '''
+        Write the crown statistics as a csv file
+    '''
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    names = list(statistics)
+    table = np.column_stack([statistics[name] for name in names])
+    fmt = ['%d' if np.issubdtype(statistics[name].dtype, np.integer) else '%.3f' for name in names]
+    np.savetxt(output, table, fmt=fmt, delimiter=',', header=','.join(names), comments='')
+
+
+@staged('crowns')
+def segment_crowns(file_path='../data/processed/tile_500_filtered.laz', dtm_file=None, eps=0.5, min_samples=10,
+                   tile_size=50.0, res=0.5, output='../data/output/crowns.csv'):
+    '''
+        Segment the tree crowns of a tile: DBSCAN of the multi-return vegetation points (the
+        vegetation points of step4), tile by tile, and the statistics of every crown
+
+        Input:
+            file_path: the laz file (or PointStore directory)
+            dtm_file: optional DTM for the height of the crowns above the terrain
+            eps, min_samples: the parameters of DBSCAN
+            tile_size: size of the tiles DBSCAN works on
+            res: cell size used for the crown area
+            output: the csv file of the crown statistics
+
+        Output:
+            the points, their cluster (-1 for noise) and the crown statistics
+    '''
+    print("Crown segmentation starts")
+    with stage('read'):
+        data = read_points(file_path, ('x', 'y', 'z', 'number_of_returns'), classes=(1,))
+        multi_return = data['number_of_returns'] > 1
+        xyz = np.column_stack((data['x'][multi_return], data['y'][multi_return], data['z'][multi_return]))
+    with stage('dbscan'):
+        labels = dbscan(xyz, eps, min_samples, tile_size)
+    with stage('statistics'):
+        statistics = crown_statistics(xyz, labels, res, dtm_file)
+        write_statistics(statistics, output)
+    count('crowns.points', len(xyz))
+    count('crowns.noise', np.count_nonzero(labels < 0))
+    count('crowns.clusters', len(statistics['cluster']))
+    print(f"{len(statistics['cluster'])} crowns segmented")
+    return xyz, labels, statistics
+
+
+if __name__ == '__main__':
+    segment_crowns()
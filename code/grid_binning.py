@@ -0,0 +1,181 @@
+import numpy as np
+
+
+def cell_indices(x, y, x_min, y_min, cell_size, num_x, num_y):
+    """
+        Assign every point to the grid cell it falls in, in one pass over the arrays.
+        Cell (i, j) covers [x_min + i*cell_size, x_min + (i+1)*cell_size) in x
+        and [y_min + j*cell_size, y_min + (j+1)*cell_size) in y.
+
+        Input:
+            x, y: coordinate arrays of the points
+            x_min, y_min: lower-left corner of the grid
+            cell_size: size of one (square) cell
+            num_x, num_y: number of cells in x and y direction
+
+        Output:
+            column index, row index and a mask of the points that fall inside the grid
+    """
+    ix = np.floor((np.asarray(x) - x_min) / cell_size).astype(np.int64)
+    iy = np.floor((np.asarray(y) - y_min) / cell_size).astype(np.int64)
+    inside = (ix >= 0) & (ix < num_x) & (iy >= 0) & (iy < num_y)
+    return ix, iy, inside
+
+
+def group_argmin(cell_ids, values, num_cells):
+    """
+        Find, for every cell, the index of the point with the smallest value.
+        Ties are resolved in favour of the point that comes first in the input.
+
+        Input:
+            cell_ids: cell index of every point, negative for points outside the grid
+            values: value to minimise (e.g. z) of every point
+            num_cells: total number of cells
+
+        Output:
+            an array of length num_cells with the point index per cell, -1 for empty cells
+    """
+    valid = np.flatnonzero(cell_ids >= 0)
+    # lexsort is stable, so within a cell equal values keep their input order
+    order = valid[np.lexsort((values[valid], cell_ids[valid]))]
+    sorted_cells = cell_ids[order]
+
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_cells[1:] != sorted_cells[:-1]
+
+    result = np.full(num_cells, -1, dtype=np.int64)
+    result[sorted_cells[first]] = order[first]
+    return result
+
+
+def sort_by_cell(cell_ids):
+    """
+        Sort the points by their cell index so that every occupied cell becomes one
+        contiguous run, which can then be reduced with ufunc.reduceat.
+
+        Input:
+            cell_ids: cell index of every point, negative for points outside the grid
+
+        Output:
+            order: indices of the points inside the grid, sorted by cell
+            cells: the occupied cells, in increasing order
+            starts: the position in order where the run of each occupied cell starts
+    """
+    valid = np.flatnonzero(cell_ids >= 0)
+    order = valid[np.argsort(cell_ids[valid], kind='stable')]
+    sorted_cells = cell_ids[order]
+
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_cells[1:] != sorted_cells[:-1]
+    starts = np.flatnonzero(first)
+
+    return order, sorted_cells[starts], starts
+
+
+def group_reduce(ufunc, sorted_values, starts):
+    """
+        Reduce the values of every cell run with a numpy ufunc (np.add, np.maximum, ...)
+
+        Input:
+            ufunc: the reduction to apply
+            sorted_values: values already sorted by cell (values[order])
+            starts: start of the run of each occupied cell, from sort_by_cell
+
+        Output:
+            an array with one reduced value per occupied cell
+    """
+    if len(starts) == 0:
+        return np.empty(0, dtype=sorted_values.dtype)
+    return ufunc.reduceat(sorted_values, starts)
+
+
+def _spread_bits(v):
+    # insert a zero bit between every bit of the lower 32 bits of v
+    v = v & np.uint64(0x00000000FFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def _quantize(x, y, bbx, bits):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if bbx is None:
+        bbx = [x.min(), x.max(), y.min(), y.max()] if len(x) > 0 else [0.0, 1.0, 0.0, 1.0]
+    scale = (2 ** bits - 1) / max(bbx[1] - bbx[0], bbx[3] - bbx[2], 1e-9)
+    qx = np.clip((x - bbx[0]) * scale, 0, 2 ** bits - 1).astype(np.uint64)
+    qy = np.clip((y - bbx[2]) * scale, 0, 2 ** bits - 1).astype(np.uint64)
+    return qx, qy
+
+
+def morton_codes(x, y, bbx=None, bits=16):
+    """
+        Compute the Morton (Z-order) code of every point.
+
+        Input:
+            x, y: coordinate arrays of the points
+            bbx: [min_x, max_x, min_y, max_y] used to quantise the coordinates,
+                 the extent of the points if not given
+            bits: number of bits per axis (at most 32)
+
+        Output:
+            an uint64 array with the Morton code of every point
+    """
+    qx, qy = _quantize(x, y, bbx, bits)
+    return _spread_bits(qx) | (_spread_bits(qy) << np.uint64(1))
+
+
+def morton_order(x, y, bbx=None, bits=16):
+    """
+        The order that sorts the points along the Morton (Z-order) curve, so that points
+        that are consecutive in that order are close to each other in space.
+    """
+    return np.argsort(morton_codes(x, y, bbx, bits), kind='stable')
+
+
+def hilbert_codes(x, y, bbx=None, bits=16):
+    """
+        Compute the Hilbert curve index of every point. Unlike the Morton curve the
+        Hilbert curve has no jumps: consecutive codes are always neighbouring cells.
+
+        Input:
+            x, y: coordinate arrays of the points
+            bbx: [min_x, max_x, min_y, max_y] used to quantise the coordinates,
+                 the extent of the points if not given
+            bits: number of bits per axis (at most 32)
+
+        Output:
+            an uint64 array with the Hilbert index of every point
+    """
+    qx, qy = _quantize(x, y, bbx, bits)
+    qx = qx.astype(np.int64)
+    qy = qy.astype(np.int64)
+    last = 2 ** bits - 1
+    codes = np.zeros(len(qx), dtype=np.uint64)
+    for level in range(bits - 1, -1, -1):
+        s = 1 << level
+        rx = (qx & s) > 0
+        ry = (qy & s) > 0
+        codes += np.uint64(s * s) * ((3 * rx) ^ ry).astype(np.uint64)
+        # rotate the quadrant so that the curve continues in the right direction
+        flip = ~ry & rx
+        qx = np.where(flip, last - qx, qx)
+        qy = np.where(flip, last - qy, qy)
+        qx, qy = np.where(ry, qx, qy), np.where(ry, qy, qx)
+    return codes
+
+
+def space_filling_order(x, y, curve='morton', bbx=None, bits=16):
+    """
+        The order that sorts the points along a space filling curve, 'morton' or 'hilbert'
+    """
+    if curve == 'morton':
+        codes = morton_codes(x, y, bbx, bits)
+    elif curve == 'hilbert':
+        codes = hilbert_codes(x, y, bbx, bits)
+    else:
+        raise ValueError(f"unknown space filling curve: {curve}")
+    return np.argsort(codes, kind='stable')
@@ -0,0 +1,180 @@
+import contextlib
+import functools
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+
+
+class Report:
+    '''
+        Wall time, CPU time and peak resident size of the stages of a run, and domain counters.
+        Stages can be nested, a stage is recorded under the path of the stages it runs in
+        (e.g. laplace/interpolate), and the calls of a stage with the same path are summed.
+        The peak resident size of a stage is the highest one while the stage ran (on linux, where the
+        high-water mark of the process can be reset), elsewhere the peak of the process up to its end.
+        A report whose stages may overlap with those of another one (reset_rss False) does not reset
+        the high-water mark, its peaks are the ones of the process.
+    '''
+
+    def __init__(self, reset_rss=True):
+        self.reset_rss = reset_rss
+        self.stages = {}
+        self.counters = {}
+        self.stack = []
+        # the peak resident size of every open stage, up to the last reset of the high-water mark
+        self.peaks = []
+        # the peak resident size of the run (the high-water mark is reset by the stages)
+        self.max_rss = max_rss_mb()
+        self.created = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    def _fold_peak(self):
+        # the peak since the last reset belongs to every open stage
+        peak = max_rss_mb()
+        self.peaks = [max(open_peak, peak) for open_peak in self.peaks]
+        self.max_rss = max(self.max_rss, peak)
+        return peak
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self._fold_peak()
+        self.peaks.append(_rss_mb() if self.reset_rss and reset_max_rss() else max_rss_mb())
+        self.stack.append(name)
+        path = '/'.join(self.stack)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            self._fold_peak()
+            peak = self.peaks.pop()
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record = self.stages.setdefault(path, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'children_cpu': 0.0})
+            record['calls'] += 1
+            record['wall'] += time.perf_counter() - wall
+            record['cpu'] += time.process_time() - cpu
+            # the time of worker processes that finished during the stage
+            record['children_cpu'] += (after.ru_utime + after.ru_stime) - (children.ru_utime + children.ru_stime)
+            # the peak resident size of the stage, the highest one of its calls
+            record['max_rss_mb'] = max(record.get('max_rss_mb', 0.0), peak)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def to_dict(self, **meta):
+        self._fold_peak()
+        return {'created': self.created, 'host': platform.node(), 'python': platform.python_version(),
+                'argv': sys.argv, 'max_rss_mb': self.max_rss, **meta,
+                'stages': self.stages, 'counters': self.counters}
+
+    def write(self, file_path, **meta):
+        '''
+            Write the report as json, meta is added to it (e.g. the tile and the parameters)
+        '''
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(file_path, 'w') as f:
+            json.dump(self.to_dict(**meta), f, indent=2)
+        return file_path
+
+
+def _status_mb(field):
+    # a memory field of /proc/self/status in MB, None where there is no /proc
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return None
+
+
+def reset_max_rss():
+    '''
+        Reset the high-water mark of the resident size of the process to its current resident size,
+        returns False where it cannot be reset (no /proc/self/clear_refs)
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return _status_mb('VmHWM') is not None
+
+
+def _rss_mb():
+    rss = _status_mb('VmRSS')
+    return max_rss_mb() if rss is None else rss
+
+
+def max_rss_mb():
+    '''
+        The peak resident size of the process since the last reset_max_rss, or since it started
+    '''
+    peak = _status_mb('VmHWM')
+    if peak is not None:
+        return peak
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+# the report the stages of every thread record into: the one of the main thread is the report of the run,
+# a background thread (e.g. the prefetch of las_io) records into its own, so that its stages never nest
+# in the stages of the main thread that run at the same time, and it never resets the high-water mark
+_reports = threading.local()
+
+
+def stage(name):
+    '''
+        Context manager that records a stage in the current report
+    '''
+    return report().stage(name)
+
+
+def staged(name):
+    '''
+        Decorator that records every call of a function as a stage
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    '''
+        Add value to a counter of the current report
+    '''
+    report().count(name, value)
+
+
+def report():
+    '''
+        The current report of this thread
+    '''
+    if getattr(_reports, 'report', None) is None:
+        reset()
+    return _reports.report
+
+
+def reset():
+    '''
+        Start a new report of this thread, e.g. for the next tile
+    '''
+    _reports.report = Report(reset_rss=threading.current_thread() is threading.main_thread())
+    return _reports.report
+
+
+def write_report(file_path='../data/output/report.json', **meta):
+    return report().write(file_path, **meta)
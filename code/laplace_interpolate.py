@@ -1,8 +1,19 @@
+import json
+import os
+
 import startinpy
 import numpy as np
-import laspy
-from tqdm import tqdm
 import rasterio
+from tqdm import tqdm
+from scipy.spatial import ConvexHull, cKDTree
+from concurrent.futures import ProcessPoolExecutor
+from grid_binning import morton_order, sort_by_cell
+from las_io import read_header, read_xyz
+from instrument import stage, staged, count
+from checkpoint import Checkpoint, checkpoint_key
+from cell_index import CellIndex
+from triangle_grid import TriangleGrid
+from raster_io import header_transform, patch_raster, raster_profile, write_raster
 
 
 def read_laz_file(file_path):
@@ -15,9 +26,9 @@ def read_laz_file(file_path):
         Output:
             points array and header information
     '''
-    las = laspy.read(file_path)
-    header = las.header
-    points = np.vstack((las.x, las.y, las.z)).transpose()
+    header = read_header(file_path)
+    # read the coordinates chunk by chunk, without keeping the whole LasData in memory
+    points = read_xyz(file_path)
     return points,header
 
 
@@ -27,10 +38,11 @@ def generate_grid(bbx, cell_size=0.5):
         return the center of each cell in the grid, as well as number of rows and columns
 
         Input:
-            points: an array containing points with x, y, z values
+            bbx: the bounding box of the grid [min_x, max_x, min_y, max_y]
 
         Output:
-            a list containing centers of all cells [x, y], number of rows, number of columns
+            an array containing centers of all cells [x, y] row by row (from the top),
+            number of rows, number of columns
     '''
 
     # the bounding box
@@ -42,98 +54,922 @@ def generate_grid(bbx, cell_size=0.5):
     num_row = int((max_y - min_y) / cell_size)
     num_column = int((max_x - min_x) / cell_size)
 
-    cell_centers = []
-
     # Calculate centers of each cell
-    for i in range(0, num_row):
-        for j in range(0, num_column):
-            cell_center_x = min_x + cell_size/2 + j * cell_size
-            cell_center_y = max_y - cell_size/2 - i * cell_size
-            cell_centers.append([cell_center_x,cell_center_y])
+    cell_center_x = min_x + cell_size/2 + np.arange(num_column) * cell_size
+    cell_center_y = max_y - cell_size/2 - np.arange(num_row) * cell_size
+    cell_centers = np.column_stack((np.tile(cell_center_x, num_row), np.repeat(cell_center_y, num_column)))
 
     return cell_centers, num_row, num_column
 
 
-def laplace_interpolant(points, cell_centers, num_row, num_column):
+class LaplaceInterpolator:
+    '''
+        Laplace interpolation for many locations at once.
+
+        The Delaunay triangulation of the samples, the circumcircles of its triangles and a
+        KD-tree of the sample locations are computed once. For a batch of locations the
+        triangles whose circumcircle contains the location (the triangles that would be
+        destroyed by inserting it) are collected with a breadth-first search over the
+        triangle neighbours, starting from the triangles around the closest sample. The
+        boundary edges (a, b) of that region form the new triangles (c, a, b) around the
+        location c, so the Voronoi edge between c and a natural neighbour a is the segment
+        between the circumcenters of the two new triangles sharing a.
+        Nothing is inserted into or removed from the triangulation.
+        The samples and triangles can be saved to a .npz file and loaded again without
+        triangulating the samples (see save, load and for_file).
+    '''
+
+    def __init__(self, points, origin=None):
+        '''
+            Input:
+                points: an array of sample points with x, y, z values
+                origin: [x, y] the computations are done relative to,
+                        the lower-left corner of the samples if not given
+        '''
+        points = np.asarray(points, dtype=np.float64)
+        # keep the first sample of points sharing the same location, like startinpy does
+        first = np.lexsort((points[:, 1], points[:, 0]))
+        same = np.all(points[first[1:], :2] == points[first[:-1], :2], axis=1)
+        self.points = points[np.sort(first[np.append(True, ~same)])]
+        # work relative to the lower-left corner to keep the circumcenter math accurate
+        self.origin = self.points[:, :2].min(axis=0) if origin is None else np.asarray(origin, dtype=np.float64)
+        self.xy = self.points[:, :2] - self.origin
+
+        # inserting the samples along the Morton curve keeps the walks of startinpy short
+        order = morton_order(self.points[:, 0], self.points[:, 1])
+        dt = startinpy.DT()
+        dt.insert(self.points[order])
+        if dt.number_of_vertices() == len(order):
+            # vertex i of the DT (0 is the infinite vertex) is the sample order[i - 1]
+            vertex_index = np.append(-1, order)
+        else:
+            # samples closer than the snap tolerance have been merged, keep the vertices of the DT
+            self.points = dt.points[1:]
+            self.xy = self.points[:, :2] - self.origin
+            vertex_index = np.arange(-1, len(self.points))
+        triangles = vertex_index[dt.triangles.astype(np.int64)]
+        self._set_triangles(triangles)
+
+        self.kdtree = cKDTree(self.xy)
+
+    def save(self, file_path, **meta):
+        '''
+            Save the samples, the triangles and the convex hull as an uncompressed .npz file,
+            meta (e.g. the size and modification time of the laz file) is saved with them.
+            The file is written under a temporary name first, that is then renamed.
+        '''
+        index_type = np.int32 if len(self.points) < 2 ** 31 else np.int64
+        partial = f"{file_path}.partial"
+        with open(partial, 'wb') as f:
+            np.savez(f, points=self.points, triangles=self.triangles.astype(index_type),
+                     hull=self.hull.astype(index_type), meta=json.dumps(meta))
+        os.replace(partial, file_path)
+
+    @classmethod
+    def load(cls, file_path, origin=None):
+        '''
+            Load an interpolator saved with save, the triangle neighbours, circumcircles and the
+            KD-tree are computed again but the samples are not triangulated
+
+            Input:
+                file_path: the .npz file
+                origin: [x, y] the computations are done relative to, like for __init__
+        '''
+        with np.load(file_path) as data:
+            points, triangles, hull = data['points'], data['triangles'], data['hull']
+        interpolator = cls.__new__(cls)
+        interpolator.points = points
+        interpolator.origin = points[:, :2].min(axis=0) if origin is None else np.asarray(origin, dtype=np.float64)
+        interpolator.xy = points[:, :2] - interpolator.origin
+        interpolator._set_triangles(triangles.astype(np.int64), hull.astype(np.int64))
+        interpolator.kdtree = cKDTree(interpolator.xy)
+        return interpolator
+
+    @classmethod
+    def for_file(cls, file_path, origin=None):
+        '''
+            The interpolator of the points of a laz file. Its TIN is saved next to the file
+            (see tin_file) and loaded by later runs, until the laz file changes.
+        '''
+        path = tin_file(file_path)
+        stat = os.stat(file_path)
+        meta = {'file_size': stat.st_size, 'file_mtime_ns': stat.st_mtime_ns}
+        if os.path.exists(path):
+            with np.load(path) as data:
+                saved = json.loads(str(data['meta']))
+            if all(saved.get(key) == value for key, value in meta.items()):
+                with stage('tin_load'):
+                    return cls.load(path, origin)
+        with stage('tin_build'):
+            interpolator = cls(read_xyz(file_path), origin)
+        interpolator.save(path, **meta)
+        return interpolator
+
+    def set_origin(self, origin):
+        '''
+            Do the computations relative to another origin, e.g. the grid of another resolution
+        '''
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.xy = self.points[:, :2] - self.origin
+        self._set_circumcircles()
+        self.kdtree = cKDTree(self.xy)
+
+    def _set_triangles(self, triangles, hull=None):
+        # the boundary edges of the (counter-clockwise) triangles, in counter-clockwise order
+        self.hull = _convex_hull(triangles) if hull is None else hull
+
+        # sort the vertices of every triangle, so that every computation sees them in the same order
+        self.triangles = np.sort(triangles, axis=1)
+        self.neighbors = _triangle_neighbors(self.triangles)
+
+        # triangles incident to each vertex, in compressed sparse row form
+        incident = np.argsort(self.triangles.ravel(), kind='stable')
+        self.incident_triangles = incident // 3
+        self.incident_offsets = np.searchsorted(self.triangles.ravel()[incident], np.arange(len(self.xy) + 1))
+        self._set_circumcircles()
+
+    def _set_circumcircles(self):
+        a = self.xy[self.triangles[:, 0]].T
+        b = self.xy[self.triangles[:, 1]].T
+        c = self.xy[self.triangles[:, 2]].T
+        self.circumcenters = np.column_stack(calculate_circumcenter(a, b, c))
+        self.circumradii2 = np.sum((self.circumcenters - self.xy[self.triangles[:, 0]]) ** 2, axis=1)
+
+    def interpolate(self, locations, nodata=-9999, reach=False):
+        '''
+            Input:
+                locations: an array of [x, y] locations
+                reach: also return the reach of each location
+
+            Output:
+                an array with the interpolated value of each location,
+                nodata for locations outside the convex hull of the samples.
+                With reach=True also an array with, for each location, the bounding box
+                [min_x, max_x, min_y, max_y] of the circumcircles of the triangles around the
+                location after its insertion (infinite for locations outside the convex hull
+                or in degenerate configurations). When the samples are the subset of a larger
+                sample set inside a region that contains this box, those circumcircles are
+                empty in the larger set too, so the value is the same as with all samples.
+        '''
+        q = np.asarray(locations, dtype=np.float64)[:, :2] - self.origin
+        values = np.full(len(q), nodata, dtype=np.float64)
+        extent = np.tile([-np.inf, np.inf, -np.inf, np.inf], (len(q), 1))
+
+        # if the location is one of the sample points, take the value of that sample
+        distance, nearest = self.kdtree.query(q)
+        exact = distance == 0
+        values[exact] = self.points[nearest[exact], 2]
+        extent[exact] = np.repeat(q[exact], 2, axis=1)
+
+        # locations outside the convex hull can not be interpolated
+        todo = np.flatnonzero(~exact)
+        todo = todo[self.is_inside_convex_hull(q[todo])]
+        count('laplace.exact_hits', np.count_nonzero(exact))
+        count('laplace.outside_hull', len(q) - np.count_nonzero(exact) - len(todo))
+        count('laplace.interpolated', len(todo))
+        if len(todo) > 0:
+            values[todo], extent[todo] = self._laplace(q[todo], nearest[todo])
+        if not reach:
+            return values
+        return values, extent + np.repeat(self.origin, 2)
+
+    def is_inside_convex_hull(self, q):
+        '''
+            Test for many (origin relative) locations whether they are inside the convex hull
+            or on its boundary.
+        '''
+        return _inside_convex_polygon(self.xy[self.hull], q)
+
+    def _cavity(self, q, nearest, tolerance=0.0):
+        '''
+            Find for every location the triangles whose circumcircle contains it
+            (or passes within a relative tolerance of it).
+            Returns the sorted keys location * number_of_triangles + triangle.
+        '''
+        num_triangles = len(self.triangles)
+        # the closest sample is always a natural neighbour, start from its triangles
+        start = self.incident_offsets[nearest]
+        num_incident = self.incident_offsets[nearest + 1] - start
+        next_q = np.repeat(np.arange(len(q)), num_incident)
+        first = np.repeat(start - np.cumsum(num_incident) + num_incident, num_incident)
+        next_t = self.incident_triangles[first + np.arange(num_incident.sum())]
+        keys = np.empty(0, dtype=np.int64)
+        while len(next_q) > 0:
+            inside = np.sum((q[next_q] - self.circumcenters[next_t]) ** 2, axis=1) < \
+                     self.circumradii2[next_t] * (1 + tolerance)
+            next_keys = _unique(next_q[inside] * num_triangles + next_t[inside])
+            next_keys = next_keys[~_contains(keys, next_keys)]
+            keys = np.sort(np.concatenate((keys, next_keys)))
+            # candidates: the neighbours of the triangles added in this round
+            frontier_q, frontier_t = np.divmod(next_keys, num_triangles)
+            next_q = np.repeat(frontier_q, 3)
+            next_t = self.neighbors[frontier_t].ravel()
+            valid = next_t >= 0
+            next_q, next_t = next_q[valid], next_t[valid]
+        return keys
+
+    def _laplace(self, q, nearest):
+        '''
+            Laplace interpolation of the (origin relative) locations q,
+            which are inside the convex hull and not on a sample.
+            Returns the values and their reach (see interpolate).
+        '''
+        num_triangles = len(self.triangles)
+        num_points = len(self.xy)
+        cavity_keys = self._cavity(q, nearest)
+        cavity_q, cavity_t = np.divmod(cavity_keys, num_triangles)
+
+        # boundary edges of the cavity: edges whose neighbouring triangle is not in the cavity
+        edge_q, edge_a, edge_b = [], [], []
+        for k, (i, j) in enumerate(((1, 2), (0, 2), (0, 1))):
+            opposite = self.neighbors[cavity_t, k]
+            outer = opposite < 0
+            outer[~outer] = ~_contains(cavity_keys, cavity_q[~outer] * num_triangles + opposite[~outer])
+            edge_q.append(cavity_q[outer])
+            edge_a.append(self.triangles[cavity_t[outer], i])
+            edge_b.append(self.triangles[cavity_t[outer], j])
+        edge_q = np.concatenate(edge_q)
+        edge_a = np.concatenate(edge_a)
+        edge_b = np.concatenate(edge_b)
+
+        # circumcenters of the new triangles (c, a, b) are the Voronoi vertices around c
+        with np.errstate(invalid='ignore', divide='ignore'):
+            center = np.column_stack(calculate_circumcenter(q[edge_q].T, self.xy[edge_a].T, self.xy[edge_b].T))
+
+        # every natural neighbour p is shared by two new triangles, pair their circumcenters
+        pair_q = np.concatenate((edge_q, edge_q))
+        pair_p = np.concatenate((edge_a, edge_b))
+        pair_keys = pair_q * num_points + pair_p
+        order = np.argsort(pair_keys, kind='stable')
+        pair_keys = pair_keys[order]
+        pair_q, pair_p = pair_q[order], pair_p[order]
+        pair_center = np.concatenate((center, center))[order]
+
+        # a location whose neighbours do not come in pairs hit a degenerate configuration
+        run_start = np.flatnonzero(np.append(True, pair_keys[1:] != pair_keys[:-1]))
+        run_length = np.diff(np.append(run_start, len(pair_keys)))
+        degenerate = np.ones(len(q), dtype=bool)
+        degenerate[edge_q] = False
+        degenerate[pair_q[run_start[run_length != 2]]] = True
+        keep = ~degenerate[pair_q]
+        pair_q, pair_p, pair_center = pair_q[keep], pair_p[keep], pair_center[keep]
+
+        q_index = pair_q[0::2]
+        p_index = pair_p[0::2]
+        # length of the Voronoi edge between c and p divided by the distance between c and p
+        distance_voronoi_centers = np.hypot(pair_center[0::2, 0] - pair_center[1::2, 0],
+                                            pair_center[0::2, 1] - pair_center[1::2, 1])
+        distance_p_c = np.hypot(self.xy[p_index, 0] - q[q_index, 0], self.xy[p_index, 1] - q[q_index, 1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = distance_voronoi_centers / distance_p_c
+            sum_of_weights = np.bincount(q_index, weights=weight, minlength=len(q))
+            sum_of_products = np.bincount(q_index, weights=weight * self.points[p_index, 2], minlength=len(q))
+            values = sum_of_products / sum_of_weights
+
+        # fall back to linear interpolation in the triangle for the degenerate cases,
+        # e.g. a location exactly on the convex hull
+        fallback = degenerate | ~np.isfinite(values)
+        if np.any(fallback):
+            # the triangle containing the location is one of its cavity triangles
+            candidates = fallback[cavity_q]
+            values[fallback] = self._linear(q, cavity_q[candidates], cavity_t[candidates])[fallback]
+
+        # bounding box of the circumcircles of the new triangles
+        radius = np.hypot(center[:, 0] - q[edge_q, 0], center[:, 1] - q[edge_q, 1])
+        extent = np.repeat(q, 2, axis=1)
+        with np.errstate(invalid='ignore'):
+            np.minimum.at(extent[:, 0], edge_q, center[:, 0] - radius)
+            np.maximum.at(extent[:, 1], edge_q, center[:, 0] + radius)
+            np.minimum.at(extent[:, 2], edge_q, center[:, 1] - radius)
+            np.maximum.at(extent[:, 3], edge_q, center[:, 1] + radius)
+        extent[fallback | np.isnan(extent).any(axis=1)] = [-np.inf, np.inf, -np.inf, np.inf]
+        return values, extent
+
+    def _linear(self, q, pair_q, pair_t):
+        '''
+            Linear interpolation in the triangle containing each location, chosen from the
+            candidate (location, triangle) pairs as the one with the largest smallest
+            barycentric coordinate.
+        '''
+        bary = _barycentric(self.xy[self.triangles[pair_t]], q[pair_q])
+        best = np.full(len(q), -np.inf)
+        np.maximum.at(best, pair_q, bary.min(axis=1))
+        chosen = bary.min(axis=1) == best[pair_q]
+        values = np.full(len(q), np.nan)
+        values[pair_q[chosen]] = np.sum(bary[chosen] * self.points[self.triangles[pair_t[chosen]], 2], axis=1)
+        return values
+
+
+def tin_file(file_path):
+    '''
+        The file next to the laz file where the TIN of its points is saved
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(file_path)), f"{os.path.basename(file_path)}.tin.npz")
+
+
+def _unique(keys):
+    keys = np.sort(keys)
+    return keys[np.append(True, keys[1:] != keys[:-1])] if len(keys) > 0 else keys
+
+
+def _contains(sorted_keys, keys):
+    # membership test of keys in an array of sorted keys
+    i = np.searchsorted(sorted_keys, keys)
+    found = i < len(sorted_keys)
+    found[found] = sorted_keys[i[found]] == keys[found]
+    return found
+
+
+def _inside_convex_polygon(polygon, q):
+    '''
+        Test for many locations whether they are inside a convex (counter-clockwise) polygon
+        or on its boundary, with a binary search over the fan of triangles around the first
+        polygon vertex.
+    '''
+    p0 = polygon[0]
+    d = q - p0
+    edge = polygon[1:] - p0
+
+    def cross(u, v):
+        return u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+
+    inside = (cross(edge[0], d) >= 0) & (cross(edge[-1], d) <= 0)
+    # find the last fan edge i for which the location is on its left
+    low = np.zeros(len(q), dtype=np.int64)
+    high = np.full(len(q), len(edge) - 1, dtype=np.int64)
+    while np.any(low < high):
+        middle = (low + high + 1) // 2
+        left = cross(edge[middle], d) >= 0
+        low = np.where(left, middle, low)
+        high = np.where(left, high, middle - 1)
+    i = np.minimum(low, len(edge) - 2)
+    inside &= cross(polygon[i + 2] - polygon[i + 1], q - polygon[i + 1]) >= 0
+    return inside
+
+
+def _barycentric(triangle_xy, q):
+    # barycentric coordinates of the locations q in the triangles (n, 3, 2)
+    a, b, c = triangle_xy[:, 0], triangle_xy[:, 1], triangle_xy[:, 2]
+    det = (b[:, 1] - c[:, 1]) * (a[:, 0] - c[:, 0]) + (c[:, 0] - b[:, 0]) * (a[:, 1] - c[:, 1])
+    l1 = ((b[:, 1] - c[:, 1]) * (q[:, 0] - c[:, 0]) + (c[:, 0] - b[:, 0]) * (q[:, 1] - c[:, 1])) / det
+    l2 = ((c[:, 1] - a[:, 1]) * (q[:, 0] - c[:, 0]) + (a[:, 0] - c[:, 0]) * (q[:, 1] - c[:, 1])) / det
+    return np.column_stack((l1, l2, 1 - l1 - l2))
+
+
+def _triangle_neighbors(triangles):
+    '''
+        For every triangle the neighbouring triangle opposite to each of its vertices,
+        -1 for edges on the convex hull.
+    '''
+    num_points = triangles.max() + 1 if len(triangles) > 0 else 0
+    # edge opposite vertex k, as the key min * n + max of its two vertices
+    u = triangles[:, [1, 0, 0]]
+    v = triangles[:, [2, 2, 1]]
+    keys = (np.minimum(u, v) * num_points + np.maximum(u, v)).ravel()
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    shared = np.flatnonzero(keys[1:] == keys[:-1])
+    neighbors = np.full(keys.shape, -1, dtype=np.int64)
+    neighbors[order[shared]] = order[shared + 1] // 3
+    neighbors[order[shared + 1]] = order[shared] // 3
+    return neighbors.reshape(-1, 3)
+
+
+def _convex_hull(triangles):
+    '''
+        The vertices of the convex hull in counter-clockwise order,
+        from the edges that belong to only one (counter-clockwise) triangle.
+    '''
+    start = triangles.ravel()
+    end = triangles[:, [1, 2, 0]].ravel()
+    # an interior edge is used once in each direction
+    num_points = triangles.max() + 1
+    forward = start * num_points + end
+    backward = end * num_points + start
+    boundary = ~_contains(np.sort(backward), forward)
+    following = dict(zip(start[boundary].tolist(), end[boundary].tolist()))
+    hull = [next(iter(following))]
+    while len(hull) < len(following):
+        hull.append(following[hull[-1]])
+    return np.array(hull, dtype=np.int64)
+
+
+def laplace_interpolant(points, cell_centers, num_row, num_column, batch_size=100000, interpolator=None,
+                        checkpoint=None, checkpoint_interval=60.0):
     '''
         Perform Laplace interpolation method for a grid(interpolate at the center of each cell)
 
         Input:
-            points: a list of points with x, y, z values
-            cell_centers: list of center of each cell of a grid to be interpolated
+            points: an array of points with x, y, z values
+            cell_centers: array of center of each cell of a grid to be interpolated
+            batch_size: number of cells interpolated at once
+            interpolator: the LaplaceInterpolator of the points, e.g. loaded with for_file,
+                          it is built from points if not given
+            checkpoint: a .npz file where the completed rows of cells are saved every
+                        checkpoint_interval seconds, a run with the same points and cells
+                        continues after them (the file is removed at the end)
 
         Output:
-            an array containing the interpolation values for each cell
+            an array containing the interpolation values for each cell,
+            -9999 for cells outside the convex hull of the points
     '''
 
+    cell_centers = np.asarray(cell_centers, dtype=np.float64)
+
     # generate a TIN based on the input points
-    dt = startinpy.DT()
-    dt.insert(points)
+    if interpolator is None:
+        with stage('tin_build'):
+            interpolator = LaplaceInterpolator(points, origin=np.min(cell_centers, axis=0))
+    else:
+        interpolator.set_origin(np.min(cell_centers, axis=0))
 
-    cell_values = []
+    cell_values = np.empty(len(cell_centers))
+    first = 0
+    if checkpoint is not None:
+        # batches of whole rows, the checkpoint holds the values of the first rows of the grid
+        batch_size = max(batch_size // num_column, 1) * num_column
+        checkpoint = Checkpoint(checkpoint, checkpoint_key(interpolator.points, cell_centers, num_column=num_column),
+                                checkpoint_interval)
+        state = checkpoint.load()
+        if state is not None:
+            first = len(state['values'])
+            cell_values[:first] = state['values']
+            print(f"resuming after row {first // num_column} from {checkpoint.file_path}")
 
-    points_xy = [[x,y] for x,y,z in points]
+    with stage('cells'):
+        for start in tqdm(range(first, len(cell_centers), batch_size)):
+            end = start + batch_size
+            cell_values[start:end] = interpolator.interpolate(cell_centers[start:end])
+            if checkpoint is not None and end < len(cell_centers):
+                checkpoint.save_due(values=cell_values[:end])
+    if checkpoint is not None:
+        checkpoint.remove()
 
-    for c in tqdm(cell_centers):
-        # if the cell center is on the location of one of the sample points
-        if c in points_xy:
-            # find the closest point(it should be that exact sample point)
-            closet_point_index = dt.closest_point(c[0],c[1])
-            cell_values.append(dt.get_point(closet_point_index)[2])
+    # reshape the array into the shape of num_row rows and num_column columns
+    cell_values = np.reshape(cell_values,(num_row, num_column))
 
-        else:
-            # insert the center point into the TIN
-            if dt.is_inside_convex_hull(c[0], c[1]):
-                index_c = dt.insert_one_pt(c[0], c[1], 0.0)
+    return cell_values
+
+
+def laplace_interpolant_parallel(points, cell_centers, num_row, num_column, workers=None, tile_size=256, halo=20.0,
+                                 cell_index=None):
+    '''
+        Perform Laplace interpolation method for a grid with several worker processes.
+        The grid is split into tiles of tile_size * tile_size cells, and every worker builds a
+        TIN from only the points in its tile plus a halo around it. Cells whose natural
+        neighbours might lie outside the halo (see LaplaceInterpolator.interpolate) are
+        interpolated again with a larger halo, so the result is exactly the same as the one
+        of laplace_interpolant.
+
+        Input:
+            points: an array of points with x, y, z values
+            cell_centers: array of center of each cell of a grid to be interpolated (row by row)
+            workers: number of worker processes, the number of CPUs if not given
+            tile_size: number of rows and columns of cells in one tile
+            halo: initial width of the overlap around each tile
+            cell_index: a CellIndex of the points, used to find the points around a tile
+                        without testing every point (built here if not given)
 
-                # find the adjacent vertices to the point c
-                adjacent_vertices = dt.adjacent_vertices_to_vertex(index_c)
+        Output:
+            an array containing the interpolation values for each cell,
+            -9999 for cells outside the convex hull of the points
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    cell_centers = np.asarray(cell_centers, dtype=np.float64)
+    origin = np.min(cell_centers, axis=0)
 
-                # find incident triangles to the point c
-                incident_triangles = dt.incident_triangles_to_vertex(index_c)
+    # cells outside the convex hull of all points keep the nodata value
+    inside_hull = _inside_hull(points, cell_centers, origin)
+    cell_values = np.full(len(cell_centers), -9999.0)
+    if cell_index is None:
+        extent = np.ptp(points[:, :2], axis=0)
+        cell_size = max(np.sqrt(extent[0] * extent[1] / 4096), 1e-6)
+        shape = (int(extent[1] // cell_size) + 1, int(extent[0] // cell_size) + 1)
+        cell_index = CellIndex.build({'x': points[:, 0], 'y': points[:, 1]}, cell_size, points[:, :2].min(axis=0), shape)
+    # the workers record in their own processes, count the cells from their results here
+    count('laplace.outside_hull', len(cell_centers) - np.count_nonzero(inside_hull))
 
-                weights_pvalues = []
+    todo = []
+    grid_cells = np.arange(len(cell_centers)).reshape(num_row, num_column)
+    for r in range(0, num_row, tile_size):
+        for c in range(0, num_column, tile_size):
+            cells = grid_cells[r:r + tile_size, c:c + tile_size].ravel()
+            cells = cells[inside_hull[cells]]
+            if len(cells) > 0:
+                centers = cell_centers[cells]
+                region = np.array([centers[:, 0].min() - halo, centers[:, 0].max() + halo,
+                                   centers[:, 1].min() - halo, centers[:, 1].max() + halo])
+                todo.append((cells, region, halo))
 
-                for index_p in adjacent_vertices:
-                    coordinates_p = dt.get_point(index_p)
-                    # for each adjacent vertex pi, calculate the distance between pi and c
-                    distance_p_c = np.sqrt((coordinates_p[0] - c[0]) ** 2 + (coordinates_p[1] - c[1]) ** 2)
+    with ProcessPoolExecutor(workers) as executor:
+        while len(todo) > 0:
+            jobs = []
+            full = []
+            for cells, region, tile_halo in todo:
+                # the points in the region, in the order of points (the first of duplicate samples is kept)
+                in_region = np.sort(cell_index.order[cell_index.points_in_bbox(region)[1]])
+                if len(in_region) == len(points):
+                    # with all the points in the halo the result is the one of the full TIN,
+                    # do the remaining cells of all such tiles in one job
+                    full.append(cells)
+                else:
+                    job = executor.submit(_interpolate_tile, points[in_region], cell_centers[cells], origin)
+                    jobs.append((cells, region, tile_halo, job))
+            if len(full) > 0:
+                cells = np.concatenate(full)
+                job = executor.submit(_interpolate_tile, points, cell_centers[cells], origin)
+                jobs.append((cells, None, None, job))
 
-                    voronoi_centers_xp = []
+            todo = []
+            for cells, region, tile_halo, job in tqdm(jobs):
+                values, reach = job.result()
+                if region is None:
+                    done = np.ones(len(cells), dtype=bool)
+                else:
+                    done = ((reach[:, 0] >= region[0]) & (reach[:, 1] <= region[1]) &
+                            (reach[:, 2] >= region[2]) & (reach[:, 3] <= region[3]))
+                cell_values[cells[done]] = values[done]
+                # the reach of an exact hit is the location itself
+                exact = (reach[done, 0] == reach[done, 1]) & (reach[done, 2] == reach[done, 3])
+                count('laplace.exact_hits', np.count_nonzero(exact))
+                count('laplace.interpolated', np.count_nonzero(values[done] != -9999) - np.count_nonzero(exact))
+                count('laplace.tile_jobs')
+                if region is None:
+                    continue
+                if not np.all(done):
+                    # grow the halo to at least the reach of the remaining cells
+                    reach = reach[~done]
+                    region = np.array([min(region[0] - tile_halo, reach[:, 0].min()),
+                                       max(region[1] + tile_halo, reach[:, 1].max()),
+                                       min(region[2] - tile_halo, reach[:, 2].min()),
+                                       max(region[3] + tile_halo, reach[:, 3].max())])
+                    todo.append((cells[~done], region, tile_halo * 2))
 
-                    for tr in incident_triangles:
-                        if index_p in tr:
-                            # calculate the circumcenter of this triangle
-                            circumcenter = calculate_circumcenter(dt.get_point(tr[0]), dt.get_point(tr[1]), dt.get_point(tr[2]))
-                            voronoi_centers_xp.append(circumcenter)
+    # reshape the array into the shape of num_row rows and num_column columns
+    cell_values = np.reshape(cell_values,(num_row, num_column))
 
-                    distance_voronoi_centers = np.sqrt((voronoi_centers_xp[0][0] - voronoi_centers_xp[1][0]) ** 2 + (voronoi_centers_xp[0][1] - voronoi_centers_xp[1][1]) ** 2)
+    return cell_values
 
-                    weight_pi = distance_voronoi_centers / distance_p_c
 
-                    weights_pvalues.append([weight_pi, coordinates_p[2]])
+def _interpolate_tile(points, cell_centers, origin):
+    # worker of laplace_interpolant_parallel
+    if len(points) < 3:
+        reach = np.tile([-np.inf, np.inf, -np.inf, np.inf], (len(cell_centers), 1))
+        return np.full(len(cell_centers), -9999.0), reach
+    interpolator = LaplaceInterpolator(points, origin=origin)
+    return interpolator.interpolate(cell_centers, reach=True)
 
-            sum_of_weights = sum(row[0] for row in weights_pvalues)
-            products = [row[0] * row[1] for row in weights_pvalues]
-            sum_of_products = sum(products)
 
-            c_zvalue = sum_of_products / sum_of_weights
+def _inside_hull(points, cell_centers, origin):
+    # which cell centers are inside the convex hull of the points (or on its boundary)
+    hull = points[ConvexHull(points[:, :2]).vertices, :2]
+    return _inside_convex_polygon(hull - origin, cell_centers - origin)
 
-            cell_values.append(c_zvalue)
 
-            dt.remove(index_c)
+def linear_interpolant(points, cell_centers, num_row, num_column):
+    '''
+        Linear interpolation in the triangles of the TIN of the points for a grid
+        (interpolate at the center of each cell), all cell centers are located in the TIN at once
 
-    # transform list into numpy array
-    cell_values = np.array(cell_values)
-    # reshape the array into the shape of num_row rows and num_column columns
-    cell_values = np.reshape(cell_values,(num_row, num_column))
+        Input:
+            points: an array of points with x, y, z values
+            cell_centers: array of center of each cell of a grid to be interpolated
+
+        Output:
+            an array containing the interpolation values for each cell,
+            -9999 for cells outside the convex hull of the points
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    cell_centers = np.asarray(cell_centers, dtype=np.float64)
+    origin = np.min(cell_centers, axis=0)
+
+    with stage('tin_build'):
+        dt = startinpy.DT()
+        dt.insert(points[morton_order(points[:, 0], points[:, 1])])
+        # vertex 0 of the DT is the infinite vertex, no triangle uses it
+        vertices = dt.points
+        triangles = dt.triangles.astype(np.int64)
+        xy = vertices[:, :2] - origin
+
+    with stage('cells'):
+        q = cell_centers - origin
+        located = TriangleGrid(xy, triangles).locate(q)
+        inside = np.flatnonzero(located >= 0)
+        corners = triangles[located[inside]]
+        cell_values = np.full(len(cell_centers), -9999.0)
+        cell_values[inside] = np.sum(_barycentric(xy[corners], q[inside]) * vertices[corners, 2], axis=1)
+    count('linear.outside_hull', len(cell_centers) - len(inside))
+
+    return np.reshape(cell_values, (num_row, num_column))
 
-    return cell_values
+
+def idw_interpolant(points, cell_centers, num_row, num_column, power=2.0, k=12, radius=np.inf, workers=1,
+                    batch_size=100000):
+    '''
+        Inverse distance weighting of the k closest points within radius of each cell center,
+        found with a KD-tree
+
+        Input:
+            points: an array of points with x, y, z values
+            cell_centers: array of center of each cell of a grid to be interpolated
+            power: power of the inverse distance
+            k: maximum number of points used for one cell
+            radius: maximum distance of the points used
+            workers: number of threads of the KD-tree queries
+            batch_size: number of cells interpolated at once
+
+        Output:
+            an array containing the interpolation values for each cell,
+            -9999 for cells outside the convex hull of the points or without points within radius
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    cell_centers = np.asarray(cell_centers, dtype=np.float64)
+    origin = np.min(cell_centers, axis=0)
+    with stage('tin_build'):
+        kdtree = cKDTree(points[:, :2] - origin)
+    # a missing neighbour has the index len(points), give it a weight of 0
+    z = np.append(points[:, 2], 0.0)
+
+    cell_values = np.full(len(cell_centers), -9999.0)
+    with stage('cells'):
+        inside = np.flatnonzero(_inside_hull(points, cell_centers, origin))
+        for start in tqdm(range(0, len(inside), batch_size)):
+            cells = inside[start:start + batch_size]
+            distance, index = kdtree.query(cell_centers[cells] - origin, k=k, distance_upper_bound=radius,
+                                           workers=workers)
+            distance = distance.reshape(len(cells), -1)
+            index = index.reshape(len(cells), -1)
+            with np.errstate(divide='ignore'):
+                weight = np.where(np.isfinite(distance), distance ** -power, 0.0)
+            found = np.isfinite(distance[:, 0])
+            exact = distance[:, 0] == 0
+            weighted = found & ~exact
+            values = np.full(len(cells), -9999.0)
+            # the value of the sample at the cell center
+            values[exact] = z[index[exact, 0]]
+            values[weighted] = np.sum(weight[weighted] * z[index[weighted]], axis=1) / np.sum(weight[weighted], axis=1)
+            cell_values[cells] = values
+            count('idw.no_points', len(cells) - np.count_nonzero(found))
+    count('idw.outside_hull', len(cell_centers) - len(inside))
+
+    return np.reshape(cell_values, (num_row, num_column))
+
+
+def nearest_interpolant(points, cell_centers, num_row, num_column, radius=np.inf, workers=1):
+    '''
+        The value of the closest point of each cell center, found with a KD-tree
+
+        Input:
+            points: an array of points with x, y, z values
+            cell_centers: array of center of each cell of a grid to be interpolated
+            radius: maximum distance of the closest point
+            workers: number of threads of the KD-tree queries
+
+        Output:
+            an array containing the interpolation values for each cell,
+            -9999 for cells outside the convex hull of the points or without a point within radius
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    cell_centers = np.asarray(cell_centers, dtype=np.float64)
+    origin = np.min(cell_centers, axis=0)
+    with stage('tin_build'):
+        kdtree = cKDTree(points[:, :2] - origin)
+    # a missing neighbour has the index len(points)
+    z = np.append(points[:, 2], -9999.0)
+
+    cell_values = np.full(len(cell_centers), -9999.0)
+    with stage('cells'):
+        inside = np.flatnonzero(_inside_hull(points, cell_centers, origin))
+        _, index = kdtree.query(cell_centers[inside] - origin, distance_upper_bound=radius, workers=workers)
+        cell_values[inside] = z[index]
+    count('nearest.outside_hull', len(cell_centers) - len(inside))
+
+    return np.reshape(cell_values, (num_row, num_column))
+
+
+# the interpolation methods of laplace(), besides laplace_interpolant they are meant for previews
+# and coarse products
+INTERPOLANTS = {'laplace': laplace_interpolant, 'linear': linear_interpolant, 'idw': idw_interpolant,
+                'nearest': nearest_interpolant}
+
+
+def ground_changes(old_points, new_points):
+    '''
+        The differences between two sets of ground points, e.g. the ground points found by GFTIN
+        with two different thresholds
+
+        Input:
+            old_points, new_points: arrays of points with x, y, z values
+
+        Output:
+            an array of the points of new_points that are not in old_points,
+            the indices of the points of old_points that are not in new_points
+    '''
+    old_keys = _row_keys(old_points)
+    new_keys = _row_keys(new_points)
+    added = np.asarray(new_points, dtype=np.float64)[~_contains(np.sort(old_keys), new_keys), :3]
+    removed = np.flatnonzero(~_contains(np.sort(new_keys), old_keys))
+    return added, removed
+
+
+def _row_keys(points):
+    # every x, y, z row as one sortable record
+    xyz = np.ascontiguousarray(np.asarray(points, dtype=np.float64)[:, :3])
+    return xyz.view([('x', np.float64), ('y', np.float64), ('z', np.float64)]).ravel()
+
+
+def _in_box(points, box):
+    return (points[:, 0] >= box[0]) & (points[:, 0] <= box[1]) & (points[:, 1] >= box[2]) & (points[:, 1] <= box[3])
+
+
+def _changed_triangles(interpolator, vertices, locations, region):
+    '''
+        The triangles of the TIN of interpolator that change when the samples at vertices are removed
+        and samples are inserted at locations: the triangles around the vertices and the triangles
+        whose circumcircle contains a location.
+
+        Output:
+            the circumcenters and squared circumradii of the changed triangles, and whether these are
+            certainly the changed triangles of the TIN of all the samples, of which the interpolator
+            only has the ones inside region. That is the case when the circumcircles of the changed
+            triangles and of their neighbours are inside region: such triangles are empty of all
+            the samples, and the neighbours close the changed area.
+    '''
+    num_triangles = len(interpolator.triangles)
+    distance, vertex = interpolator.kdtree.query(vertices[:, :2] - interpolator.origin)
+    vertex = vertex[distance == 0]
+    start = interpolator.incident_offsets[vertex]
+    size = interpolator.incident_offsets[vertex + 1] - start
+    around = interpolator.incident_triangles[np.repeat(start - np.cumsum(size) + size, size) + np.arange(size.sum())]
+
+    q = locations[:, :2] - interpolator.origin
+    _, nearest = interpolator.kdtree.query(q)
+    # a triangle whose circumcircle passes through a location changes when its cocircular samples
+    # are triangulated otherwise, include them
+    cavity = interpolator._cavity(q, nearest, tolerance=1e-9) % num_triangles
+    changed = _unique(np.concatenate((around, cavity)))
+
+    neighbors = interpolator.neighbors[changed]
+    checked = _unique(np.concatenate((changed, neighbors[neighbors >= 0])))
+    center = interpolator.circumcenters[checked] + interpolator.origin
+    radius = np.sqrt(interpolator.circumradii2[checked])
+    exact = np.all(neighbors >= 0) and np.all((center[:, 0] - radius >= region[0]) & (center[:, 0] + radius <= region[1]) &
+                                              (center[:, 1] - radius >= region[2]) & (center[:, 1] + radius <= region[3]))
+    return interpolator.circumcenters[changed] + interpolator.origin, interpolator.circumradii2[changed], exact
+
+
+def _cells_in_circles(centers, radii2, x0, y0, res, num_row, num_column):
+    '''
+        The rows and columns of the grid cells whose center is inside (or within a relative
+        tolerance of) one of the circles, for the grid of generate_grid with the center of its
+        upper left cell at x0, y0
+    '''
+    radii2 = radii2 * (1 + 1e-9)
+    radius = np.sqrt(radii2)
+    # clip before the conversion to integers, a circle may be huge
+    col0 = np.clip(np.ceil((centers[:, 0] - radius - x0) / res), 0, num_column).astype(np.int64)
+    col1 = np.clip(np.floor((centers[:, 0] + radius - x0) / res), -1, num_column - 1).astype(np.int64)
+    row0 = np.clip(np.ceil((y0 - centers[:, 1] - radius) / res), 0, num_row).astype(np.int64)
+    row1 = np.clip(np.floor((y0 - centers[:, 1] + radius) / res), -1, num_row - 1).astype(np.int64)
+    width = np.maximum(col1 - col0 + 1, 0)
+    size = width * np.maximum(row1 - row0 + 1, 0)
+
+    # the cells of the bounding box of every circle
+    circle = np.repeat(np.arange(len(centers)), size)
+    k = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+    row = row0[circle] + k // width[circle]
+    col = col0[circle] + k % width[circle]
+    inside = (x0 + col * res - centers[circle, 0]) ** 2 + (y0 - row * res - centers[circle, 1]) ** 2 <= radii2[circle]
+    return np.divmod(_unique(row[inside] * num_column + col[inside]), num_column)
+
+
+@staged('laplace_update')
+def laplace_update(dtm_file, points, added=None, removed=None, bbx=None, halo=20.0, group_size=50.0):
+    '''
+        Update a DTM written by laplace after ground points were added or removed, without
+        interpolating the whole grid again. The natural neighbours of a cell only change when it
+        is inside the circumcircle of a triangle that the edit destroys or creates: the triangles
+        around a removed or added point, and the triangles whose circumcircle contains one.
+        The edited points are grouped in squares of group_size, and for every group these
+        triangles are found in TINs of only the points around it (grown like the halo of
+        laplace_interpolant_parallel until they are certainly the triangles of the TIN of all
+        the points). Only the cells inside their circumcircles are interpolated again, and
+        written into the GeoTIFF in place.
+
+        Input:
+            dtm_file: the DTM to update
+            points: the ground points the DTM was interpolated from, an array with x, y, z values
+            added: an array of the added ground points
+            removed: indices (or a mask) of the removed points of points
+            bbx: the bounding box laplace interpolated the DTM in, the bounds of the raster if not given
+            halo: initial width of the region around a group that the TINs are built from
+            group_size: size of the squares the edited points are grouped in
+
+        Output:
+            the updated ground points, and the rows and columns of the cells interpolated again
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    added = np.empty((0, 3)) if added is None else np.asarray(added, dtype=np.float64)[:, :3]
+    removed = np.empty(0, dtype=np.int64) if removed is None else np.asarray(removed)
+    if removed.dtype == bool:
+        removed = np.flatnonzero(removed)
+    keep = np.ones(len(points), dtype=bool)
+    keep[removed] = False
+    new_points = np.concatenate((points[keep], added))
+    removed_points = points[removed]
+    count('laplace_update.added', len(added))
+    count('laplace_update.removed', len(removed))
+
+    with rasterio.open(dtm_file) as raster:
+        res = raster.res[0]
+        num_row, num_column = raster.height, raster.width
+        if bbx is None:
+            bbx = [raster.bounds.left, raster.bounds.right, raster.bounds.bottom, raster.bounds.top]
+    # the cell centers and the origin of the TINs as in laplace
+    x0 = bbx[0] + res / 2
+    y0 = bbx[3] - res / 2
+    grid = (x0, y0, res, num_row, num_column)
+    origin = np.array([x0, y0 - (num_row - 1) * res])
+
+    # group the edited points, removed points first
+    edits = np.concatenate((removed_points, added))
+    group = np.floor((edits[:, :2] - edits[:, :2].min(axis=0, initial=np.inf)) / group_size).astype(np.int64)
+    order, _, starts = sort_by_cell(group[:, 0] * (group[:, 1].max(initial=0) + 1) + group[:, 1])
+    cells = []
+    for start, end in zip(starts, np.append(starts[1:], len(order))):
+        members = order[start:end]
+        is_removed = members < len(removed_points)
+        count('laplace_update.groups')
+        cells.append(_update_group(points, new_points, edits[members[is_removed]], edits[members[~is_removed]],
+                                   origin, grid, halo))
+
+    rows, cols, values = (np.concatenate(v) for v in zip(*cells)) if cells else (np.empty(0, dtype=np.int64),) * 3
+    # the cells of neighbouring groups overlap, their values are the same
+    cell_ids, first = np.unique(rows * num_column + cols, return_index=True)
+    rows, cols = np.divmod(cell_ids, num_column)
+    values = values[first]
+    count('laplace_update.cells', len(rows))
+    with stage('write'):
+        patch_raster(dtm_file, rows, cols, values)
+    return new_points, (rows, cols)
+
+
+def _update_group(points, new_points, removed_points, added, origin, grid, halo):
+    '''
+        The cells of the grid (x0, y0, res, num_row, num_column, see laplace_update) whose value
+        changes by the edit of a group of points, and their new values.
+    '''
+    x0, y0, res, num_row, num_column = grid
+    edits = np.concatenate((removed_points, added))
+    box = [edits[:, 0].min(), edits[:, 0].max(), edits[:, 1].min(), edits[:, 1].max()]
+    with stage('changed_cells'):
+        while True:
+            region = [box[0] - halo, box[1] + halo, box[2] - halo, box[3] + halo]
+            old_local = points[_in_box(points, region)]
+            new_local = new_points[_in_box(new_points, region)]
+            complete = len(old_local) == len(points) and len(new_local) == len(new_points)
+            count('laplace_update.regions')
+            if complete or min(len(old_local), len(new_local)) >= 3:
+                new_tin = LaplaceInterpolator(new_local, origin=origin)
+                old = _changed_triangles(LaplaceInterpolator(old_local, origin=origin), removed_points, added, region)
+                new = _changed_triangles(new_tin, added, removed_points, region)
+                if complete or (old[2] and new[2]):
+                    break
+            halo *= 2
+        rows, cols = _cells_in_circles(np.concatenate((old[0], new[0])), np.concatenate((old[1], new[1])),
+                                       x0, y0, res, num_row, num_column)
+
+    # interpolate the cells again, with a larger region for the cells whose natural neighbours
+    # might be outside it
+    with stage('interpolate'):
+        cell_centers = np.column_stack((x0 + cols * res, y0 - rows * res))
+        values = np.empty(len(rows))
+        todo = np.arange(len(rows))
+        while len(todo) > 0:
+            value, reach = new_tin.interpolate(cell_centers[todo], reach=True)
+            if complete:
+                done = np.ones(len(todo), dtype=bool)
+            else:
+                done = ((reach[:, 0] >= region[0]) & (reach[:, 1] <= region[1]) &
+                        (reach[:, 2] >= region[2]) & (reach[:, 3] <= region[3]))
+            values[todo[done]] = value[done]
+            todo = todo[~done]
+            if len(todo) > 0:
+                halo *= 2
+                reach = reach[~done]
+                region = [min(box[0] - halo, reach[:, 0].min()), max(box[1] + halo, reach[:, 1].max()),
+                          min(box[2] - halo, reach[:, 2].min()), max(box[3] + halo, reach[:, 3].max())]
+                new_local = new_points[_in_box(new_points, region)]
+                complete = len(new_local) == len(new_points)
+                count('laplace_update.regions')
+                new_tin = LaplaceInterpolator(new_local, origin=origin)
+    return rows, cols, values
 
 
 def calculate_circumcenter(a, b, c):
     """
         Calculate the circumcenter of one given triangle
+        (or of many triangles at once when the coordinates are arrays)
 
         Input:
             vertices of the triangle
@@ -150,55 +986,143 @@ def calculate_circumcenter(a, b, c):
     return [ux, uy]
 
 
-def write_raster(input_data, header, output, res):
+@staged('laplace')
+def laplace(res = 0.5, workers = 1, file_path = "../data/processed/600_GP_output_threshold.laz",
+            header_path = '../data/processed/tile_500_filtered.laz', bbx = (188465, 188965, 311800, 312300),
+            output = None, method = 'laplace', method_options = None, checkpoint = False):
     """
-        Write raster file with point cloud data and generate output result
+        Generate the DTM with Laplace interpolation (or one of the faster INTERPOLANTS),
+        with workers > 1 the grid is interpolated tile by tile in that many processes
 
         Input:
-            input_data: data to be written into the GeoTiff
-            header: laz header information
-            output: output file name
             res: resolution
+            workers: number of processes
+            file_path: the ground points
+            header_path: the laz file whose header gives the origin of the raster
+            bbx: the bounding box of the grid [min_x, max_x, min_y, max_y]
+            output: output file name, ../data/output/dtm_{res}.tiff by default
+            method: 'laplace', or 'linear', 'idw' or 'nearest' for previews and coarse products
+            method_options: dictionary of extra arguments of the interpolant (e.g. k and radius of idw)
+            checkpoint: save the completed rows of Laplace with one worker to output.checkpoint.npz,
+                        an interrupted run continues from there (see laplace_interpolant)
 
         Output:
-            A GeoTiff file
+            the DTM array and its raster metadata, to hand over to step5 without reading the file
     """
-    transform = rasterio.transform.from_origin(header.x_min, header.y_max, res, res)
-    crs = 'EPSG:28992'
-    with rasterio.open(output, 'w',
-                       driver='GTiff',
-                       height=input_data.shape[0],
-                       width=input_data.shape[1],
-                       nodata=-9999,
-                       count=1,
-                       dtype=input_data.dtype,
-                       crs=crs,
-                       transform=transform) as dst:
-        dst.write(input_data, 1)
-
-def laplace(res = 0.5):
-    print("Laplace interpolation starts")
+    if method not in INTERPOLANTS:
+        raise ValueError(f"unknown interpolation method {method}, use one of {', '.join(INTERPOLANTS)}")
+    method_options = dict(method_options or {})
+    print("Laplace interpolation starts" if method == 'laplace' else f"Interpolation ({method}) starts")
+    if output is None:
+        output = f'../data/output/dtm_{res}.tiff'
     # bounding box: 500*500 min_x, max_x, min_y, max_y = 188415+50, 189015-50, 311750+50, 312350-50
-    grid = generate_grid([188465,188965,311800,312300], res)
+    grid = generate_grid(bbx, res)
     # get the cell centers coordinates
     cell_center = grid[0]
     # get the number of grid rows
     grid_row = grid[1]
     # get the number of grid columns
     grid_column = grid[2]
-    # read the laz data
-    data_original = read_laz_file("../data/processed/600_GP_output_threshold.laz")
+    with stage('read'):
+        if method == 'laplace' and workers == 1:
+            # the TIN of the points, saved next to the laz file and loaded by later runs
+            cell_index = None
+            interpolator = LaplaceInterpolator.for_file(file_path)
+            data_points = interpolator.points
+        elif method == 'laplace':
+            # the parallel Laplace finds the points around its tiles through the index of the points
+            # at this resolution, that is saved next to the laz file and reused by later runs
+            cell_index = CellIndex.for_file(file_path, res)
+            data_points = cell_index.file_order()
+            interpolator = None
+        else:
+            # the other interpolants only need the points
+            cell_index = None
+            data_points = read_xyz(file_path)
+            interpolator = None
+    if checkpoint and interpolator is not None:
+        method_options['checkpoint'] = f"{output}.checkpoint.npz"
 
-    # transform numpy array to list
-    data_points = data_original[0].tolist()
     # use the data to perform Laplace interpolation
-    laplace_result = laplace_interpolant(data_points, cell_center, grid_row, grid_column)
+    with stage('interpolate'):
+        laplace_result = _interpolate(method, data_points, cell_center, grid_row, grid_column, workers,
+                                      method_options, cell_index, interpolator)
 
     # write the data into GeoTiff format
     # extract origin from the 500*500 data
-    data_500_header = read_laz_file('../data/processed/tile_500_filtered.laz')[1]
-    write_raster(laplace_result, data_500_header, f'../data/output/dtm_{res}.tiff',res)
+    with stage('write'):
+        # only the header, the points of the tile are not needed
+        data_500_header = read_header(header_path)
+        profile = raster_profile(header_transform(data_500_header, res), grid_column, grid_row)
+        meta = write_raster(laplace_result, profile, output)
     print("DTM generated")
+    return laplace_result, meta
+
+
+def _interpolate(method, points, cell_centers, num_row, num_column, workers, method_options, cell_index=None,
+                 interpolator=None):
+    # the grid of one resolution with the interpolant of method
+    if method in ('idw', 'nearest'):
+        return INTERPOLANTS[method](points, cell_centers, num_row, num_column, workers=workers, **method_options)
+    if method != 'laplace':
+        return INTERPOLANTS[method](points, cell_centers, num_row, num_column, **method_options)
+    if workers > 1:
+        return laplace_interpolant_parallel(points, cell_centers, num_row, num_column, workers,
+                                            cell_index=cell_index, **method_options)
+    return laplace_interpolant(points, cell_centers, num_row, num_column, interpolator=interpolator, **method_options)
+
+
+@staged('laplace')
+def laplace_resolutions(resolutions = (0.5, 1, 5), workers = 1,
+                        file_path = "../data/processed/600_GP_output_threshold.laz",
+                        header_path = '../data/processed/tile_500_filtered.laz', bbx = (188465, 188965, 311800, 312300),
+                        outputs = None, method = 'laplace', method_options = None, checkpoint = False):
+    '''
+        Generate the DTM at every resolution of resolutions in one run: the ground points are read
+        once and, for Laplace with one worker, the TIN is built (or loaded from the file next to
+        the laz file, see LaplaceInterpolator.for_file) once and used for every grid.
+        Every DTM is the same as the one of laplace at its resolution.
+
+        Input:
+            resolutions: the resolutions of the DTMs
+            outputs: the output file names, ../data/output/dtm_{res}.tiff by default
+            the other parameters are the ones of laplace
+
+        Output:
+            a list with the DTM array and its raster metadata of every resolution
+    '''
+    if method not in INTERPOLANTS:
+        raise ValueError(f"unknown interpolation method {method}, use one of {', '.join(INTERPOLANTS)}")
+    method_options = dict(method_options or {})
+    if outputs is None:
+        outputs = [f'../data/output/dtm_{res}.tiff' for res in resolutions]
+    if len(outputs) != len(resolutions):
+        raise ValueError(f"{len(outputs)} outputs for {len(resolutions)} resolutions")
+    with stage('read'):
+        header = read_header(header_path)
+        if method == 'laplace' and workers == 1:
+            interpolator = LaplaceInterpolator.for_file(file_path)
+            data_points = interpolator.points
+        else:
+            interpolator = None
+            data_points = read_xyz(file_path)
+
+    results = []
+    for res, output in zip(resolutions, outputs):
+        print(f"DTM at {res} m")
+        cell_center, grid_row, grid_column = generate_grid(bbx, res)
+        options = dict(method_options)
+        if checkpoint and interpolator is not None:
+            options['checkpoint'] = f"{output}.checkpoint.npz"
+        with stage('interpolate'):
+            values = _interpolate(method, data_points, cell_center, grid_row, grid_column, workers, options,
+                                  interpolator=interpolator)
+        with stage('write'):
+            profile = raster_profile(header_transform(header, res), grid_column, grid_row)
+            results.append((values, write_raster(values, profile, output)))
+        count('laplace.resolutions')
+    print("DTMs generated")
+    return results
 
 if __name__ == '__main__':
     laplace()
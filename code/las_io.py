@@ -0,0 +1,181 @@
+import os
+import queue
+import threading
+
+import numpy as np
+import laspy
+
+from point_store import PointStore, dimension_dtype
+
+
+def laz_backend():
+    '''
+        The laz backend of all the readers and writers: lazrs compressing and decompressing the
+        chunks of a laz file on all cores when it is installed, else the default of laspy
+    '''
+    available = laspy.LazBackend.detect_available()
+    if laspy.LazBackend.LazrsParallel in available:
+        return laspy.LazBackend.LazrsParallel
+    return available[0] if available else None
+
+
+def open_laz(file_path, mode='r', **kwargs):
+    '''
+        laspy.open with the backend of laz_backend, only the header is read when the file is opened
+    '''
+    return laspy.open(file_path, mode=mode, laz_backend=laz_backend(), **kwargs)
+
+
+def iter_points(file_path, dimensions=('x', 'y', 'z'), bbox=None, classes=None, chunk_size=1_000_000):
+    '''
+        Read a laz file in chunks, so that only one chunk of points is decoded in memory at a time.
+        file_path can also be the directory of a PointStore, then only the chunks of the store
+        that intersect bbox and classes are read
+
+        Input:
+            file_path: file path of the laz file
+            dimensions: names of the dimensions to read, x, y and z are returned as scaled coordinates
+            bbox: optional [min_x, max_x, min_y, max_y], only points inside it are kept
+            classes: optional list of classification codes, only points with these classes are kept
+            chunk_size: number of points decoded at once
+
+        Output:
+            yields, for every chunk, a dictionary with a contiguous array per dimension
+    '''
+    if os.path.isdir(file_path):
+        yield from PointStore(file_path).iter_points(dimensions, bbox, classes)
+        return
+    with open_laz(file_path) as reader:
+        for chunk in reader.chunk_iterator(chunk_size):
+            keep = np.ones(len(chunk), dtype=bool)
+            if bbox is not None:
+                x = np.asarray(chunk.x)
+                y = np.asarray(chunk.y)
+                keep &= (x >= bbox[0]) & (x <= bbox[1]) & (y >= bbox[2]) & (y <= bbox[3])
+            if classes is not None:
+                keep &= np.isin(np.asarray(chunk.classification), classes)
+            yield {name: np.ascontiguousarray(np.asarray(chunk[name])[keep]) for name in dimensions}
+
+
+def read_points(file_path, dimensions=('x', 'y', 'z'), bbox=None, classes=None, chunk_size=1_000_000):
+    '''
+        Read the requested dimensions of the points of a laz file (optionally filtered by bbox and class)
+        chunk by chunk, see iter_points
+
+        Output:
+            a dictionary with a contiguous array per dimension
+    '''
+    if os.path.isdir(file_path):
+        return PointStore(file_path).read_points(dimensions, bbox, classes)
+    chunks = list(iter_points(file_path, dimensions, bbox, classes, chunk_size))
+    if len(chunks) == 0:
+        with open_laz(file_path) as reader:
+            point_format = reader.header.point_format
+        return {name: np.empty(0, dtype=dimension_dtype(point_format, name)) for name in dimensions}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in dimensions}
+
+
+def read_xyz(file_path, bbox=None, classes=None, chunk_size=1_000_000):
+    '''
+        Read the coordinates of the points of a laz file chunk by chunk, see iter_points
+
+        Output:
+            an array of points with x, y, z values
+    '''
+    chunks = [np.column_stack((chunk['x'], chunk['y'], chunk['z']))
+              for chunk in iter_points(file_path, ('x', 'y', 'z'), bbox, classes, chunk_size)]
+    if len(chunks) == 0:
+        return np.empty((0, 3))
+    return np.concatenate(chunks)
+
+
+def read_header(file_path):
+    '''
+        The header of a laz file (or of the laz file a PointStore was converted from),
+        without reading the points
+    '''
+    if os.path.isdir(file_path):
+        return PointStore(file_path).header
+    # the points are not decoded, only the header (and the vlrs) are read
+    with open_laz(file_path) as reader:
+        return reader.header
+
+
+def prefetch(items, load, depth=1):
+    '''
+        Load the next items on a background thread while the current one is being processed, so
+        reading and decompressing a tile overlaps the computation on the previous one.
+        The laz decompression and most numpy operations release the GIL.
+
+            for tile, points in prefetch(tiles, read_xyz):
+                ...
+
+        Input:
+            items: the items to load, e.g. file paths
+            load: function of an item, e.g. read_xyz
+            depth: number of items loaded ahead
+
+        Output:
+            yields every item and load(item), in the order of items
+    '''
+    loaded = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def worker():
+        for item in items:
+            if stop.is_set():
+                return
+            try:
+                value = (item, load(item), None)
+            except BaseException as error:
+                value = (item, None, error)
+            loaded.put(value)
+            if value[2] is not None:
+                return
+        loaded.put(None)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            value = loaded.get()
+            if value is None:
+                return
+            item, result, error = value
+            if error is not None:
+                raise error
+            yield item, result
+    finally:
+        stop.set()
+        # let the worker finish the item it is loading
+        while thread.is_alive():
+            try:
+                loaded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+def write_masked_points(file_path, output_path, mask, chunk_size=1_000_000):
+    '''
+        Copy the points selected by a mask from one laz file to another, chunk by chunk.
+        The points keep all their attributes, and the output keeps the header (version,
+        point format, scales, offsets, vlrs) of the input file.
+
+        Input:
+            file_path: file path of the input laz file
+            output_path: file path of the output laz file
+            mask: a boolean array with one value per point of the input file, in file order
+            chunk_size: number of points decoded at once
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    with open_laz(file_path) as reader:
+        if len(mask) != reader.header.point_count:
+            raise ValueError(f"the mask has {len(mask)} values but {file_path} has {reader.header.point_count} points")
+        with open_laz(output_path, mode='w', header=reader.header) as writer:
+            start = 0
+            for chunk in reader.chunk_iterator(chunk_size):
+                keep = mask[start:start + len(chunk)]
+                start += len(chunk)
+                if keep.any():
+                    writer.write_points(chunk[keep])
@@ -1,14 +1,26 @@
-from laplace_interpolate import laplace
-from step4 import step4
-from step5 import step5
+from pipeline import run_pipeline
 """
 default file has been put in the function
 default resolution is 0.5m, for quick test, you can set it to 20m
+for a quick preview of the DTM, set method to 'linear', 'idw' or 'nearest' instead of 'laplace'
+the results of every step are cached in ../data/output/cache,
+a step only runs again when its input files or parameters change
 """
-def test_(res = 20):
-    laplace(res=res)
-    step4(res=res)
-    step5()
+def test_(res = 20, method = 'laplace'):
+    artifacts = run_pipeline(res=res, method=method)
+    print(artifacts)
+
+"""
+the whole workflow from the AHN4 tile: cropping, thinning and outlier removal (preprocessing.py),
+the ground filtering (GFTIN_final_pyVer.py), then the DTM, step4 and the CHM
+"""
+def run_all(raw_file = '../data/raw/69DN2_04.LAZ', res = 20, method = 'laplace',
+            ground_file = '../data/processed/600_GP_output.laz'):
+    from preprocessing import preprocess
+    from GFTIN_final_pyVer import ground_filter
+    inputs = preprocess(raw_file)
+    ground_filter(inputs['ground_input'], ground_file)
+    artifacts = run_pipeline(res=res, method=method, ground_file=ground_file, tile_file=inputs['tile'])
+    print(artifacts)
 if __name__ == "__main__":
     test_()
-
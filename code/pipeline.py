@@ -0,0 +1,223 @@
+import hashlib
+import importlib.metadata
+import inspect
+import json
+import os
+
+import instrument
+
+import cell_index
+import checkpoint
+import grid_binning
+import laplace_interpolate
+import las_io
+import point_store
+import raster_io
+import step4 as step4_module
+import step5 as step5_module
+import triangle_grid
+from cell_index import CellIndex
+from las_io import prefetch
+from laplace_interpolate import LaplaceInterpolator, laplace
+from step4 import step4, DIMENSIONS as STEP4_DIMENSIONS, CLASSES as STEP4_CLASSES
+from step5 import step5
+
+# the libraries whose version can change the artifacts of the stages
+LIBRARIES = ('numpy', 'scipy', 'laspy', 'lazrs', 'startinpy', 'rasterio')
+
+# the modules whose source is part of the key of each stage: the module of the stage and every module
+# of this package it imports, directly or through the others (las_io reads PointStores, raster_io bins by cell)
+DTM_CODE = [laplace_interpolate, grid_binning, las_io, point_store, cell_index, triangle_grid, raster_io, checkpoint]
+STEP4_CODE = [step4_module, grid_binning, las_io, point_store, cell_index, raster_io]
+STEP5_CODE = [step5_module, grid_binning, raster_io]
+
+
+def file_digest(file_path, digests=None):
+    '''
+        sha256 of the content of a file, read in blocks
+
+        Input:
+            file_path: the file to hash
+            digests: optional dictionary of known digests, keyed on path, size and modification time,
+                     so that large input files are only hashed again when they change
+
+        Output:
+            the hex digest
+    '''
+    if os.path.isdir(file_path):
+        # a PointStore, its meta.json identifies the laz file it was converted from
+        file_path = os.path.join(file_path, 'meta.json')
+    stat = os.stat(file_path)
+    known = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    if digests is not None and known in digests:
+        return digests[known]
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    if digests is not None:
+        digests[known] = sha.hexdigest()
+    return sha.hexdigest()
+
+
+def library_digest():
+    '''
+        sha256 of the versions of LIBRARIES (None for the ones not installed)
+    '''
+    sha = hashlib.sha256()
+    for library in LIBRARIES:
+        try:
+            version = importlib.metadata.version(library)
+        except importlib.metadata.PackageNotFoundError:
+            version = None
+        sha.update(f"{library}={version}".encode())
+    return sha.hexdigest()
+
+
+class Pipeline:
+    '''
+        Runs the stages of the workflow with a content addressed cache: the output of a stage is
+        stored under a key made of the hashes of its input files, its parameters, the source of
+        the modules the stage depends on and the versions of LIBRARIES. A stage whose artifact
+        already exists is skipped, and the artifact paths are passed from stage to stage explicitly.
+    '''
+
+    def __init__(self, cache_dir='../data/output/cache'):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.digest_file = os.path.join(cache_dir, 'digests.json')
+        self.digests = {}
+        # the values returned by the stages that ran in this process, by artifact path
+        self.memory = {}
+        if os.path.exists(self.digest_file):
+            with open(self.digest_file) as f:
+                self.digests = json.load(f)
+        self.library_digest = library_digest()
+
+    def key(self, name, code, inputs, params):
+        '''
+            the cache key of a stage: sha256 of the stage name, the versions of LIBRARIES, the source of
+            the modules of code, the digests of the input files and the parameters
+        '''
+        sha = hashlib.sha256(name.encode())
+        sha.update(self.library_digest.encode())
+        for func in code:
+            sha.update(file_digest(inspect.getsourcefile(inspect.unwrap(func)), self.digests).encode())
+        for file_path in inputs:
+            sha.update(file_digest(file_path, self.digests).encode())
+        sha.update(json.dumps(params, sort_keys=True, default=list).encode())
+        return sha.hexdigest()
+
+    def run(self, name, func, inputs, params, options=None, code=None, suffix='.tiff'):
+        '''
+            Run one stage, or reuse its cached artifact
+
+            Input:
+                name: name of the stage
+                func: the stage function, called as func(*inputs, output=path, **params, **options)
+                inputs: the input file paths of the stage
+                params: the parameters that change the result (resolution, bbox, thresholds)
+                options: parameters that do not change the result (e.g. number of workers)
+                code: the modules (or functions of the modules) whose source is part of the key,
+                      the module of func by default
+                suffix: file extension of the artifact
+
+            Output:
+                the path of the artifact
+        '''
+        key = self.key(name, code or [func], inputs, params)
+        output = os.path.join(self.cache_dir, f"{name}_{key[:16]}{suffix}")
+        if os.path.exists(output):
+            print(f"{name}: cached {output}")
+            instrument.count('pipeline.cached')
+            return output
+
+        # write to a temporary name first, an interrupted stage never leaves a valid looking artifact
+        partial = os.path.join(self.cache_dir, f"{name}_{key[:16]}.partial{suffix}")
+        value = func(*inputs, output=partial, **params, **(options or {}))
+        os.replace(partial, output)
+        if value is not None:
+            self.memory[output] = value
+        with open(os.path.join(self.cache_dir, f"{name}_{key[:16]}.json"), 'w') as f:
+            json.dump({'stage': name, 'key': key, 'inputs': list(inputs), 'params': params}, f,
+                      indent=2, default=list)
+        self.save_digests()
+        return output
+
+    def save_digests(self):
+        with open(self.digest_file, 'w') as f:
+            json.dump(self.digests, f, indent=2)
+
+
+def _dtm(ground_file, tile_file, output, res, bbx, method='laplace', method_options=None, workers=1,
+         checkpoint=False):
+    return laplace(res=res, workers=workers, file_path=ground_file, header_path=tile_file, bbx=bbx, output=output,
+                   method=method, method_options=method_options, checkpoint=checkpoint)
+
+
+def _step4(tile_file, output, res, ndvi_threshold):
+    return step4(file_path=tile_file, res=res, ndvi_threshold=ndvi_threshold, output=output)
+
+
+def run_pipeline(res=0.5, workers=1, ground_file='../data/processed/600_GP_output_threshold.laz',
+                 tile_file='../data/processed/tile_500_filtered.laz', bbx=(188465, 188965, 311800, 312300),
+                 ndvi_threshold=0.2, cache_dir='../data/output/cache', report_file='../data/output/report.json',
+                 method='laplace', method_options=None, checkpoint=True):
+    """
+    run step3 (DTM by Laplace interpolation), step4 (vegetation DSM) and step5 (CHM),
+    reusing every artifact whose inputs and parameters did not change.
+    method and method_options select the interpolation of the DTM (see laplace).
+    with checkpoint an interrupted Laplace interpolation continues from its last saved rows
+    in the next run (the checkpoint is kept next to the partial artifact in cache_dir).
+    the time, memory and counters of the stages are written as json to report_file.
+    returns the paths of the artifacts
+    """
+    instrument.reset()
+    pipeline = Pipeline(cache_dir)
+    dtm = pipeline.run('dtm', _dtm, [ground_file, tile_file],
+                       {'res': res, 'bbx': list(bbx), 'method': method, 'method_options': dict(method_options or {})},
+                       options={'workers': workers, 'checkpoint': checkpoint}, code=DTM_CODE)
+    dsm = pipeline.run('step4', _step4, [tile_file], {'res': res, 'ndvi_threshold': ndvi_threshold},
+                       code=STEP4_CODE)
+
+    def _step5(dtm_file, step4_file, output):
+        # the rasters of the stages that just ran are handed over in memory, cached ones are read by blocks
+        step5(dtm_file=dtm_file, step4_file=step4_file, output=output,
+              dtm=pipeline.memory.get(dtm_file), dsm=pipeline.memory.get(step4_file))
+
+    chm = pipeline.run('step5', _step5, [dtm, dsm], {}, code=STEP5_CODE)
+    artifacts = {'dtm': dtm, 'step4': dsm, 'step5': chm}
+    instrument.write_report(report_file, params={'res': res, 'bbx': list(bbx), 'ndvi_threshold': ndvi_threshold,
+                                                 'method': method},
+                            inputs=[ground_file, tile_file], artifacts=artifacts)
+    return artifacts
+
+
+def _read_tile(tile, res, method='laplace', workers=1):
+    # decode the laz files of a tile into what laplace and step4 read: the TIN of the ground points
+    # (the cell index of them for the parallel Laplace) and the cell index of the tile,
+    # they are saved next to the files, so the stages load them instead of reading the laz files
+    if method == 'laplace' and workers == 1:
+        LaplaceInterpolator.for_file(tile['ground_file'])
+    elif method == 'laplace':
+        CellIndex.for_file(tile['ground_file'], res)
+    CellIndex.for_file(tile['tile_file'], res, STEP4_DIMENSIONS, classes=STEP4_CLASSES)
+    return tile
+
+
+def run_tiles(tiles, res=0.5, prefetch_depth=1, report_dir='../data/output/reports', **options):
+    """
+    run the pipeline for many tiles, while the laz files of the next tiles are read and decompressed
+    on a background thread (see las_io.prefetch), so the reading overlaps the stages of the current tile.
+    tiles are dictionaries with the ground_file, tile_file and bbx of every tile,
+    options are passed to run_pipeline, the report of every tile is written to report_dir.
+    returns the artifacts of every tile
+    """
+    results = []
+    method, workers = options.get('method', 'laplace'), options.get('workers', 1)
+    for tile, _ in prefetch(tiles, lambda tile: _read_tile(tile, res, method, workers), prefetch_depth):
+        name = os.path.splitext(os.path.basename(tile['tile_file']))[0]
+        results.append(run_pipeline(res=res, ground_file=tile['ground_file'], tile_file=tile['tile_file'],
+                                    bbx=tile['bbx'], report_file=os.path.join(report_dir, f"{name}.json"),
+                                    **options))
+    return results
@@ -0,0 +1,274 @@
+import json
+import os
+import shutil
+import types
+
+import numpy as np
+
+from grid_binning import hilbert_codes, morton_codes, sort_by_cell
+
+# the dimensions kept by default, when the point format has them
+DIMENSIONS = ('classification', 'return_number', 'number_of_returns', 'red', 'green', 'blue', 'nir')
+CURVES = {'morton': morton_codes, 'hilbert': hilbert_codes}
+
+
+class PointStore:
+    '''
+        A laz file converted to a chunked columnar store on disk. The points are sorted along a
+        space filling curve and split into chunks of chunk_size points, so the points of a chunk
+        are close to each other. Every dimension is one .npy file that is loaded memory mapped
+        (x, y and z together as 'xyz', (n, 3)), and the bounding box and the classes of every
+        chunk are kept, so a query by bbox or class only reads the chunks it intersects.
+        order holds the index in the laz file of every point, like the order of a CellIndex.
+
+            store = PointStore.for_file('../data/processed/tile.laz')
+            ground = store.read_xyz(bbox=[x0, x1, y0, y1], classes=[2])
+    '''
+
+    def __init__(self, directory, mmap_mode='r'):
+        '''
+            Open a store written by convert
+
+            Input:
+                directory: the directory of the store
+                mmap_mode: mode of the memory maps of the columns
+        '''
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.chunk_size = self.meta['chunk_size']
+        self.columns = {name: np.load(os.path.join(directory, f'column_{name}.npy'), mmap_mode=mmap_mode)
+                        for name in self.meta['columns']}
+        # [min_x, max_x, min_y, max_y] and a flag per classification code of every chunk
+        self.chunk_bbox = np.load(os.path.join(directory, 'chunk_bbox.npy'))
+        self.chunk_classes = np.load(os.path.join(directory, 'chunk_classes.npy'))
+        # stores converted before the file order was kept have no order.npy
+        order_file = os.path.join(directory, 'order.npy')
+        self.order = np.load(order_file, mmap_mode=mmap_mode) if os.path.exists(order_file) else None
+
+    @classmethod
+    def convert(cls, file_path, directory=None, dimensions=DIMENSIONS, chunk_size=65536, curve='hilbert',
+                read_chunk=1_000_000, bucket_size=4_000_000):
+        '''
+            Write a laz file into a store, without holding all its points in memory: the points are
+            read chunk by chunk and spread over buckets of consecutive ranges of the curve in
+            temporary files, then every bucket is sorted in memory and appended to the columns.
+
+            Input:
+                file_path: the laz file
+                directory: directory of the store, store_directory(file_path) if not given
+                dimensions: the dimensions to keep besides x, y and z (the ones the point format lacks are skipped)
+                chunk_size: number of points of a chunk
+                curve: 'hilbert' or 'morton', the order of the points
+                read_chunk: number of points decoded from the laz file at once
+                bucket_size: about the number of points sorted in memory at once
+
+            Output:
+                the PointStore
+        '''
+        # las_io reads stores too, it is imported here to avoid a circular import
+        from las_io import open_laz
+
+        if directory is None:
+            directory = store_directory(file_path)
+        with open_laz(file_path) as reader:
+            header = reader.header
+        point_format = header.point_format
+        dimensions = [name for name in dimensions if name in point_format.dimension_names]
+        count = header.point_count
+        bbx = [header.x_min, header.x_max, header.y_min, header.y_max]
+
+        # buckets of the first bits of the codes, each a range of the curve
+        level = 0
+        while 4 ** level * bucket_size < count and level < 6:
+            level += 1
+        shift = 32 - 2 * level
+        record = np.dtype([('code', np.uint64), ('index', np.int64),
+                           ('x', np.float64), ('y', np.float64), ('z', np.float64)] +
+                          [(name, dimension_dtype(point_format, name)) for name in dimensions])
+
+        partial = directory + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        buckets = os.path.join(partial, 'buckets')
+        os.makedirs(buckets)
+        with open_laz(file_path) as reader:
+            read = 0
+            for chunk in reader.chunk_iterator(read_chunk):
+                records = np.empty(len(chunk), dtype=record)
+                records['index'] = np.arange(read, read + len(chunk))
+                read += len(chunk)
+                for name in ('x', 'y', 'z') + tuple(dimensions):
+                    records[name] = np.asarray(chunk[name])
+                records['code'] = CURVES[curve](records['x'], records['y'], bbx)
+                # sort_by_cell is stable, so the points of a bucket stay in file order
+                order, ids, starts = sort_by_cell((records['code'] >> np.uint64(shift)).astype(np.int64))
+                for b, start, end in zip(ids, starts, np.append(starts[1:], len(order))):
+                    with open(os.path.join(buckets, f'{b}.bin'), 'ab') as f:
+                        records[order[start:end]].tofile(f)
+
+        columns = {'xyz': np.lib.format.open_memmap(os.path.join(partial, 'column_xyz.npy'), mode='w+',
+                                                    dtype=np.float64, shape=(count, 3))}
+        order = np.lib.format.open_memmap(os.path.join(partial, 'order.npy'), mode='w+', dtype=np.int64, shape=(count,))
+        for name in dimensions:
+            columns[name] = np.lib.format.open_memmap(os.path.join(partial, f'column_{name}.npy'), mode='w+',
+                                                      dtype=record[name], shape=(count,))
+        start = 0
+        for b in sorted(int(name[:-4]) for name in os.listdir(buckets)):
+            records = np.fromfile(os.path.join(buckets, f'{b}.bin'), dtype=record)
+            records = records[np.argsort(records['code'], kind='stable')]
+            end = start + len(records)
+            columns['xyz'][start:end] = np.column_stack((records['x'], records['y'], records['z']))
+            order[start:end] = records['index']
+            for name in dimensions:
+                columns[name][start:end] = records[name]
+            start = end
+        shutil.rmtree(buckets)
+
+        # bounding box and classes of the chunks
+        num_chunks = -(-count // chunk_size)
+        chunk_bbox = np.empty((num_chunks, 4))
+        chunk_classes = np.zeros((num_chunks, 256), dtype=bool)
+        for k in range(num_chunks):
+            xyz = columns['xyz'][k * chunk_size:(k + 1) * chunk_size]
+            chunk_bbox[k] = [xyz[:, 0].min(), xyz[:, 0].max(), xyz[:, 1].min(), xyz[:, 1].max()]
+            if 'classification' in columns:
+                chunk_classes[k, columns['classification'][k * chunk_size:(k + 1) * chunk_size]] = True
+            else:
+                chunk_classes[k] = True
+        for values in list(columns.values()) + [order]:
+            values.flush()
+        del columns, order
+        np.save(os.path.join(partial, 'chunk_bbox.npy'), chunk_bbox)
+        np.save(os.path.join(partial, 'chunk_classes.npy'), chunk_classes)
+
+        stat = os.stat(file_path)
+        meta = {'file_size': stat.st_size, 'file_mtime_ns': stat.st_mtime_ns, 'chunk_size': chunk_size,
+                'curve': curve, 'columns': ['xyz'] + dimensions,
+                'header': {'point_count': int(count), 'point_format': int(point_format.id),
+                           'x_min': header.x_min, 'x_max': header.x_max, 'y_min': header.y_min,
+                           'y_max': header.y_max, 'z_min': header.z_min, 'z_max': header.z_max,
+                           'scales': header.scales.tolist(), 'offsets': header.offsets.tolist()}}
+        with open(os.path.join(partial, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(partial, directory)
+        return cls(directory)
+
+    @classmethod
+    def for_file(cls, file_path, directory=None, **options):
+        '''
+            The store of a laz file, converted when it does not exist yet or the file changed since.
+            options are passed to convert.
+        '''
+        if directory is None:
+            directory = store_directory(file_path)
+        if os.path.exists(os.path.join(directory, 'meta.json')):
+            stat = os.stat(file_path)
+            store = cls(directory)
+            if store.meta['file_size'] == stat.st_size and store.meta['file_mtime_ns'] == stat.st_mtime_ns \
+                    and store.order is not None:
+                return store
+        return cls.convert(file_path, directory, **options)
+
+    @property
+    def header(self):
+        '''
+            The bounds, point count, scales and offsets of the laz file, with the names of a laspy header
+        '''
+        header = dict(self.meta['header'])
+        header['scales'] = np.array(header['scales'])
+        header['offsets'] = np.array(header['offsets'])
+        return types.SimpleNamespace(**header)
+
+    @property
+    def num_points(self):
+        return len(self.columns['xyz'])
+
+    @property
+    def num_chunks(self):
+        return len(self.chunk_bbox)
+
+    @property
+    def dimensions(self):
+        return ('x', 'y', 'z') + tuple(self.meta['columns'][1:])
+
+    def chunks(self, bbox=None, classes=None):
+        '''
+            The chunks that intersect bbox [min_x, max_x, min_y, max_y] and have points of one of classes
+        '''
+        selected = np.ones(self.num_chunks, dtype=bool)
+        if bbox is not None:
+            selected &= (self.chunk_bbox[:, 0] <= bbox[1]) & (self.chunk_bbox[:, 1] >= bbox[0]) & \
+                        (self.chunk_bbox[:, 2] <= bbox[3]) & (self.chunk_bbox[:, 3] >= bbox[2])
+        if classes is not None:
+            selected &= self.chunk_classes[:, np.asarray(classes, dtype=np.int64)].any(axis=1)
+        return np.flatnonzero(selected)
+
+    def iter_points(self, dimensions=('x', 'y', 'z'), bbox=None, classes=None):
+        '''
+            Read the points chunk by chunk, only the chunks intersecting the query are read,
+            like las_io.iter_points
+
+            Output:
+                yields, for every chunk with points in the query, a dictionary with a contiguous array per dimension
+        '''
+        for k in self.chunks(bbox, classes):
+            rows = slice(int(k) * self.chunk_size, (int(k) + 1) * self.chunk_size)
+            xyz = self.columns['xyz'][rows]
+            keep = np.ones(len(xyz), dtype=bool)
+            if bbox is not None:
+                keep &= (xyz[:, 0] >= bbox[0]) & (xyz[:, 0] <= bbox[1]) & (xyz[:, 1] >= bbox[2]) & (xyz[:, 1] <= bbox[3])
+            if classes is not None:
+                keep &= np.isin(self.columns['classification'][rows], classes)
+            if not keep.any():
+                continue
+            yield {name: np.ascontiguousarray(self._column(name, rows)[keep]) for name in dimensions}
+
+    def read_points(self, dimensions=('x', 'y', 'z'), bbox=None, classes=None):
+        '''
+            Read the requested dimensions of the points in the query, see iter_points
+
+            Output:
+                a dictionary with a contiguous array per dimension
+        '''
+        chunks = list(self.iter_points(dimensions, bbox, classes))
+        if len(chunks) == 0:
+            return {name: self._column(name, slice(0, 0)).copy() for name in dimensions}
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in dimensions}
+
+    def read_xyz(self, bbox=None, classes=None):
+        '''
+            Read the coordinates of the points in the query, see iter_points
+
+            Output:
+                an array of points with x, y, z values
+        '''
+        if bbox is None and classes is None:
+            return np.array(self.columns['xyz'])
+        chunks = [np.column_stack((chunk['x'], chunk['y'], chunk['z']))
+                  for chunk in self.iter_points(('x', 'y', 'z'), bbox, classes)]
+        if len(chunks) == 0:
+            return np.empty((0, 3))
+        return np.concatenate(chunks)
+
+    def _column(self, name, rows):
+        if name in ('x', 'y', 'z'):
+            return self.columns['xyz'][rows, 'xyz'.index(name)]
+        return self.columns[name][rows]
+
+
+def dimension_dtype(point_format, name):
+    '''
+        The dtype of a dimension of a point format, as laspy returns its values
+    '''
+    if name in ('x', 'y', 'z'):
+        return np.float64
+    # the bit fields of point formats 0 to 5 (e.g. classification) have no dtype of their own
+    return point_format.dimension_by_name(name).dtype or np.dtype(np.uint8)
+
+
+def store_directory(file_path):
+    '''
+        The directory next to the laz file where its store is written
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(file_path)), f"{os.path.basename(file_path)}.store")
@@ -0,0 +1,323 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from las_io import open_laz, read_header, write_masked_points
+from point_store import PointStore
+from instrument import stage, staged, count
+
+
+def _copy_points(file_path, output_path, select, chunk_size=1_000_000):
+    '''
+        Copy the points of a laz file for which select returns True, chunk by chunk, keeping all
+        their attributes and the header of the input file (the bounds follow the written points)
+
+        Input:
+            file_path: the input laz file
+            output_path: the output laz file
+            select: function of a chunk of points and the index of its first point, returns a boolean mask
+            chunk_size: number of points decoded at once
+
+        Output:
+            the number of points written
+    '''
+    written = 0
+    with open_laz(file_path) as reader:
+        with open_laz(output_path, mode='w', header=reader.header) as writer:
+            start = 0
+            for chunk in reader.chunk_iterator(chunk_size):
+                keep = select(chunk, start)
+                start += len(chunk)
+                if keep.any():
+                    writer.write_points(chunk[keep])
+                    written += int(np.count_nonzero(keep))
+    return written
+
+
+@staged('crop')
+def crop(file_path, output_path, bbox, buffer=0.0, chunk_size=1_000_000):
+    '''
+        Crop a laz file to a bounding box, streamed chunk by chunk (see cropping_final.ipynb)
+
+        Input:
+            file_path: the input laz file, e.g. the AHN4 tile
+            output_path: the output laz file
+            bbox: [min_x, max_x, min_y, max_y], the edges are included
+            buffer: distance the box is grown by on every side
+            chunk_size: number of points decoded at once
+
+        Output:
+            the number of points written
+    '''
+    min_x, max_x = bbox[0] - buffer, bbox[1] + buffer
+    min_y, max_y = bbox[2] - buffer, bbox[3] + buffer
+
+    def select(chunk, start):
+        x = np.asarray(chunk.x)
+        y = np.asarray(chunk.y)
+        return (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+
+    written = _copy_points(file_path, output_path, select, chunk_size)
+    count('preprocess.cropped_points', written)
+    return written
+
+
+def _boundary(chunk, header):
+    # the points on the edges of the bounds in the header, thinning keeps them so the extent does not shrink
+    x = np.asarray(chunk.x)
+    y = np.asarray(chunk.y)
+    return (x == header.x_min) | (x == header.x_max) | (y == header.y_min) | (y == header.y_max)
+
+
+def _random_selection(num_points, keep_fraction, seed):
+    '''
+        A random selection of int(num_points * keep_fraction) of the points, the same number as
+        np.random.choice in thining+outlier_final.ipynb, drawn chunk by chunk: the number of points kept
+        in a chunk follows the hypergeometric distribution of the points still to keep among the points
+        left, so every subset of that size is equally likely, without an index of the whole file.
+
+        Output:
+            a function of the number of points of the next chunk, returns its boolean mask
+    '''
+    rng = np.random.default_rng(seed)
+    state = {'left': num_points, 'to_keep': int(num_points * keep_fraction)}
+
+    def select(num_chunk):
+        left, to_keep = state['left'], state['to_keep']
+        if left < 10 ** 9:
+            kept = int(rng.hypergeometric(to_keep, left - to_keep, num_chunk)) if num_chunk > 0 else 0
+        else:
+            # beyond the population size numpy samples, its binomial limit, within the feasible range
+            kept = int(np.clip(rng.binomial(num_chunk, to_keep / left), to_keep - (left - num_chunk),
+                               min(to_keep, num_chunk)))
+        mask = np.zeros(num_chunk, dtype=bool)
+        mask[rng.choice(num_chunk, kept, replace=False)] = True
+        state['left'], state['to_keep'] = left - num_chunk, to_keep - kept
+        return mask
+
+    return select
+
+
+def _voxel_mask(file_path, cell_size, chunk_size=1_000_000):
+    '''
+        The point closest to the centre of every occupied voxel of cell_size, found chunk by chunk:
+        the best point of every voxel so far is kept in a table sorted by voxel, that the best points
+        of every chunk are merged into.
+
+        Output:
+            a boolean array with one value per point of the file, in file order
+    '''
+    header = read_header(file_path)
+    origin = np.array([header.x_min, header.y_min, header.z_min])
+    num = np.floor((np.array([header.x_max, header.y_max, header.z_max]) - origin) / cell_size).astype(np.int64) + 1
+    keys = np.empty(0, dtype=np.int64)
+    distances = np.empty(0)
+    index = np.empty(0, dtype=np.int64)
+    with open_laz(file_path) as reader:
+        start = 0
+        for chunk in reader.chunk_iterator(chunk_size):
+            xyz = np.column_stack((chunk.x, chunk.y, chunk.z))
+            voxel = np.clip(np.floor((xyz - origin) / cell_size).astype(np.int64), 0, num - 1)
+            chunk_keys = (voxel[:, 0] * num[1] + voxel[:, 1]) * num[2] + voxel[:, 2]
+            chunk_distances = np.sum((xyz - origin - (voxel + 0.5) * cell_size) ** 2, axis=1)
+            # points earlier in the file win ties, like group_argmin
+            keys = np.concatenate((keys, chunk_keys))
+            distances = np.concatenate((distances, chunk_distances))
+            index = np.concatenate((index, np.arange(start, start + len(xyz))))
+            order = np.lexsort((index, distances, keys))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = keys[order[1:]] != keys[order[:-1]]
+            order = order[first]
+            keys, distances, index = keys[order], distances[order], index[order]
+            start += len(xyz)
+    mask = np.zeros(header.point_count, dtype=bool)
+    mask[index] = True
+    return mask
+
+
+@staged('thin')
+def thin(file_path, output_path, method='random', keep_fraction=0.25, cell_size=0.5, keep_boundary=True,
+         seed=0, chunk_size=1_000_000):
+    '''
+        Thin a laz file, streamed chunk by chunk (see thining+outlier_final.ipynb)
+
+        Input:
+            file_path: the input laz file
+            output_path: the output laz file
+            method: 'random' keeps a random keep_fraction of the points,
+                    'grid' keeps the point closest to the centre of every voxel of cell_size
+            keep_fraction: the fraction of points kept by random thinning (0.25 for the assignment)
+            cell_size: size of the voxels of grid thinning
+            keep_boundary: also keep the points on the edges of the bounds, so the extent of the tile stays the same
+            seed: seed of random thinning, the same seed and chunk_size keep the same points
+            chunk_size: number of points decoded at once
+
+        Output:
+            the number of points written
+    '''
+    header = read_header(file_path)
+    if method == 'random':
+        random_selection = _random_selection(header.point_count, keep_fraction, seed)
+    elif method == 'grid':
+        mask = _voxel_mask(file_path, cell_size, chunk_size)
+    else:
+        raise ValueError(f"unknown thinning method {method!r}, use 'random' or 'grid'")
+
+    def select(chunk, start):
+        # the chunks come in file order
+        keep = random_selection(len(chunk)) if method == 'random' else mask[start:start + len(chunk)]
+        if keep_boundary:
+            keep = keep | _boundary(chunk, header)
+        return keep
+
+    written = _copy_points(file_path, output_path, select, chunk_size)
+    count('preprocess.thinned_points', header.point_count - written)
+    return written
+
+
+def _knn_median_distances(store, k, out, workers=1):
+    '''
+        The median distance of every point of a store to its k nearest neighbours (the point itself
+        excluded), chunk by chunk. The neighbours of a chunk are searched in a KD-tree of the points
+        in its bounding box grown by a halo. A distance is exact when the k-th neighbour is closer than
+        the edge of the grown box, the halo is grown again for the other points.
+
+        Input:
+            store: the PointStore
+            k: number of neighbours
+            out: array of num_points values, in the order of the store, the distances are written to
+            workers: number of threads of the KD-tree queries
+    '''
+    header = store.header
+    extent = max(header.x_max - header.x_min, header.y_max - header.y_min)
+    for c in range(store.num_chunks):
+        rows = slice(c * store.chunk_size, (c + 1) * store.chunk_size)
+        points = np.asarray(store.columns['xyz'][rows])
+        box = store.chunk_bbox[c]
+        # about twice the radius of a disk with k points at the density of the chunk
+        area = max((box[1] - box[0]) * (box[3] - box[2]), 1e-6)
+        halo = 2 * np.sqrt(k * area / len(points))
+        todo = np.arange(len(points))
+        while len(todo) > 0:
+            grown = [box[0] - halo, box[1] + halo, box[2] - halo, box[3] + halo]
+            candidates = store.read_xyz(bbox=grown)
+            distances, _ = cKDTree(candidates).query(points[todo], k=min(k + 1, len(candidates)), workers=workers)
+            distances = distances.reshape(len(todo), -1)
+            q = points[todo]
+            margin = np.minimum.reduce([q[:, 0] - grown[0], grown[1] - q[:, 0], q[:, 1] - grown[2], grown[3] - q[:, 1]])
+            exact = (distances[:, -1] <= margin) | (halo > extent)
+            out[rows][todo[exact]] = np.median(distances[exact, 1:], axis=1)
+            todo = todo[~exact]
+            halo *= 4
+
+
+def _radius_counts(store, radius, out, workers=1):
+    '''
+        The number of other points within radius of every point of a store, chunk by chunk,
+        with a KD-tree of the points in the bounding box of the chunk grown by radius
+    '''
+    for c in range(store.num_chunks):
+        rows = slice(c * store.chunk_size, (c + 1) * store.chunk_size)
+        points = np.asarray(store.columns['xyz'][rows])
+        box = store.chunk_bbox[c]
+        candidates = store.read_xyz(bbox=[box[0] - radius, box[1] + radius, box[2] - radius, box[3] + radius])
+        out[rows] = cKDTree(candidates).query_ball_point(points, radius, workers=workers, return_length=True) - 1
+
+
+@staged('outliers')
+def remove_outliers(file_path, output_path, method='statistical', k=3, std_ratio=2.0, radius=1.0,
+                    min_neighbors=2, chunk_size=65536, workers=1):
+    '''
+        Remove the outliers of a laz file (see thining+outlier_final.ipynb). The points are first
+        converted to a temporary PointStore, so the neighbours are searched chunk by chunk among
+        points close to each other, and the kept points are copied with all their attributes.
+
+        Input:
+            file_path: the input laz file
+            output_path: the output laz file
+            method: 'statistical' removes the points whose median distance to their k nearest neighbours
+                    is at least the mean + std_ratio * standard deviation of all median distances,
+                    'radius' removes the points with fewer than min_neighbors other points within radius
+            k: number of neighbours of the statistical filter
+            std_ratio: number of standard deviations of the threshold of the statistical filter
+            radius: search radius of the radius filter
+            min_neighbors: minimum number of neighbours of the radius filter
+            chunk_size: number of points of a chunk of the store
+            workers: number of threads of the KD-tree queries
+
+        Output:
+            the number of points written
+    '''
+    if method not in ('statistical', 'radius'):
+        raise ValueError(f"unknown outlier method {method!r}, use 'statistical' or 'radius'")
+    directory = tempfile.mkdtemp(prefix='outliers_', dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        with stage('store'):
+            store = PointStore.convert(file_path, os.path.join(directory, 'store'), dimensions=(),
+                                       chunk_size=chunk_size)
+        with stage('neighbors'):
+            if method == 'statistical':
+                values = np.lib.format.open_memmap(os.path.join(directory, 'median_distances.npy'), mode='w+',
+                                                   dtype=np.float64, shape=(store.num_points,))
+                _knn_median_distances(store, k, values, workers)
+                threshold = np.mean(values) + std_ratio * np.std(values)
+                keep = values < threshold
+            else:
+                values = np.empty(store.num_points, dtype=np.int64)
+                _radius_counts(store, radius, values, workers)
+                keep = values >= min_neighbors
+        mask = np.zeros(store.num_points, dtype=bool)
+        mask[store.order] = keep
+        del store, values
+        with stage('write'):
+            write_masked_points(file_path, output_path, mask)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    count('preprocess.outliers', len(mask) - np.count_nonzero(mask))
+    return int(np.count_nonzero(mask))
+
+
+@staged('preprocess')
+def preprocess(raw_file='../data/raw/69DN2_04.LAZ', bbx=(188465, 188965, 311800, 312300), buffer=50.0,
+               keep_fraction=0.25, outlier_method='statistical', outlier_options=None, seed=0,
+               output_dir='../data/processed'):
+    '''
+        The preprocessing of the notebooks in one run, from the AHN4 tile to the inputs of the pipeline:
+        the tile is cropped to bbx grown by buffer, thinned and filtered for the ground filtering,
+        and cropped to bbx and filtered for the interpolation and step4.
+
+        Input:
+            raw_file: the AHN4 laz tile
+            bbx: [min_x, max_x, min_y, max_y] of the study area
+            buffer: the margin of the crop used for the ground filtering
+            keep_fraction: the fraction of points kept by thinning
+            outlier_method, outlier_options: method and parameters of remove_outliers
+            seed: seed of the thinning
+            output_dir: directory of the output files
+
+        Output:
+            a dictionary with the paths of the thinned and filtered crop ('ground_input', e.g.
+            600_thinned_025_filtered.laz) and of the filtered study area ('tile', tile_500_filtered.laz)
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    outlier_options = dict(outlier_options or {})
+    size = bbx[1] - bbx[0]
+    buffered = f"{size + 2 * buffer:g}"
+    fraction = f"{keep_fraction:g}".replace('.', '')
+
+    crop_file = os.path.join(output_dir, f"tile_{buffered}.laz")
+    thinned_file = os.path.join(output_dir, f"{buffered}_thinned_{fraction}.laz")
+    ground_input = os.path.join(output_dir, f"{buffered}_thinned_{fraction}_filtered.laz")
+    area_file = os.path.join(output_dir, f"tile_{size:g}.laz")
+    tile = os.path.join(output_dir, f"tile_{size:g}_filtered.laz")
+
+    crop(raw_file, crop_file, bbx, buffer)
+    # the study area is inside the buffered crop, which is much smaller to read than the AHN4 tile
+    crop(crop_file, area_file, bbx)
+    thin(crop_file, thinned_file, keep_fraction=keep_fraction, seed=seed)
+    remove_outliers(thinned_file, ground_input, method=outlier_method, **outlier_options)
+    remove_outliers(area_file, tile, method=outlier_method, **outlier_options)
+    return {'ground_input': ground_input, 'tile': tile}
@@ -0,0 +1,156 @@
+import os
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from grid_binning import sort_by_cell
+
+# nodata value of all the rasters of the pipeline
+NODATA = -9999.0
+CRS = 'EPSG:28992'
+
+
+def header_transform(header, res):
+    '''
+        The transform of a raster with cells of res from the upper left corner of a laz header
+    '''
+    return rasterio.transform.from_origin(header.x_min, header.y_max, res, res)
+
+
+def raster_profile(transform, width, height, dtype='float64', nodata=NODATA, crs=CRS, blocksize=256):
+    '''
+        The profile of a tiled, deflate compressed single band GeoTIFF
+
+        Input:
+            transform: the transform of the raster
+            width, height: number of columns and rows
+            dtype: data type of the values
+            nodata: nodata value
+            crs: coordinate reference system
+            blocksize: size of the square tiles (a multiple of 16)
+
+        Output:
+            a dictionary to pass to rasterio.open or RasterWriter
+    '''
+    floating = np.issubdtype(np.dtype(dtype), np.floating)
+    return dict(driver='GTiff', width=width, height=height, count=1, dtype=np.dtype(dtype).name,
+                crs=crs, transform=transform, nodata=nodata,
+                tiled=True, blockxsize=blocksize, blockysize=blocksize,
+                compress='deflate', predictor=3 if floating else 2, BIGTIFF='IF_SAFER')
+
+
+class RasterWriter:
+    '''
+        Write a single band raster block by block, as the values are produced, and turn it into
+        a Cloud Optimized GeoTIFF with internal overviews when it is closed.
+        The blocks go to a tiled, compressed GeoTIFF next to the output first, so an interrupted
+        run never leaves an incomplete raster under the output name.
+
+            with RasterWriter(output, profile) as dst:
+                dst.write(block, row)
+    '''
+
+    def __init__(self, output, profile, cog=True, resampling='average'):
+        '''
+            Input:
+                output: output file name
+                profile: profile of the raster, see raster_profile
+                cog: convert to a Cloud Optimized GeoTIFF with overviews when closed
+                resampling: resampling method of the overviews
+        '''
+        self.output = output
+        self.profile = {**raster_profile(profile['transform'], profile['width'], profile['height'],
+                                         profile['dtype'], profile.get('nodata', NODATA),
+                                         profile.get('crs', CRS)),
+                        **{key: value for key, value in profile.items() if key in ('blockxsize', 'blockysize')}}
+        self.cog = cog
+        self.resampling = resampling
+        self.partial = f"{os.path.splitext(output)[0]}.partial.tif"
+        self.dst = None
+
+    def __enter__(self):
+        self.dst = rasterio.open(self.partial, 'w', **self.profile)
+        return self
+
+    def write(self, block, row=0, col=0):
+        '''
+            Write a 2D block of values with its upper left cell at (row, col)
+        '''
+        block = np.asarray(block)
+        window = Window(col, row, block.shape[1], block.shape[0])
+        self.dst.write(block.astype(self.profile['dtype'], copy=False), 1, window=window)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.dst.close()
+        if exc_type is not None:
+            os.remove(self.partial)
+            return False
+        if self.cog:
+            rasterio.shutil.copy(self.partial, self.output, driver='COG', compress='DEFLATE', predictor='YES',
+                                 blocksize=self.profile['blockxsize'], overviews='AUTO',
+                                 resampling=self.resampling, bigtiff='IF_SAFER')
+            os.remove(self.partial)
+        else:
+            os.replace(self.partial, self.output)
+        return False
+
+
+def write_raster(data, profile, output, block_rows=256, cog=True):
+    '''
+        Write a 2D array as a Cloud Optimized GeoTIFF, block_rows rows at a time
+
+        Input:
+            data: the values
+            profile: profile of the raster, see raster_profile (its width, height and dtype follow data)
+            output: output file name
+            block_rows: number of rows written at once
+            cog: write a Cloud Optimized GeoTIFF with overviews
+
+        Output:
+            the profile of the raster
+    '''
+    profile = {**profile, 'height': data.shape[0], 'width': data.shape[1], 'dtype': data.dtype.name}
+    with RasterWriter(output, profile, cog=cog) as dst:
+        for row in range(0, data.shape[0], block_rows):
+            dst.write(data[row:row + block_rows], row)
+    return dst.profile
+
+
+def patch_raster(file_path, rows, cols, values, resampling='average'):
+    '''
+        Set some cells of a single band raster in place. Only the tiles with changed cells are
+        read and written again, and the overviews of the raster are rebuilt.
+
+        Input:
+            file_path: the raster, e.g. written by write_raster
+            rows, cols: row and column of every changed cell
+            values: the new values
+            resampling: resampling method of the overviews
+
+        Output:
+            the number of tiles written
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    values = np.asarray(values)
+    # the COG layout is not kept when a tile is rewritten, the file stays a valid tiled GeoTIFF
+    with rasterio.open(file_path, 'r+', IGNORE_COG_LAYOUT_BREAK='YES') as dst:
+        block_rows, block_cols = dst.block_shapes[0]
+        tiles_x = -(-dst.width // block_cols)
+        order, tiles, starts = sort_by_cell((rows // block_rows) * tiles_x + cols // block_cols)
+        ends = np.append(starts[1:], len(order))
+        for tile, start, end in zip(tiles, starts, ends):
+            row0 = (tile // tiles_x) * block_rows
+            col0 = (tile % tiles_x) * block_cols
+            window = Window(col0, row0, min(block_cols, dst.width - col0), min(block_rows, dst.height - row0))
+            block = dst.read(1, window=window)
+            changed = order[start:end]
+            block[rows[changed] - row0, cols[changed] - col0] = values[changed]
+            dst.write(block, 1, window=window)
+        factors = dst.overviews(1)
+        if len(tiles) > 0 and factors:
+            dst.build_overviews(factors, Resampling[resampling])
+    return len(tiles)
@@ -1,10 +1,17 @@
-import rasterio
 import numpy as np
 import laspy
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
-from sklearn.cluster import DBSCAN
-from tqdm import tqdm
+from grid_binning import cell_indices, sort_by_cell, group_reduce
+from cell_index import CellIndex
+from crown_segmentation import dbscan
+from las_io import read_header
+from instrument import stage, staged, count
+from raster_io import NODATA, header_transform, raster_profile, write_raster
+
+# the dimensions and classes of the points step4 reads
+DIMENSIONS = ('classification', 'number_of_returns', 'red', 'nir')
+CLASSES = (1, 2)
 
 
 def read_point_cloud(file_path):
@@ -52,9 +59,12 @@ def write_point_cloud(data, file_name):
                            file_version = data.header.version)
     outfile.points = data.points
     outfile.write(file_name)
-def split_point_cloud(data,header,grid_size):
+def split_point_cloud(x, y, header, grid_size):
     """
     split point cloud into grids with specific grid size
+    instead of copying the points of every grid, the points are sorted by grid index
+    (row by row from y_min, col by col from x_min), so each grid is one run in that order
+    returns the sort order, the non-empty grids, the start of their runs and the raster size (rows, cols)
     """
     x_min = header.x_min
     y_min = header.y_min
@@ -63,42 +73,28 @@ def split_point_cloud(data,header,grid_size):
 
     x_range = np.arange(x_min, x_max, grid_size)
     y_range = np.arange(y_min, y_max, grid_size)
-    size = (len(x_range), len(y_range))
-    grids = []
-    grid_centers = []
-
-    # split by col and row, easier to reshape
-    for y in tqdm(y_range, desc="Splitting grids in rows"):
-        for x in x_range:
-            grid_centers.append([x + grid_size / 2, y + grid_size / 2])
-            mask = (data.x >= x) & (data.x < x + grid_size) & (data.y >= y) & (data.y < y + grid_size)
-            if np.any(mask):
-                grid_point = data[mask]
-                grids.append(grid_point)
-            else:
-                grids.append(None)
-    return grids, size, grid_centers
-def has_veg(data):
-    """
-    check if the grid has vegetation
-    with NDVI index
-    """
-    red = np.mean(data.red)
-    nir = np.mean(data.nir)
+    size = (len(y_range), len(x_range))
+
+    # split by row and col, easier to reshape
+    col, row, inside = cell_indices(x, y, x_min, y_min, grid_size, len(x_range), len(y_range))
+    grid_ids = np.where(inside, row * len(x_range) + col, -1)
+    order, grids, starts = sort_by_cell(grid_ids)
+    return order, grids, starts, size
+def has_veg(red, nir, ndvi_threshold=0.2):
+    """
+    check if the grids have vegetation
+    with NDVI index of the mean red and nir values (scalars or arrays)
+    """
     ndvi = (nir - red) / (nir + red)
-    if ndvi>=0.2:
-        return True
-    else:
-        return False
+    return ndvi >= ndvi_threshold
 def db_scan(data, eps = 0.5, min_samples = 10):
     """
     cluster the point cloud with DBSCAN
     (inspired by GEO1001-ASSIGNMENT4)
-    (just try, not used in this task)
+    tile by tile with a grid hashed neighbour search, see crown_segmentation
     """
     las_array = np.vstack([data.x, data.y, data.z]).transpose()
-    clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(las_array)
-    labels = clustering.labels_
+    labels = dbscan(las_array, eps, min_samples)
     point_labels = np.vstack([data.x, data.y, data.z, labels]).transpose()
     n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
     return point_labels, n_clusters_
@@ -124,47 +120,161 @@ def show_cluster(data):
     ax.set_zlabel('Z Label')
 
     plt.show()
-def write_raster(data, header, res):
+@staged('step4')
+def step4(file_path = '../data/processed/tile_500_filtered.laz',res = 0.5, ndvi_threshold = 0.2, output = None):
     """
-    write raster file with point cloud data
+    generate the vegetation DSM of file_path at resolution res,
+    written to output (../data/output/step4_{res}.tiff by default)
+    returns the height array and its raster metadata
     """
-    transform = rasterio.transform.from_origin(header.x_min, header.y_max, res, res)
-    crs = 'EPSG:28992'
-    with rasterio.open(f'../data/output/step4_{res}.tiff', 'w', driver='GTiff',
-                       height=data.shape[0], width=data.shape[1],nodata=np.nan,
-                       count=1, dtype=data.dtype,
-                       crs=crs, transform=transform) as dst:
-        dst.write(data, 1)
-
-
-def step4(file_path = '../data/processed/tile_500_filtered.laz',res = 0.5):
     print("Step4 Starts!")
-    las, header = read_point_cloud(file_path)
-    # select unclassified points and ground points
-    grid_veg = select_class(las, 1,2)
-    # split point cloud into grids
-    grids,size,grid_centers = split_point_cloud(grid_veg,header,res)
-    height = []
-    # generate height raster of vegetation points and average height of ground points
-    for grid in tqdm(grids, desc="Generating height raster"):
-        if grid is not None:
-            # judge if the grid has vegetation
-            if len(grid[grid.number_of_returns > 1]) != 0:
-                # has vegetation points, add the highest vegetation poi
-                if has_veg(grid):
-                    height.append(max(grid.z[grid.number_of_returns > 1]))
-                else: # no vegetation points ,add average height of ground points
-                    height.append(np.mean(grid.z[grid.classification == 2]))
-            else: # no vegetation
-                height.append(np.mean(grid.z[grid.classification == 2]))
-        else: # nodata for empty grids(no valid points)
-            height.append(np.nan)
+    if output is None:
+        output = f'../data/output/step4_{res}.tiff'
+    with stage('read'):
+        header = read_header(file_path)
+        # the unclassified points and ground points sorted by grid (the grids of split_point_cloud),
+        # only the dimensions needed, saved next to the laz file and reused by later runs at this resolution
+        grid_veg = CellIndex.for_file(file_path, res, DIMENSIONS, classes=CLASSES)
+    with stage('grid'):
+        grids, statistics = _index_statistics(grid_veg)
+        size = grid_veg.shape
+        grid_height = _grid_height(statistics, ndvi_threshold)
+    count('step4.empty_cells', size[0] * size[1] - len(grids))
+
+    # nodata for empty grids(no valid points)
+    height = np.full(size[0] * size[1], NODATA)
+    height[grids] = grid_height
 
     # reshape and reorganize the height array for output
-    height = np.array(height).reshape(size[0],size[1])
+    height = height.reshape(size[0],size[1])
     height = np.flipud(height)
-    write_raster(height,header,res)
+    with stage('write'):
+        meta = write_raster(height, raster_profile(header_transform(header, res), size[1], size[0]), output)
     print("Vegetation-DSM generated!")
+    return height, meta
+
+
+@staged('step4')
+def step4_pyramid(file_path = '../data/processed/tile_500_filtered.laz', resolutions = (0.5, 1, 2, 5),
+                  ndvi_threshold = 0.2, outputs = None):
+    """
+    generate the vegetation DSMs of several resolutions with one pass over the points:
+    the statistics of the grids (see _grid_statistics) are computed at the finest resolution,
+    and the grids of every coarser resolution, which must be a multiple of it, are blocks of fine grids,
+    so their statistics are the sums and maxima of those of the fine grids, like an overview pyramid.
+    the grids start at the lower left corner of the header, like in step4, so every DSM is the one of
+    step4 at its resolution (up to the rounding of the sums, and of points on the edge of a coarse grid).
+    outputs are ../data/output/step4_{res}.tiff by default
+    returns a list with the height array and raster metadata of every resolution
+    """
+    print("Step4 Starts!")
+    if outputs is None:
+        outputs = [f'../data/output/step4_{res}.tiff' for res in resolutions]
+    if len(outputs) != len(resolutions):
+        raise ValueError(f"{len(outputs)} outputs for {len(resolutions)} resolutions")
+    fine = min(resolutions)
+    factors = [int(round(res / fine)) for res in resolutions]
+    for res, factor in zip(resolutions, factors):
+        if abs(factor * fine - res) > 1e-9 * res:
+            raise ValueError(f"the resolution {res} is not a multiple of the finest resolution {fine}")
+
+    with stage('read'):
+        header = read_header(file_path)
+        grid_veg = CellIndex.for_file(file_path, fine, DIMENSIONS, classes=CLASSES)
+    with stage('grid'):
+        grids, statistics = _index_statistics(grid_veg)
+        size = grid_veg.shape
+        fine_statistics = {}
+        for name, values in statistics.items():
+            fine_statistics[name] = np.full(size[0] * size[1], -np.inf if name == 'veg_max' else 0, dtype=values.dtype)
+            fine_statistics[name][grids] = values
+            fine_statistics[name] = fine_statistics[name].reshape(size)
+
+    results = []
+    for res, factor, output in zip(resolutions, factors, outputs):
+        with stage('grid'):
+            # the raster size of step4 at this resolution
+            shape = (len(np.arange(header.y_min, header.y_max, res)), len(np.arange(header.x_min, header.x_max, res)))
+            coarse = {name: _coarsen(values, factor, shape, np.maximum if name == 'veg_max' else np.add)
+                      for name, values in fine_statistics.items()}
+            occupied = coarse['point_count'] > 0
+            height = np.full(shape, NODATA)
+            height[occupied] = _grid_height({name: values[occupied] for name, values in coarse.items()},
+                                            ndvi_threshold)
+            height = np.flipud(height)
+        with stage('write'):
+            meta = write_raster(height, raster_profile(header_transform(header, res), shape[1], shape[0]), output)
+        results.append((height, meta))
+        count('step4.resolutions')
+    print("Vegetation-DSMs generated!")
+    return results
+
+
+def _index_statistics(grid_veg):
+    """
+    the non-empty grids of a CellIndex of the points of step4 and their statistics (see _grid_statistics)
+    """
+    grids, starts = grid_veg.occupied()
+    inside = slice(0, grid_veg.offsets[-1])
+    columns = {name: grid_veg.columns[name][inside] for name in DIMENSIONS}
+    columns['z'] = grid_veg.xyz[inside, 2]
+    count('step4.points', inside.stop)
+    return grids, _grid_statistics(columns, starts)
+
+
+def _grid_statistics(grid_veg, starts):
+    """
+    the statistics every grid height is derived from, as reductions over the runs of the sorted points:
+    the number of points, of vegetation (multiple return) points and of ground points, the highest
+    vegetation point, and the sums of the ground heights, red and nir.
+    they are sums and maxima, so the statistics of a larger grid are those of the grids it contains added up
+    grid_veg holds the columns of the points sorted by grid, starts the start of the run of each grid
+    """
+    z = np.asarray(grid_veg['z'])
+    multi_return = grid_veg['number_of_returns'] > 1
+    ground = grid_veg['classification'] == 2
+    return {'point_count': np.diff(np.append(starts, len(z))),
+            'veg_count': group_reduce(np.add, multi_return.astype(np.int64), starts),
+            'veg_max': group_reduce(np.maximum, np.where(multi_return, z, -np.inf), starts),
+            'ground_count': group_reduce(np.add, ground.astype(np.int64), starts),
+            'ground_sum': group_reduce(np.add, np.where(ground, z, 0.0), starts),
+            'red_sum': group_reduce(np.add, grid_veg['red'].astype(np.float64), starts),
+            'nir_sum': group_reduce(np.add, grid_veg['nir'].astype(np.float64), starts)}
+
+
+def _coarsen(values, factor, shape, ufunc):
+    """
+    reduce blocks of factor * factor fine grids into the grids of a raster of shape (rows, cols),
+    the fine grids missing at the upper and right edges count as empty
+    """
+    fill = -np.inf if ufunc is np.maximum else 0
+    padded = np.full((shape[0] * factor, shape[1] * factor), fill, dtype=values.dtype)
+    rows, cols = min(values.shape[0], padded.shape[0]), min(values.shape[1], padded.shape[1])
+    padded[:rows, :cols] = values[:rows, :cols]
+    return ufunc.reduce(ufunc.reduce(padded.reshape(shape[0], factor, shape[1], factor), axis=3), axis=1)
+
+
+def _grid_height(statistics, ndvi_threshold):
+    """
+    height of every non-empty grid: the highest vegetation point, or the mean height of the ground points,
+    NODATA for a grid with neither vegetation nor ground points
+    statistics are those of _grid_statistics
+    """
+    point_count = statistics['point_count']
+    red = statistics['red_sum'] / point_count
+    nir = statistics['nir_sum'] / point_count
+
+    # generate height raster of vegetation points and average height of ground points
+    ground_count = statistics['ground_count']
+    ground_mean = np.divide(statistics['ground_sum'], ground_count, out=np.full(len(ground_count), NODATA),
+                            where=ground_count > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # has vegetation points, add the highest vegetation point
+        # no vegetation points, add average height of ground points
+        height = np.where((statistics['veg_count'] > 0) & has_veg(red, nir, ndvi_threshold),
+                          statistics['veg_max'], ground_mean)
+    # the raster has a single nodata value, never nan
+    height[~np.isfinite(height)] = NODATA
     return height
 
 if __name__ == '__main__':
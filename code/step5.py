@@ -1,5 +1,8 @@
 import rasterio
+from rasterio.windows import Window
 import numpy as np
+from instrument import staged, count
+from raster_io import NODATA, RasterWriter, raster_profile, write_raster
 
 
 def read_raster(file_path):
@@ -10,25 +13,49 @@ def read_raster(file_path):
         values = raster.read(1)
     return values, raster.meta
 
-def write_raster(data,meta):
+def chm(dtm, dsm, in_place=False):
     """
-    write raster file with point cloud data
+    CHM: the vegetation DSM minus the DTM, negative heights set to 0,
+    nodata where the DTM has no value
+    with in_place the dsm array is reused for the result
     """
-
-    with rasterio.open(f'../data/output/step5.tiff', 'w', **meta) as dst:
-        dst.write(data, 1)
-
-
-def step5():
-    print("Step5 Starts!")
-    step3, meta3 = read_raster('../data/output/dtm.tiff')
-    step4, meta4 = read_raster('../data/output/step4.tiff')
-
     # There is nodata in step4
     # we replace it with 0
-    step4 = np.nan_to_num(step4, nan=0.0)
-    step5 = step4 - step3
-    step5[step5 < 0] = 0
+    height = dsm if in_place else dsm.copy()
+    height[(height == NODATA) | np.isnan(height)] = 0.0
+    height -= dtm
+    np.maximum(height, 0, out=height)
+    height[dtm == NODATA] = NODATA
+    return height
 
-    write_raster(step5, meta4)
+
+@staged('step5')
+def step5(res=0.5, dtm_file=None, step4_file=None, output='../data/output/step5.tiff',
+          dtm=None, dsm=None, block_rows=256):
+    """
+    generate the CHM from the DTM and the vegetation DSM,
+    by default the files written by laplace and step4 at resolution res.
+    dtm and dsm can also be given in memory as (array, meta), as returned by laplace and step4,
+    then no raster is read. otherwise the files are processed block_rows rows at a time.
+    """
+    print("Step5 Starts!")
+    if dtm is not None and dsm is not None:
+        step3, _ = dtm
+        step4, meta4 = dsm
+        write_raster(chm(step3, step4), meta4, output)
+        print("CHM generated!")
+        return
+
+    if dtm_file is None:
+        dtm_file = f'../data/output/dtm_{res}.tiff'
+    if step4_file is None:
+        step4_file = f'../data/output/step4_{res}.tiff'
+    with rasterio.open(dtm_file) as step3, rasterio.open(step4_file) as step4:
+        profile = raster_profile(step4.transform, step4.width, step4.height, step4.dtypes[0])
+        with RasterWriter(output, profile) as dst:
+            for row in range(0, step4.height, block_rows):
+                window = Window(0, row, step4.width, min(block_rows, step4.height - row))
+                block = step4.read(1, window=window)
+                dst.write(chm(step3.read(1, window=window), block, in_place=True), row)
+                count('step5.blocks')
     print("CHM generated!")
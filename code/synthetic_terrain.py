@@ -0,0 +1,125 @@
+import numpy as np
+import laspy
+
+
+def terrain_height(x, y, x0, y0, seed=0):
+    '''
+        A smooth terrain surface: a gentle slope plus a few long waves
+
+        Input:
+            x, y: coordinates
+            x0, y0: lower left corner of the tile
+            seed: seed of the random phases
+
+        Output:
+            the terrain height at x, y
+    '''
+    rng = np.random.default_rng(seed)
+    u = np.asarray(x) - x0
+    v = np.asarray(y) - y0
+    z = 2.0 + 0.01 * u + 0.005 * v
+    for wavelength, amplitude in ((120.0, 1.5), (45.0, 0.5), (15.0, 0.1)):
+        phase = rng.uniform(0, 2 * np.pi, 2)
+        z = z + amplitude * np.sin(2 * np.pi * u / wavelength + phase[0]) * np.cos(2 * np.pi * v / wavelength + phase[1])
+    return z
+
+
+def generate_tile(file_path, extent=(100.0, 100.0), density=10.0, origin=(188465.0, 311800.0),
+                  building_fraction=0.1, tree_fraction=0.25, seed=0):
+    '''
+        Write a synthetic laz tile with the attributes the pipeline uses: ground (class 2), buildings
+        (class 6) and vegetation (class 1) with multiple returns, red and nir values (point format 8)
+
+        Input:
+            file_path: file path of the laz file to write
+            extent: size of the tile in x and y (m)
+            density: number of first returns per m2
+            origin: lower left corner of the tile
+            building_fraction: fraction of the area covered by buildings
+            tree_fraction: fraction of the area covered by tree crowns
+            seed: seed of the random generator
+
+        Output:
+            the number of points written
+    '''
+    rng = np.random.default_rng(seed)
+    x0, y0 = origin
+    width, height = extent
+    n = int(width * height * density)
+    x = x0 + rng.uniform(0, width, n)
+    y = y0 + rng.uniform(0, height, n)
+    ground_z = terrain_height(x, y, x0, y0, seed)
+
+    # rectangular buildings with a flat roof
+    building = np.zeros(n, dtype=bool)
+    roof = np.zeros(n)
+    covered = 0.0
+    while covered < building_fraction * width * height:
+        size = rng.uniform(8, 30, 2)
+        corner = rng.uniform((0, 0), (max(width - size[0], 1), max(height - size[1], 1)))
+        inside = (x - x0 >= corner[0]) & (x - x0 < corner[0] + size[0]) & \
+                 (y - y0 >= corner[1]) & (y - y0 < corner[1] + size[1]) & ~building
+        roof[inside] = terrain_height(x0 + corner[0], y0 + corner[1], x0, y0, seed) + rng.uniform(3, 15)
+        building |= inside
+        covered += size[0] * size[1]
+
+    # round tree crowns, away from the buildings
+    crown_height = np.zeros(n)
+    covered = 0.0
+    while covered < tree_fraction * width * height:
+        radius = rng.uniform(1.5, 5.0)
+        center = rng.uniform((0, 0), (width, height))
+        top = rng.uniform(5, 25)
+        d2 = ((x - x0 - center[0]) ** 2 + (y - y0 - center[1]) ** 2) / radius ** 2
+        inside = (d2 < 1) & ~building
+        crown_height[inside] = np.maximum(crown_height[inside], top * np.sqrt(1 - d2[inside]))
+        covered += np.pi * radius ** 2
+    tree = crown_height > 0
+
+    # first returns: roofs, crowns or ground
+    z = np.where(building, roof, np.where(tree, ground_z + crown_height, ground_z)) + rng.normal(0, 0.02, n)
+    classification = np.where(building, 6, np.where(tree, 1, 2)).astype(np.uint8)
+    number_of_returns = np.ones(n, dtype=np.uint8)
+    return_number = np.ones(n, dtype=np.uint8)
+
+    # vegetation has more returns: one inside the crown and, for part of the pulses, one on the ground
+    returns = rng.integers(2, 4, n)
+    trees = np.flatnonzero(tree)
+    number_of_returns[trees] = returns[trees]
+    extra = [(trees, 2, ground_z[trees] + rng.uniform(0.5, 1.0, len(trees)) * crown_height[trees], 1)]
+    last = trees[returns[trees] == 3]
+    extra.append((last, 3, ground_z[last] + rng.normal(0, 0.02, len(last)), 2))
+
+    xs, ys, zs, classes, nrs, rns = [x], [y], [z], [classification], [number_of_returns], [return_number]
+    for index, number, heights, code in extra:
+        xs.append(x[index])
+        ys.append(y[index])
+        zs.append(heights)
+        classes.append(np.full(len(index), code, dtype=np.uint8))
+        nrs.append(number_of_returns[index])
+        rns.append(np.full(len(index), number, dtype=np.uint8))
+    classification = np.concatenate(classes)
+
+    # vegetation reflects much more nir than red, the other surfaces about the same
+    vegetation = classification == 1
+    red = np.where(vegetation, rng.normal(8000, 1500, len(vegetation)), rng.normal(20000, 3000, len(vegetation)))
+    nir = np.where(vegetation, rng.normal(40000, 5000, len(vegetation)), rng.normal(22000, 3000, len(vegetation)))
+
+    header = laspy.LasHeader(version="1.4", point_format=8)
+    header.scales = np.array([0.001, 0.001, 0.001])
+    header.offsets = np.array([x0, y0, 0.0])
+    las = laspy.LasData(header)
+    las.x = np.concatenate(xs)
+    las.y = np.concatenate(ys)
+    las.z = np.concatenate(zs)
+    las.classification = classification
+    las.number_of_returns = np.concatenate(nrs)
+    las.return_number = np.concatenate(rns)
+    las.red = np.clip(red, 0, 65535).astype(np.uint16)
+    las.nir = np.clip(nir, 0, 65535).astype(np.uint16)
+    las.write(file_path)
+    return len(classification)
+
+
+if __name__ == '__main__':
+    print(generate_tile('../data/processed/synthetic_tile.laz'))
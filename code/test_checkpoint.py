@@ -0,0 +1,90 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+import checkpoint
+from GFTIN_final_pyVer import Tin, create_grid_and_find_lowest_points
+from laplace_interpolate import generate_grid, laplace_interpolant
+from las_io import read_xyz
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def interrupt_after(monkeypatch):
+    '''
+        Make the run raise Interrupted right after its n-th checkpoint save
+    '''
+    def interrupt(n):
+        save = checkpoint.Checkpoint.save
+        saves = []
+
+        def save_and_interrupt(self, **arrays):
+            save(self, **arrays)
+            saves.append(self.file_path)
+            if len(saves) == n:
+                raise Interrupted()
+
+        monkeypatch.setattr(checkpoint.Checkpoint, 'save', save_and_interrupt)
+    return interrupt
+
+
+def _seed_tin(points):
+    with contextlib.redirect_stdout(io.StringIO()):
+        seeds, _ = create_grid_and_find_lowest_points(points, 10)
+    tin = Tin()
+    tin.insert_lowest_pts(seeds)
+    return tin
+
+
+def test_resumed_densification_equals_uninterrupted(tiny_tile, tmp_path, interrupt_after, monkeypatch):
+    points = read_xyz(tiny_tile)
+    reference_tin = _seed_tin(points)
+    reference = reference_tin.find_distance_and_add_points_batch(points, curve='hilbert')
+
+    file_path = str(tmp_path / 'gftin.checkpoint.npz')
+    interrupt_after(2)
+    with pytest.raises(Interrupted):
+        _seed_tin(points).find_distance_and_add_points_batch(points, curve='hilbert', checkpoint=file_path,
+                                                             checkpoint_interval=0)
+    assert os.path.exists(file_path)
+    monkeypatch.undo()
+
+    tin = _seed_tin(points)
+    result = tin.find_distance_and_add_points_batch(points, curve='hilbert', checkpoint=file_path)
+    assert not os.path.exists(file_path)
+    assert tin.iterations == reference_tin.iterations
+    for values, expected in zip(result, reference):
+        np.testing.assert_array_equal(values, expected)
+    np.testing.assert_array_equal(tin.get_triangles(), reference_tin.get_triangles())
+
+
+def test_resumed_interpolation_equals_uninterrupted(tiny_ground, tmp_path, interrupt_after, monkeypatch):
+    points = tiny_ground[1]
+    low, high = points[:, :2].min(axis=0), points[:, :2].max(axis=0)
+    cell_centers, num_row, num_column = generate_grid([low[0], high[0], low[1], high[1]], 1.0)
+    reference = laplace_interpolant(points, cell_centers, num_row, num_column, batch_size=200)
+
+    file_path = str(tmp_path / 'dtm.checkpoint.npz')
+    interrupt_after(3)
+    with pytest.raises(Interrupted):
+        laplace_interpolant(points, cell_centers, num_row, num_column, batch_size=200, checkpoint=file_path,
+                            checkpoint_interval=0)
+    monkeypatch.undo()
+
+    result = laplace_interpolant(points, cell_centers, num_row, num_column, batch_size=200, checkpoint=file_path)
+    assert not os.path.exists(file_path)
+    np.testing.assert_array_equal(result, reference)
+
+
+def test_checkpoint_of_another_run_is_not_resumed(tmp_path):
+    file_path = str(tmp_path / 'run.checkpoint.npz')
+    key = checkpoint.checkpoint_key(np.arange(3), threshold=1)
+    checkpoint.Checkpoint(file_path, key).save(done=np.arange(2))
+    assert checkpoint.Checkpoint(file_path, checkpoint.checkpoint_key(np.arange(3), threshold=2)).load() is None
+    assert checkpoint.Checkpoint(file_path, key).load()['done'].tolist() == [0, 1]
@@ -0,0 +1,46 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from crown_segmentation import dbscan
+from las_io import read_points
+
+
+def _reference_dbscan(xyz, eps, min_samples):
+    # DBSCAN by its definition: the core points, and the clusters of core points linked within eps
+    pairs = cKDTree(xyz).query_pairs(eps, output_type='ndarray')
+    neighbors = np.bincount(pairs.ravel(), minlength=len(xyz)) + 1
+    core = neighbors >= min_samples
+    links = pairs[core[pairs[:, 0]] & core[pairs[:, 1]]]
+    graph = coo_matrix((np.ones(len(links)), (links[:, 0], links[:, 1])), shape=(len(xyz), len(xyz)))
+    clusters = connected_components(graph, directed=False)[1]
+    # a point is noise when no core point is within eps of it
+    near_core = core.copy()
+    near_core[pairs[core[pairs[:, 0]], 1]] = True
+    near_core[pairs[core[pairs[:, 1]], 0]] = True
+    return core, clusters, ~near_core, pairs
+
+
+def _same_partition(labels, expected):
+    # the same clusters, up to their numbering
+    pairs = np.unique(np.column_stack((labels, expected)), axis=0)
+    return len(pairs) == len(np.unique(labels)) == len(np.unique(expected))
+
+
+def test_tiled_dbscan_core_and_noise_labels(tiny_tile):
+    data = read_points(tiny_tile, ('x', 'y', 'z'), classes=(1,))
+    xyz = np.column_stack((data['x'], data['y'], data['z']))
+    eps, min_samples = 1.5, 5
+    # tiles much smaller than the tile, so that clusters cross their borders
+    labels = dbscan(xyz, eps=eps, min_samples=min_samples, tile_size=5.0)
+
+    core, clusters, noise, pairs = _reference_dbscan(xyz, eps, min_samples)
+    assert core.any() and noise.any() and len(np.unique(clusters[core])) > 1
+    # the noise points are the same, and the core points are in the same clusters
+    np.testing.assert_array_equal(labels == -1, noise)
+    assert _same_partition(labels[core], clusters[core])
+    # a border point is in the cluster of one of the core points within eps of it
+    for i in np.flatnonzero(~core & ~noise):
+        near = np.concatenate((pairs[pairs[:, 0] == i, 1], pairs[pairs[:, 1] == i, 0]))
+        assert labels[i] in labels[near[core[near]]]
@@ -0,0 +1,42 @@
+import contextlib
+import io
+
+import numpy as np
+
+from GFTIN_final_pyVer import Tin, create_grid_and_find_lowest_points
+from las_io import read_xyz
+from triangle_grid import TriangleGrid
+
+
+def _seed_tin(points, grid_size):
+    with contextlib.redirect_stdout(io.StringIO()):
+        seeds, _ = create_grid_and_find_lowest_points(points, grid_size)
+    tin = Tin()
+    tin.insert_lowest_pts(seeds)
+    return tin
+
+
+def test_incremental_locate_equals_rebuilt_grid(tiny_tile):
+    points = read_xyz(tiny_tile)
+    tin = _seed_tin(points, 4)
+    # points inside the TIN, so that its triangles stay inside the grid of the index
+    inside = np.flatnonzero(tin.locate_many(points)[0] >= 0)
+    tin.insert_lowest_pts(points[inside[::400]])
+    located, inside = tin.locate_many(points)
+    # the index was updated in place, not built again
+    assert len(tin.index.cell_triangles) != tin.index.built_entries
+    triangles = tin.get_triangles().astype(np.int64).reshape(-1, 3)
+    np.testing.assert_array_equal(located, TriangleGrid(tin.get_delaunay_vertices(), triangles).locate(points))
+    np.testing.assert_array_equal(inside, located >= 0)
+
+
+def test_batch_densification_does_not_depend_on_the_curve(tiny_tile):
+    points = read_xyz(tiny_tile)
+    results = []
+    for curve in (None, 'morton', 'hilbert'):
+        tin = _seed_tin(points, 10)
+        results.append(tin.find_distance_and_add_points_batch(points, curve=curve))
+    assert results[0][0].any()
+    for result in results[1:]:
+        for values, reference in zip(result, results[0]):
+            np.testing.assert_array_equal(values, reference)
@@ -0,0 +1,38 @@
+import numpy as np
+import rasterio
+
+from laplace_interpolate import (generate_grid, laplace, laplace_interpolant, laplace_interpolant_parallel,
+                                 laplace_update)
+
+
+def _bbox(points, margin):
+    low, high = points[:, :2].min(axis=0), points[:, :2].max(axis=0)
+    return [low[0] - margin, high[0] + margin, low[1] - margin, high[1] + margin]
+
+
+def test_parallel_equals_serial(tiny_ground):
+    points = tiny_ground[1]
+    # cells outside the convex hull too, and tiles small enough for their halos to be grown
+    cell_centers, num_row, num_column = generate_grid(_bbox(points, 2.0), 1.0)
+    serial = laplace_interpolant(points, cell_centers, num_row, num_column)
+    parallel = laplace_interpolant_parallel(points, cell_centers, num_row, num_column, workers=2, tile_size=8,
+                                            halo=1.0)
+    assert (serial == -9999).any()
+    np.testing.assert_array_equal(parallel, serial)
+
+
+def test_update_equals_full_interpolation(tiny_tile, tiny_ground, tmp_path):
+    ground_file, points = tiny_ground
+    bbx = _bbox(points, -2.0)
+    dtm_file = str(tmp_path / 'dtm.tiff')
+    laplace(res=1.0, file_path=ground_file, header_path=tiny_tile, bbx=bbx, output=dtm_file)
+
+    removed = np.arange(0, len(points), 37)
+    added = points[5::50] + [0.3, 0.2, 0.1]
+    new_points, (rows, cols) = laplace_update(dtm_file, points, added, removed, bbx=bbx, group_size=10.0)
+    assert 0 < len(rows) < np.prod(generate_grid(bbx, 1.0)[1:])
+
+    cell_centers, num_row, num_column = generate_grid(bbx, 1.0)
+    with rasterio.open(dtm_file) as raster:
+        np.testing.assert_array_equal(raster.read(1), laplace_interpolant(new_points, cell_centers, num_row,
+                                                                          num_column))
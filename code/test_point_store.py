@@ -0,0 +1,36 @@
+import numpy as np
+
+from las_io import read_points
+from point_store import PointStore
+
+
+def _rows(xyz):
+    # the points as sorted rows, to compare sets of points read in different orders
+    xyz = np.asarray(xyz)
+    return xyz[np.lexsort(xyz.T[::-1])]
+
+
+def test_bbox_and_class_queries(tiny_tile, tmp_path):
+    store = PointStore.convert(tiny_tile, str(tmp_path / 'store'), chunk_size=256)
+    data = read_points(tiny_tile, ('x', 'y', 'z', 'classification'))
+    xyz = np.column_stack((data['x'], data['y'], data['z']))
+    assert store.num_points == len(xyz)
+    np.testing.assert_array_equal(store.read_xyz(), xyz[store.order])
+
+    x0, y0 = xyz[:, :2].min(axis=0)
+    bbox = [x0 + 5, x0 + 15, y0 + 10, y0 + 20]
+    in_bbox = (xyz[:, 0] >= bbox[0]) & (xyz[:, 0] <= bbox[1]) & (xyz[:, 1] >= bbox[2]) & (xyz[:, 1] <= bbox[3])
+    ground = data['classification'] == 2
+    # a small bbox only reads the chunks around it
+    assert 0 < len(store.chunks(bbox=bbox)) < store.num_chunks
+
+    np.testing.assert_array_equal(_rows(store.read_xyz(bbox=bbox)), _rows(xyz[in_bbox]))
+    np.testing.assert_array_equal(_rows(store.read_xyz(classes=[2])), _rows(xyz[ground]))
+    np.testing.assert_array_equal(_rows(store.read_xyz(bbox=bbox, classes=[2])), _rows(xyz[in_bbox & ground]))
+    assert len(store.read_xyz(classes=[9])) == 0
+
+    # the readers of las_io read a store like the laz file
+    points = read_points(store.directory, ('x', 'y', 'z', 'classification'), classes=[1, 2])
+    assert np.isin(points['classification'], [1, 2]).all()
+    np.testing.assert_array_equal(_rows(np.column_stack((points['x'], points['y'], points['z']))),
+                                  _rows(xyz[np.isin(data['classification'], [1, 2])]))
@@ -0,0 +1,27 @@
+import numpy as np
+
+from raster_io import NODATA
+from step4 import _grid_height, _grid_statistics
+
+
+def _heights(classification, number_of_returns, z, red, nir, starts, ndvi_threshold=0.2):
+    columns = {'classification': np.array(classification), 'number_of_returns': np.array(number_of_returns),
+               'z': np.array(z, dtype=np.float64), 'red': np.array(red), 'nir': np.array(nir)}
+    return _grid_height(_grid_statistics(columns, np.array(starts)), ndvi_threshold)
+
+
+def test_grid_without_ground_or_vegetation_is_nodata():
+    # one unclassified single return point: no vegetation and no ground point
+    assert _heights([1], [1], [5.0], [100], [200], [0]).tolist() == [NODATA]
+
+
+def test_grid_with_vegetation_below_ndvi_threshold_and_no_ground_is_nodata():
+    # multiple return points, but red above nir
+    assert _heights([1, 1], [2, 2], [5.0, 7.0], [200, 200], [100, 100], [0]).tolist() == [NODATA]
+
+
+def test_grid_heights():
+    # a vegetation grid, a ground grid and a grid of neither
+    height = _heights([1, 1, 2, 2, 2, 1], [2, 3, 1, 1, 1, 1], [5.0, 7.0, 1.0, 2.0, 3.0, 4.0],
+                      [100, 100, 100, 100, 100, 100], [200, 200, 100, 100, 100, 100], [0, 2, 5])
+    assert height.tolist() == [7.0, 2.0, NODATA]
@@ -0,0 +1,156 @@
+import numpy as np
+
+
+class TriangleGrid:
+    '''
+        Point location for many points at once: the triangles are bucketed into a uniform grid
+        (every triangle is registered in the cells its bounding box overlaps), and a point is
+        tested with barycentric coordinates against the triangles of the cell it falls in.
+    '''
+
+    def __init__(self, vertices, triangles, cell_size=None):
+        '''
+            Input:
+                vertices: an array of vertices with x, y (and z) values
+                triangles: an array of triangles, 3 vertex indices each
+                cell_size: size of the grid cells, by default about the size of one triangle
+        '''
+        self.vertices = np.asarray(vertices, dtype=np.float64)[:, :2]
+        # a triangulation of fewer than 3 points has no triangles
+        self.triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+
+        corners = self.vertices[self.triangles]
+        self.tri_min = corners.min(axis=1)
+        self.tri_max = corners.max(axis=1)
+        self.origin = self.tri_min.min(axis=0) if len(self.triangles) > 0 else np.zeros(2)
+        extent = self.tri_max.max(axis=0) - self.origin if len(self.triangles) > 0 else np.ones(2)
+        if cell_size is None:
+            cell_size = np.sqrt(max(extent[0] * extent[1], 1e-12) / max(len(self.triangles), 1))
+        self.cell_size = cell_size
+        self.shape = (int(extent[1] // cell_size) + 1, int(extent[0] // cell_size) + 1)
+
+        # register every triangle in the cells overlapped by its bounding box
+        entry_cell, entry_tri = self._entries(np.arange(len(self.triangles)))
+        order = np.argsort(entry_cell, kind='stable')
+        self.cell_triangles = entry_tri[order]
+        self.cell_offsets = np.searchsorted(entry_cell[order], np.arange(self.shape[0] * self.shape[1] + 1))
+        # the number of entries when the grid was built, see update
+        self.built_entries = len(self.cell_triangles)
+
+    def _entries(self, tri):
+        # the (cell, triangle) pairs of the triangles tri, one per cell overlapped by the bounding box of the triangle
+        col0, row0 = self._cell(self.tri_min[tri])
+        col1, row1 = self._cell(self.tri_max[tri])
+        width = col1 - col0 + 1
+        count = width * (row1 - row0 + 1)
+        entry_tri = np.repeat(tri, count)
+        k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        entry_cell = (np.repeat(row0, count) + k // np.repeat(width, count)) * self.shape[1] + \
+                     np.repeat(col0, count) + k % np.repeat(width, count)
+        return entry_cell, entry_tri
+
+    def update(self, vertices, triangles, old_to_new, changed, max_growth=2.0):
+        '''
+            Follow the triangulation after points were inserted into it, without bucketing all the
+            triangles again: the entries of the triangles that are still there are renumbered, and
+            only the new triangles are bucketed and merged into the cells. locate gives the same
+            triangle as a new TriangleGrid (the smallest index). The grid is built again when the
+            new triangles reach outside it, or when the cells hold max_growth times more triangles
+            than when it was built, because the triangles became much smaller.
+
+            Input:
+                vertices, triangles: the vertices and triangles after the insertions
+                old_to_new: for every former triangle its index in triangles, -1 if it is gone
+                changed: the indices of the new triangles
+                max_growth: growth of the number of entries of the cells above which the grid is built again
+
+            Output:
+                the TriangleGrid
+        '''
+        vertices = np.asarray(vertices, dtype=np.float64)[:, :2]
+        triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+        changed = np.asarray(changed, dtype=np.int64)
+        kept = np.flatnonzero(old_to_new >= 0)
+
+        tri_min = np.empty((len(triangles), 2))
+        tri_max = np.empty((len(triangles), 2))
+        tri_min[old_to_new[kept]] = self.tri_min[kept]
+        tri_max[old_to_new[kept]] = self.tri_max[kept]
+        corners = vertices[triangles[changed]]
+        tri_min[changed] = corners.min(axis=1)
+        tri_max[changed] = corners.max(axis=1)
+
+        num_cells = self.shape[0] * self.shape[1]
+        col0, row0 = self._cell(tri_min[changed])
+        col1, row1 = self._cell(tri_max[changed])
+        outside = np.any((col0 < 0) | (row0 < 0) | (col1 >= self.shape[1]) | (row1 >= self.shape[0]))
+        if outside or len(self.cell_triangles) > max_growth * self.built_entries:
+            self.__init__(vertices, triangles)
+            return self
+
+        self.vertices, self.triangles, self.tri_min, self.tri_max = vertices, triangles, tri_min, tri_max
+        # the entries of the triangles still there keep their order by cell, the new ones are merged in
+        entry_cell = np.repeat(np.arange(num_cells), np.diff(self.cell_offsets))
+        entry_tri = old_to_new[self.cell_triangles]
+        alive = entry_tri >= 0
+        entry_cell, entry_tri = entry_cell[alive], entry_tri[alive]
+        new_cell, new_tri = self._entries(changed)
+        order = np.argsort(new_cell, kind='stable')
+        new_cell, new_tri = new_cell[order], new_tri[order]
+        self.cell_triangles = np.insert(entry_tri, np.searchsorted(entry_cell, new_cell, side='right'), new_tri)
+        counts = np.bincount(entry_cell, minlength=num_cells) + np.bincount(new_cell, minlength=num_cells)
+        self.cell_offsets = np.append(0, np.cumsum(counts))
+        return self
+
+    def _cell(self, xy):
+        col = np.floor((xy[:, 0] - self.origin[0]) / self.cell_size).astype(np.int64)
+        row = np.floor((xy[:, 1] - self.origin[1]) / self.cell_size).astype(np.int64)
+        return col, row
+
+    def locate(self, xy, batch_size=500000, tolerance=1e-9, subset=None):
+        '''
+            Input:
+                xy: an array of [x, y] locations
+                subset: optional boolean mask of the triangles, only those are searched
+
+            Output:
+                the index of the triangle containing each location, -1 if no triangle contains it
+                (the smallest index when the location is on the edge of several triangles)
+        '''
+        xy = np.asarray(xy, dtype=np.float64)[:, :2]
+        located = np.full(len(xy), -1, dtype=np.int64)
+        for start in range(0, len(xy), batch_size):
+            located[start:start + batch_size] = self._locate(xy[start:start + batch_size], tolerance, subset)
+        return located
+
+    def _locate(self, xy, tolerance, subset=None):
+        col, row = self._cell(xy)
+        in_grid = (col >= 0) & (col < self.shape[1]) & (row >= 0) & (row < self.shape[0])
+        cell = np.where(in_grid, row * self.shape[1] + col, 0)
+        start = self.cell_offsets[cell]
+        count = np.where(in_grid, self.cell_offsets[cell + 1] - start, 0)
+
+        # all (location, candidate triangle) pairs
+        pair_q = np.repeat(np.arange(len(xy)), count)
+        pair_t = self.cell_triangles[np.repeat(start - np.cumsum(count) + count, count) + np.arange(count.sum())]
+        p = xy[pair_q]
+        inside = np.all((p >= self.tri_min[pair_t]) & (p <= self.tri_max[pair_t]), axis=1)
+        if subset is not None:
+            inside &= subset[pair_t]
+        pair_q, pair_t = pair_q[inside], pair_t[inside]
+
+        a, b, c = (self.vertices[self.triangles[pair_t, i]] for i in range(3))
+        p = xy[pair_q]
+        det = (b[:, 1] - c[:, 1]) * (a[:, 0] - c[:, 0]) + (c[:, 0] - b[:, 0]) * (a[:, 1] - c[:, 1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            l1 = ((b[:, 1] - c[:, 1]) * (p[:, 0] - c[:, 0]) + (c[:, 0] - b[:, 0]) * (p[:, 1] - c[:, 1])) / det
+            l2 = ((c[:, 1] - a[:, 1]) * (p[:, 0] - c[:, 0]) + (a[:, 0] - c[:, 0]) * (p[:, 1] - c[:, 1])) / det
+        inside = (l1 >= -tolerance) & (l2 >= -tolerance) & (1 - l1 - l2 >= -tolerance)
+
+        # the triangle with the smallest index containing the location, the pairs are sorted by location
+        pair_q, pair_t = pair_q[inside], pair_t[inside]
+        located = np.full(len(xy), -1, dtype=np.int64)
+        if len(pair_q) > 0:
+            first = np.flatnonzero(np.append(True, pair_q[1:] != pair_q[:-1]))
+            located[pair_q[first]] = np.minimum.reduceat(pair_t, first)
+        return located